@@ -19,10 +19,10 @@
 # Anonymize queries, documents and workers to release the data.
 
 import argparse
-import bs4
 import csv
 
 from fields import orig_query, rel_column
+from html_snippets import first_tag_attrs
 
 
 class DynamicIDs:
@@ -129,7 +129,7 @@ if __name__ == '__main__':
                                                       ])
             output_writer.writeheader()
             for row in reader:
-                snippet = bs4.BeautifulSoup(row['snippet'], 'html.parser').li
+                snippet = first_tag_attrs(row['snippet'].decode('utf-8'))
                 classes = frozenset(snippet['class'])
                 output_writer.writerow({'cas_query_id': query_to_id[row[orig_query['query']]],
                                         'cas_log_id': row['log_id'],
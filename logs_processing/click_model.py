@@ -29,29 +29,26 @@ import itertools
 import jsonpickle
 import math
 import multiprocessing
+import os
 import pandas as pd
+import pickle
 import sys
+import traceback
 
 import numpy as np
 import scipy.optimize
 import scipy.stats
 import sklearn.cross_validation
 
-from pyclick.click_models.PBM import PBM as pyclick_PBM
-from pyclick.click_models.UBM import UBM as pyclick_UBM
-from pyclick.search_session.SearchResult import SearchResult as pyclick_SearchResult
-from pyclick.search_session.SearchSession import SearchSession as pyclick_SearchSession
-
+from columnar_logs import ColumnarLogs
 from create_tasks import Action, LogItem
+from ubm import UBM_GAMMAS, UBM_RELS, ubm_full_click_probs, uubm_click_probs, uubm_exam_click_probs
 
 
 DEBUG = False
 USE_CF_TRUST = True
 
 
-def prod(l):
-    return math.exp(sum(math.log(x) for x in l))
-
 class PrettyFloat(float):
     def __repr__(self):
         return "%.2f" % self
@@ -65,6 +62,17 @@ def parse_sat(sat_feedback):
     return None
 
 
+def parse_geometry(emup):
+    """ (offset_top, width, height) from the emup field of a snippet:
+        "offset parent;?;offset_top;width;height".
+    """
+    fields = emup.split(';')
+    if len(fields) != 5:
+        raise ValueError('Incorrect emup: %r' % emup)
+    _, _, offset_top, width, height = [int(d) for d in fields]
+    return offset_top, width, height
+
+
 def parse_relevance_rating(rel, offset=1):
     if len(rel) == 0:
         return None
@@ -124,6 +132,11 @@ def sigma(x):
         return math.exp(x - math.log(1 + math.exp(x)))
 
 
+def log_sigma(x):
+    """ Element-wise log(sigma(x)) for NumPy arrays, stable for large |x|. """
+    return -np.logaddexp(0, -x)
+
+
 class RelContainer:
     """ All the labels assigned by the crowd workers to a query-doc pair.
 
@@ -160,6 +173,139 @@ class RelContainer:
     def __nonzero__(self):
         return len(self.Ds) > 0 and len(self.Rs) > 0
 
+
+class RelevanceStore(object):
+    """ Relevance labels of the items as arrays indexed by dense integer item ids.
+
+        Built from a mapping log_id -> RelContainer. Log ids that are not in the
+        mapping yet are looked up in it on first use, so defaultdict-like mappings
+        work as before. Row 0 is an item without any labels; it is also used for
+        unknown log ids when there is no mapping (see load()).
+
+        The arrays can be written with save() and loaded memory-mapped with load()
+        to share them read-only between processes.
+    """
+
+    arrays = ['hist_D', 'hist_R', 'dist_D', 'dist_R',
+              'most_common_D', 'most_common_R', 'avg_D', 'avg_R']
+
+    def __init__(self, log_id_to_rel=None):
+        self.log_id_to_rel = log_id_to_rel
+        self.log_ids = [None]
+        self.ids = {}
+        self._buffers = {}
+        self._append([RelContainer()])
+        if log_id_to_rel is not None:
+            self._add(log_id_to_rel.keys())
+
+    @staticmethod
+    def wrap(log_id_to_rel):
+        """ Return log_id_to_rel if it is already a RelevanceStore, otherwise build one. """
+        if isinstance(log_id_to_rel, RelevanceStore):
+            return log_id_to_rel
+        return RelevanceStore(log_id_to_rel)
+
+    def _append(self, containers):
+        """ Append the rows for the RelContainer's to the arrays. """
+        rows = collections.defaultdict(list)
+        for rel in containers:
+            for rel_aspect, ratings in [('D', rel.Ds), ('R', rel.Rs)]:
+                num_bins = RelContainer.grades_D if rel_aspect == 'D' else RelContainer.grades_R
+                hist = np.zeros(num_bins)
+                for r in ratings:
+                    hist[r[0]] += r[1]
+                rows['hist_' + rel_aspect].append(hist)
+                rows['dist_' + rel_aspect].append(rel_dist(ratings, rel_aspect))
+                rows['most_common_' + rel_aspect].append(rel_most_common(ratings))
+                rows['avg_' + rel_aspect].append(rel_avg(ratings))
+        # The arrays are views of buffers with spare capacity that grow geometrically,
+        # so that adding the items in many small batches takes linear time.
+        for name in self.arrays:
+            dtype = np.int8 if name.startswith('most_common_') else float
+            new_rows = np.array(rows[name], dtype=dtype)
+            old_rows = getattr(self, name, new_rows[:0])
+            size = len(old_rows) + len(new_rows)
+            buf = self._buffers.get(name)
+            if buf is None or len(buf) < size:
+                buf = np.empty((max(size, 2 * len(old_rows)),) + new_rows.shape[1:], dtype=dtype)
+                buf[:len(old_rows)] = old_rows
+                self._buffers[name] = buf
+            buf[len(old_rows):size] = new_rows
+            setattr(self, name, buf[:size])
+
+    def _add(self, log_ids):
+        log_ids = [l for l in collections.OrderedDict.fromkeys(log_ids) if l not in self.ids]
+        if not log_ids:
+            return
+        self._append([self.log_id_to_rel[l] for l in log_ids])
+        for log_id in log_ids:
+            self.ids[log_id] = len(self.log_ids)
+            self.log_ids.append(log_id)
+
+    def indices(self, log_ids):
+        """ Array of item ids for the log ids. """
+        if self.log_id_to_rel is not None:
+            self._add(l for l in log_ids if l not in self.ids)
+        return np.array([self.ids.get(l, 0) for l in log_ids], dtype=np.int64)
+
+    def index(self, log_id):
+        return self.indices([log_id])[0]
+
+    def dist(self, index, rel_aspect, trec_style=False):
+        """ Same as rel_dist() for the item(s) with the given id(s). """
+        if trec_style:
+            num_bins = RelContainer.grades_D if rel_aspect == 'D' else RelContainer.grades_R
+            return np.eye(num_bins)[getattr(self, 'most_common_' + rel_aspect)[index]]
+        return getattr(self, 'dist_' + rel_aspect)[index]
+
+    def most_common(self, index, rel_aspect):
+        """ Same as rel_most_common() for the item(s) with the given id(s). """
+        return getattr(self, 'most_common_' + rel_aspect)[index]
+
+    def session_labels(self, session, rel_aspect='R'):
+        """ Array of the most common labels of the session items. """
+        return self.most_common(self.indices([l.log_id for l in session]), rel_aspect).astype(int)
+
+    def session_arrays(self, sessions, rel_aspect='R', max_len=None):
+        """ Padded (N x L) arrays of the most common labels and the clicks of
+            the sessions items and the mask of the non-padding positions.
+            Sessions are truncated to max_len items if it is given.
+        """
+        sessions = [s[:max_len] for s in sessions]
+        N = len(sessions)
+        L = max(len(s) for s in sessions) if N else 0
+        items = np.zeros((N, L), dtype=np.int64)
+        clicks = np.zeros((N, L), dtype=bool)
+        mask = np.zeros((N, L), dtype=bool)
+        for n, session in enumerate(sessions):
+            items[n, :len(session)] = self.indices([l.log_id for l in session])
+            clicks[n, :len(session)] = [l.click for l in session]
+            mask[n, :len(session)] = True
+        labels = self.most_common(items, rel_aspect).astype(int)
+        return np.where(mask, labels, 0), clicks, mask
+
+    def save(self, directory):
+        """ Write the arrays to directory as .npy files. """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in self.arrays:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'log_ids.pickle'), 'wb') as f:
+            pickle.dump(self.log_ids, f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """ Read the arrays written by save(), memory-mapped by default. """
+        store = object.__new__(cls)
+        store.log_id_to_rel = None
+        for name in cls.arrays:
+            setattr(store, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(directory, 'log_ids.pickle'), 'rb') as f:
+            store.log_ids = pickle.load(f)
+        store.ids = dict((l, i) for i, l in enumerate(store.log_ids) if i > 0)
+        return store
+
+
 NUM_ITEM_TYPES = 10
 
 MAX_OFFSET_TOP = 1869
@@ -182,6 +328,65 @@ Snippet = collections.namedtuple('Snippet', ['emup',
 )
 
 
+def read_csv_rows(file_name):
+    with open(file_name) as f:
+        for row in csv.DictReader(f):
+            yield row
+
+
+def sessions_from_rows(rows, sat_labels=None):
+    """ Group the rows of serps_anonymized.csv into sessions.
+
+        Yields dicts with the query, sat, session and serp keys. Sessions with
+        an undefined satisfaction label are skipped. If sat_labels is a list,
+        the raw satisfaction labels of all the sessions are appended to it.
+        The actions of the rows are either jsonpickle'd or LogItem objects
+        (see ColumnarLogs).
+    """
+    for key, query_rows_iter in itertools.groupby(rows,
+                    key=lambda row: (row['cas_log_id'].split('_')[:-1], # SERP id
+                                     row['cas_query_id'],
+                                     row['sat_feedback'])):
+        sat = key[2]
+        if DEBUG and sat == 'undefined':
+            print >>sys.stderr, 'Undefined sat label for query [%s]' % key[1]
+        if sat_labels is not None:
+            sat_labels.append(sat)
+        sat = parse_sat(sat)
+        if sat is None:
+            continue
+        data_row = {'query': key[1], 'sat': sat, 'session': [], 'serp': []}
+        for row in query_rows_iter:
+            actions = row['actions']
+            if isinstance(actions, basestring):
+                actions = jsonpickle.decode(actions)
+            data_row['session'].append(actions)
+            data_row['serp'].append(Snippet(emup=row['emup'],
+                                            cas_item_type=row['cas_item_type'],
+                                            is_complex=row['is_complex']))
+        yield data_row
+
+
+def read_sessions(task_file, sat_labels=None):
+    """ Read the sessions from a serps_anonymized.csv file object one at a time
+        (see sessions_from_rows()).
+    """
+    return sessions_from_rows(csv.DictReader(task_file), sat_labels)
+
+
+def read_session_chunks(task_file_name, chunk_size):
+    """ Read the sessions from a serps_anonymized.csv file in lists of chunk_size. """
+    with open(task_file_name) as task_file:
+        chunk = []
+        for data_row in read_sessions(task_file):
+            chunk.append(data_row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
 class UserModel:
     __metaclass__ = ABCMeta
 
@@ -197,6 +402,17 @@ class UserModel:
     def utility(self, p, session, serp):
         pass
 
+    def log_likelihood_batch(self, p, data):
+        """ LogLikelihood of arrays with the (f_only) values for the sessions in data. """
+        ll_values = [self.log_likelihood(p, d['session'], d['serp'], d['sat'], f_only=True)
+                     for d in data]
+        return LogLikelihood(*[np.array([getattr(l, f) for l in ll_values], dtype=float)
+                               for f in LogLikelihood._fields])
+
+    def utility_batch(self, p, data):
+        """ Array of utilities of the sessions in data. """
+        return np.array([self.utility(p, d['session'], d['serp']) for d in data], dtype=float)
+
 
 class RandomSatModel(UserModel):
     def train(self, data):
@@ -226,30 +442,152 @@ class RandomSatModel(UserModel):
         p_click, p_sat = p
         return p_sat
 
+    def log_likelihood_batch(self, p, data):
+        p_click, p_sat = p
+        num_clicked = np.array([sum(1 for l in d['session'] if l.click) for d in data], dtype=float)
+        num_results = np.array([len(d['session']) for d in data], dtype=float)
+        sat = np.array([d['sat'] for d in data], dtype=bool)
+        ll_click = num_clicked * math.log(p_click) + (num_results - num_clicked) * math.log(1 - p_click)
+        ll_sat = np.where(sat, math.log(p_sat), math.log(1 - p_sat))
+        return LogLikelihood(full=ll_click + ll_sat,
+                             gaussian=np.full(len(data), np.nan),
+                             clicks=ll_click,
+                             sat=ll_sat)
+
+    def utility_batch(self, p, data):
+        p_click, p_sat = p
+        return np.full(len(data), p_sat)
+
+
+class EMClickModel(object):
+    """ PBM or UBM click model trained with EM, same as the pyclick models.
+
+        Sessions are given as (N x L) arrays of document ids and clicks with
+        a mask for the padding. Training aggregates them into counts over
+        (doc, rank, previous click rank, click) and runs batched EM over the
+        count tensor; the previous click rank is 0 if there was no click above
+        and the rank of the last click plus one otherwise. Parameters never
+        seen in the training data are 0.5 as in pyclick.
+    """
+
+    iterations = 50
+
+    def __init__(self, model_name):
+        assert model_name in ['PBM', 'UBM'], model_name
+        self.model_name = model_name
+        self.attr = np.zeros(0)         # doc -> attractiveness
+        self.exam = np.zeros((0, 1))    # rank, previous click rank -> examination
+
+    @staticmethod
+    def prev_click_ranks(clicks):
+        """ Previous click rank (see above) for each position. """
+        ranks = np.arange(1, clicks.shape[1] + 1) * clicks
+        prev = np.maximum.accumulate(ranks, axis=1)
+        return np.concatenate([np.zeros((len(clicks), 1), dtype=prev.dtype), prev[:, :-1]], axis=1)
+
+    def _params(self, docs, ranks, prev):
+        """ Attractiveness and examination probabilities at the given indices,
+            0.5 for the ones not in the model.
+        """
+        attr = np.pad(self.attr, (0, max(0, docs.max() + 1 - len(self.attr))),
+                      'constant', constant_values=0.5)
+        exam = np.pad(self.exam, [(0, max(0, ranks.max() + 1 - self.exam.shape[0])),
+                                  (0, max(0, prev.max() + 1 - self.exam.shape[1]))],
+                      'constant', constant_values=0.5)
+        if self.model_name == 'PBM':
+            prev = np.zeros_like(prev)
+        return attr[docs], exam[ranks, prev]
+
+    def train(self, docs, clicks, mask):
+        N, L = docs.shape
+        prev = self.prev_click_ranks(clicks)
+        ranks = np.broadcast_to(np.arange(L), (N, L))
+        shape = (docs[mask].max() + 1 if mask.any() else 0, L, L + 1, 2)
+        counts = np.bincount(np.ravel_multi_index(
+                (docs[mask], ranks[mask], prev[mask], clicks[mask].astype(int)), shape),
+                minlength=int(np.prod(shape))).reshape(shape)
+        # Positions without clicks; the clicked ones contribute 1 to both posteriors.
+        no_click, click = counts[..., 0], counts[..., 1]
+        total = no_click + click
+        exam_axes = (0, 2) if self.model_name == 'PBM' else (0,)
+
+        self.attr = np.full(shape[0], 0.5)
+        self.exam = np.full((L, 1 if self.model_name == 'PBM' else L + 1), 0.5)
+        for _ in xrange(self.iterations):
+            attr = self.attr[:, np.newaxis, np.newaxis]
+            exam = self.exam[np.newaxis]
+            p_no_click = 1 - attr * exam
+            attr_posterior = click + no_click * attr * (1 - exam) / p_no_click
+            exam_posterior = click + no_click * exam * (1 - attr) / p_no_click
+            self.attr = (1 + attr_posterior.sum(axis=(1, 2))) / (2 + total.sum(axis=(1, 2)))
+            self.exam = (1 + exam_posterior.sum(axis=exam_axes)) / (2 + total.sum(axis=exam_axes))
+            if self.model_name == 'PBM':
+                self.exam = self.exam[:, np.newaxis]
+        return self
+
+    def get_conditional_click_probs(self, docs, clicks, mask):
+        """ Probabilities of the observed clicks / skips given the clicks above. """
+        L = docs.shape[1]
+        attr, exam = self._params(docs, np.broadcast_to(np.arange(L), docs.shape),
+                                  self.prev_click_ranks(clicks))
+        p_click = attr * exam
+        return np.where(mask, np.where(clicks, p_click, 1 - p_click), 1)
+
+    def get_full_click_probs(self, docs, mask):
+        """ Click probabilities not conditioned on the clicks. """
+        N, L = docs.shape
+        ranks = np.arange(L)
+        all_prev = np.broadcast_to(np.arange(L + 1), (N, L, L + 1))
+        attr, exam = self._params(docs[..., np.newaxis], ranks[np.newaxis, :, np.newaxis], all_prev)
+        return np.where(mask, ubm_full_click_probs(attr * exam), 0)
+
+    def export_params(self):
+        """ The parameters as a dict of arrays that can be pickled and
+            loaded with from_params() (e.g., by trec_eval.py).
+        """
+        return {'model_name': self.model_name, 'attr': self.attr.copy(), 'exam': self.exam.copy()}
+
+    @classmethod
+    def from_params(cls, params):
+        model = cls(params['model_name'])
+        model.attr = np.array(params['attr'], dtype=float)
+        model.exam = np.array(params['exam'], dtype=float)
+        return model
+
+
+class ClickModel(UserModel):
+    """ PBM or UBM with the most common relevance label as the document id.
+
+        The models are trained with EMClickModel; models trained with pyclick
+        (e.g., loaded from a file) can be used as well.
+    """
 
-class PyClickModel(UserModel):
     def __init__(self, model_name, log_id_to_rel):
         self.model_name = model_name
         self.log_id_to_rel = log_id_to_rel
+        self.rels = RelevanceStore.wrap(log_id_to_rel)
 
     def train(self, data):
-        train_sessions = []
-        for d in data:
-            train_sessions.append(self._to_pyclick_session(d['session']))
-        pyclick_model = globals()['pyclick_%s' % self.model_name]()
-        pyclick_model.train(train_sessions)
-        return pyclick_model
-
-    def log_likelihood(self, pyclick_model, session, serp, sat, f_only=False):
+        docs, clicks, mask = self.rels.session_arrays([d['session'] for d in data])
+        return EMClickModel(self.model_name).train(docs, clicks, mask)
+
+    def _click_probs(self, model, session, conditional):
+        if not isinstance(model, EMClickModel):
+            pyclick_session = self._to_pyclick_session(session)
+            if conditional:
+                return np.array(model.get_conditional_click_probs(pyclick_session))
+            return np.array(model.get_full_click_probs(pyclick_session))
+        docs, clicks, mask = self.rels.session_arrays([session])
+        if conditional:
+            return model.get_conditional_click_probs(docs, clicks, mask)[0]
+        return model.get_full_click_probs(docs, mask)[0]
+
+    def log_likelihood(self, model, session, serp, sat, f_only=False):
         assert f_only
-        click_probs = pyclick_model.get_conditional_click_probs(
-                self._to_pyclick_session(session))
-        ll_click = sum(math.log(prob) for prob in click_probs)
+        click_probs = self._click_probs(model, session, conditional=True)
+        ll_click = np.log(click_probs).sum()
 
-        rel_vector = np.array([
-                rel_most_common(self.log_id_to_rel[log_item.log_id].Rs) \
-                    for log_item in session
-        ])
+        rel_vector = self.rels.session_labels(session)
         p_sat = sigma(rel_vector.dot(click_probs))
         ll_sat = math.log(p_sat if sat else (1 - p_sat))
         ll_full = ll_click + ll_sat
@@ -258,27 +596,47 @@ class PyClickModel(UserModel):
                              clicks=ll_click,
                              sat=ll_sat)
 
-    def utility(self, pyclick_model, session, serp):
-        rel_vector = np.array([
-                rel_most_common(self.log_id_to_rel[log_item.log_id].Rs) \
-                    for log_item in session
-        ])
-        click_probs = np.array(pyclick_model.get_full_click_probs(
-                self._to_pyclick_session(session)))
-        return rel_vector.dot(click_probs)
+    def utility(self, model, session, serp):
+        rel_vector = self.rels.session_labels(session)
+        return rel_vector.dot(self._click_probs(model, session, conditional=False))
+
+    def log_likelihood_batch(self, model, data):
+        if not isinstance(model, EMClickModel):
+            return super(ClickModel, self).log_likelihood_batch(model, data)
+        docs, clicks, mask = self.rels.session_arrays([d['session'] for d in data])
+        click_probs = model.get_conditional_click_probs(docs, clicks, mask)
+        ll_click = np.log(click_probs).sum(axis=1)
+        sat_score = (docs * click_probs).sum(axis=1)
+        ll_sat = log_sigma(np.where([d['sat'] for d in data], sat_score, -sat_score))
+        return LogLikelihood(full=ll_click + ll_sat,
+                             gaussian=np.full(len(data), np.nan),
+                             clicks=ll_click,
+                             sat=ll_sat)
+
+    def utility_batch(self, model, data):
+        if not isinstance(model, EMClickModel):
+            return super(ClickModel, self).utility_batch(model, data)
+        docs, clicks, mask = self.rels.session_arrays([d['session'] for d in data])
+        return (docs * model.get_full_click_probs(docs, mask)).sum(axis=1)
 
     def _to_pyclick_session(self, session):
+        from pyclick.search_session.SearchResult import SearchResult as pyclick_SearchResult
+        from pyclick.search_session.SearchSession import SearchSession as pyclick_SearchSession
         pyclick_session = pyclick_SearchSession('dummy_query')
-        for log_item in session:
-            doc_id = rel_most_common(self.log_id_to_rel[log_item.log_id].Rs)
+        for log_item, doc_id in zip(session, self.rels.session_labels(session).tolist()):
             pyclick_session.web_results.append(
                 pyclick_SearchResult(doc_id, log_item.click))
         return pyclick_session
 
 
+# The old name of ClickModel, when the models were trained with pyclick.
+PyClickModel = ClickModel
+
+
 class DCG(UserModel):
     def __init__(self, log_id_to_rel):
         self.log_id_to_rel = log_id_to_rel
+        self.rels = RelevanceStore.wrap(log_id_to_rel)
 
     def train(self, data):
         pass
@@ -311,67 +669,35 @@ class DCG(UserModel):
         return d
 
     def utility(self, _, session, serp):
-        rel_vector = np.array([
-            2 ** rel_most_common(self.log_id_to_rel[log_item.log_id].Rs) - 1\
-                for log_item in session
-        ])
+        rel_vector = 2 ** self.rels.session_labels(session) - 1
         N = len(session)
         discount = self._discount(N)
         return rel_vector.dot(discount)
 
-################################################################################
-# Params used in uUBM metric in
-# Chuklin, A., Serdyukov, P., & de Rijke, M. (2013).
-# Click model-based information retrieval metrics. In SIGIR (pp. 493--502).
-# http://doi.org/10.1145/2484028.2484071
-UBM_GAMMAS = """
-0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  1.0000
-0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.6980  0.0029
-0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.6483  0.0023  0.0106
-0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.5461  0.0032  0.0082  0.0263
-0.0000  0.0000  0.0000  0.0000  0.0000  0.5747  0.0042  0.0101  0.0215  0.0305
-0.0000  0.0000  0.0000  0.0000  0.4816  0.0067  0.0179  0.0280  0.0303  0.0599
-0.0000  0.0000  0.0000  0.5670  0.0099  0.0248  0.0476  0.0434  0.0620  0.0917
-0.0000  0.0000  0.5410  0.0187  0.0426  0.0716  0.0713  0.0826  0.0813  0.1518
-0.0000  0.8951  0.0331  0.0794  0.1242  0.1210  0.1449  0.1268  0.1559  0.1901
-0.9921  0.1199  0.2395  0.3230  0.3004  0.3107  0.3018  0.3212  0.3221  0.4149
-"""
-
-gammas = [[0.0 for j in xrange(10)] for k in xrange(10)]
-
-m = 0
-for line in UBM_GAMMAS.split('\n'):
-    line = line.strip()
-    if not line:
-        continue
-    n = 0
-    for item in line.split():
-        if not item:
-            continue
-        if n + m >= 9:
-            gammas[n][n + m - 9] = float(item)
-        n += 1
-    m += 1
-
-
-UBM_GAMMAS = gammas
-del gammas
-
-
-UBM_RELS = """
-IRRELEVANT      0.491912
-RELEVANT        0.570803
-USEFUL  0.695883
-VITAL   0.931482
-"""
+    def log_likelihood_batch(self, unused, data):
+        labels, clicks, mask = self.rels.session_arrays([d['session'] for d in data])
+        discount = self._discount(labels.shape[1])
+        with np.errstate(divide='ignore'):
+            ll_click = np.where(mask, np.where(clicks, np.log(discount), np.log(1 - discount)), 0).sum(axis=1)
+        utility = self._utility(labels, mask)
+        ll_sat = log_sigma(np.where([d['sat'] for d in data], utility, -utility))
+        return LogLikelihood(full=ll_click + ll_sat,
+                             gaussian=np.full(len(data), np.nan),
+                             clicks=ll_click,
+                             sat=ll_sat)
 
+    def utility_batch(self, _, data):
+        labels, clicks, mask = self.rels.session_arrays([d['session'] for d in data])
+        return self._utility(labels, mask)
 
-UBM_RELS = [float(x.split()[-1]) for x in UBM_RELS.split('\n') if x]
+    def _utility(self, labels, mask):
+        return ((2 ** labels - 1) * mask).dot(self._discount(labels.shape[1]))
 
 
 class uUBM(UserModel):
     def __init__(self, log_id_to_rel):
         self.log_id_to_rel = log_id_to_rel
+        self.rels = RelevanceStore.wrap(log_id_to_rel)
 
     def train(self, data):
         pass
@@ -379,8 +705,9 @@ class uUBM(UserModel):
     def log_likelihood(self, unused, session, serp, sat, f_only=False):
         ll_click = 0
         prev_click_rank = -1
+        labels = self.rels.session_labels(session[:10])
         for rank, log_item in enumerate(session[:10]):
-            a = UBM_RELS[rel_most_common(self.log_id_to_rel[log_item.log_id].Rs)]
+            a = UBM_RELS[labels[rank]]
             p_click = a * UBM_GAMMAS[rank][prev_click_rank + 1]
             if log_item.click:
                 prev_click_rank = rank
@@ -394,15 +721,21 @@ class uUBM(UserModel):
                              sat=float('NaN'))
 
     def utility(self, _, session, serp):
-        p = [1.0]
-        utility = 0.0
-        alpha = [UBM_RELS[rel_most_common(self.log_id_to_rel[l.log_id].Rs)] for l in session[:10]]
-        for rank, l in enumerate(session[:10]):
-            p.append(alpha[rank] * sum(
-                    p[j] * UBM_GAMMAS[rank][j] *
-                        prod((1 - alpha[k] * UBM_GAMMAS[k][j]) for k in xrange(j, rank)) for j in xrange(rank + 1)))
-            utility += p[-1] * rel_most_common(self.log_id_to_rel[l.log_id].Rs)
-        return utility
+        labels = self.rels.session_labels(session[:10])
+        return labels.dot(uubm_click_probs(np.array(UBM_RELS)[labels][np.newaxis])[0])
+
+    def log_likelihood_batch(self, unused, data):
+        labels, clicks, mask = self.rels.session_arrays([d['session'] for d in data], max_len=10)
+        prev = EMClickModel.prev_click_ranks(clicks)
+        p_click = np.take_along_axis(uubm_exam_click_probs(np.array(UBM_RELS)[labels]),
+                                     prev[..., np.newaxis], axis=2)[..., 0]
+        ll_click = np.where(mask, np.log(np.where(clicks, p_click, 1 - p_click)), 0).sum(axis=1)
+        nan = np.full(len(data), np.nan)
+        return LogLikelihood(full=nan, gaussian=nan, clicks=ll_click, sat=nan)
+
+    def utility_batch(self, _, data):
+        labels, clicks, mask = self.rels.session_arrays([d['session'] for d in data], max_len=10)
+        return (labels * mask * uubm_click_probs(np.array(UBM_RELS)[labels])).sum(axis=1)
 
 ################################################################################
 
@@ -417,6 +750,7 @@ class CAS(UserModel):
     def __init__(self, log_id_to_rel, reg_coeff=1, sat_term_weight=1, use_D=True,
                  use_class=True, use_geometry=True, trec_style=False):
         self.log_id_to_rel = log_id_to_rel
+        self.rels = RelevanceStore.wrap(log_id_to_rel)
         self.reg_coeff = reg_coeff
         self.sat_term_weight = sat_term_weight
         self.use_D = use_D
@@ -509,24 +843,39 @@ class CAS(UserModel):
         return np.concatenate([theta_e, theta_a, [tau_0], tau_d, tau_r])
 
     def _exam_features(self, rank, snippet, second_column):
+        item_type = geometry = None
+        if not self.trec_style:
+            if self.use_class:
+                item_type = [int(snippet.cas_item_type[2:])]
+            if self.use_geometry:
+                geometry = [parse_geometry(snippet.emup)]
+        return self._exam_feature_matrix([rank], [bool(second_column)], item_type, geometry)[0]
+
+    def _exam_feature_matrix(self, rank, second_column, item_type, geometry):
+        """ Exam features of several items given the arrays of their ranks,
+            second column flags, item types (the numbers from cas_item_type)
+            and geometry (the parse_geometry() of emup). The item types and
+            geometry are only used if the corresponding features are on.
+        """
         # TODO: think about smarter feature regularization or normalization.
-        features = np.zeros(self.num_features_epsilon)
-        features[0] = 1  # intercept feature
-        features[1] = (1 + rank) / 10
+        rank = np.asarray(rank)
+        features = np.zeros((len(rank), self.num_features_epsilon))
+        features[:, 0] = 1  # intercept feature
+        features[:, 1] = (1 + rank) / 10
 
         if not self.trec_style:
             if self.use_class:
-                item_type = int(snippet.cas_item_type[2:])
-                assert item_type >= 0 and item_type < NUM_ITEM_TYPES
-                features[2 + item_type] = 1
+                item_type = np.asarray(item_type)
+                assert ((item_type >= 0) & (item_type < NUM_ITEM_TYPES)).all()
+                features[np.arange(len(rank)), 2 + item_type] = 1
             if self.use_geometry:
                 geom_features_start_index = 2 + NUM_ITEM_TYPES
-                _, _, offset_top, width, height = [int(d) for d in snippet.emup.split(';')]
-                features[geom_features_start_index] = 1 if second_column else 0
-                features[geom_features_start_index + 1] = offset_top / MAX_OFFSET_TOP
-                features[geom_features_start_index + 2] = (width - MIN_WIDTH) / (MAX_WIDTH - MIN_WIDTH)
-                features[geom_features_start_index + 3] = (height - MIN_HEIGHT) / (MAX_HEIGHT - MIN_HEIGHT)
-                features[geom_features_start_index + 4] = (
+                offset_top, width, height = np.asarray(geometry, dtype=float).T
+                features[:, geom_features_start_index] = second_column
+                features[:, geom_features_start_index + 1] = offset_top / MAX_OFFSET_TOP
+                features[:, geom_features_start_index + 2] = (width - MIN_WIDTH) / (MAX_WIDTH - MIN_WIDTH)
+                features[:, geom_features_start_index + 3] = (height - MIN_HEIGHT) / (MAX_HEIGHT - MIN_HEIGHT)
+                features[:, geom_features_start_index + 4] = (
                         (width * height - MIN_WIDTH * MIN_HEIGHT) / (MAX_WIDTH * MAX_HEIGHT - MIN_WIDTH * MIN_HEIGHT)
                 )
                 assert geom_features_start_index + 4 == self.num_features_epsilon - 1
@@ -556,6 +905,12 @@ class CAS(UserModel):
         # Start with 1 to account for intercept.
         return np.concatenate([[1], rel_dist(rels, 'R', trec_style)])
 
+    def _rel_features(self, item):
+        """ Attractiveness features, D and R features of the item with the given id. """
+        tau_f_D = self.rels.dist(item, 'D', self.trec_style) if self.use_D else np.zeros(RelContainer.grades_D)
+        tau_f_R = self.rels.dist(item, 'R', self.trec_style)
+        return np.concatenate([[1], tau_f_R]), tau_f_D, tau_f_R
+
     def _exam(self, params, features):
         return sigma(self.weight_epsilon(params).dot(features))
 
@@ -563,37 +918,46 @@ class CAS(UserModel):
     def _attr(cls, params, features):
         return sigma(cls.weight_alpha(params).dot(features))
 
-    def utility(self, params, session, serp):
+    def utility(self, params, session, serp=None):
+        """ Utility of a single session or, if session is a CASDataset,
+            an array of utilities of all its sessions.
+        """
+        if isinstance(session, CASDataset):
+            return self._dataset_utility(params, session)
         tau_D = self.tau_D(params)
         tau_R = self.tau_R(params)
         exam_features = self._exam_features_serp(session, serp)
+        items = self.rels.indices([l.log_id for l in session])
 
         utility = 0
         for i, log_item in enumerate(session):
             epsilon_f = exam_features[i]
             epsilon = self._exam(params, epsilon_f)
 
-            rels = self.log_id_to_rel[log_item.log_id]
-            alpha_f = self._attr_features(rels.Rs, self.trec_style)
+            alpha_f, tau_f_D, tau_f_R = self._rel_features(items[i])
             alpha = self._attr(params, alpha_f)
             if self.sat_term_weight == 0:
-                utility += epsilon * ((rel_most_common(rels.Ds) if self.use_D else 0) +
-                                      alpha * rel_most_common(rels.Rs))
+                utility += epsilon * ((self.rels.most_common(items[i], 'D') if self.use_D else 0) +
+                                      alpha * self.rels.most_common(items[i], 'R'))
             else:
-                tau_f_D = rel_dist(rels.Ds, 'D', self.trec_style) if self.use_D else np.zeros(RelContainer.grades_D)
-                tau_f_R = rel_dist(rels.Rs, 'R', self.trec_style)
                 utility += epsilon * (tau_D.dot(tau_f_D) + alpha * tau_R.dot(tau_f_R))
         return utility
 
 
-    def log_likelihood(self, params, session, serp, sat, f_only=False):
+    def log_likelihood(self, params, session, serp=None, sat=None, f_only=False):
         """ Compute log-likelihood of a single session and gradient thereof
             (unless f_only == True).
+
+            If session is a CASDataset, compute per-session arrays of log-likelihood
+            values and the gradient of their sum (see _dataset_log_likelihood).
         """
+        if isinstance(session, CASDataset):
+            return self._dataset_log_likelihood(params, session)
         tau_0 = self.tau_0(params)
         tau_D = self.tau_D(params)
         tau_R = self.tau_R(params)
         exam_features = self._exam_features_serp(session, serp)
+        items = self.rels.indices([l.log_id for l in session])
 
         ll = 0
         click_ll = 0
@@ -607,13 +971,9 @@ class CAS(UserModel):
             epsilon_f = exam_features[i]
             epsilon = self._exam(params, epsilon_f)
 
-            rels = self.log_id_to_rel[log_item.log_id]
-            alpha_f = self._attr_features(rels.Rs, self.trec_style)
+            alpha_f, tau_f_D, tau_f_R = self._rel_features(items[i])
             alpha = self._attr(params, alpha_f)
 
-            tau_f_D = rel_dist(rels.Ds, 'D', self.trec_style) if self.use_D else np.zeros(RelContainer.grades_D)
-            tau_f_R = rel_dist(rels.Rs, 'R', self.trec_style)
-
             if log_item.fixation:
                 ll += math.log(epsilon)
                 utility += tau_D.dot(tau_f_D)
@@ -665,9 +1025,7 @@ class CAS(UserModel):
             epsilon_f = exam_features[i]
             epsilon = self._exam(params, epsilon_f)
 
-            rels = self.log_id_to_rel[log_item.log_id]
-            tau_f_D = rel_dist(rels.Ds, 'D', self.trec_style) if self.use_D else np.zeros(RelContainer.grades_D)
-            tau_f_R = rel_dist(rels.Rs, 'R', self.trec_style)
+            _, tau_f_D, tau_f_R = self._rel_features(items[i])
 
             if not log_item.fixation:
                 f_epsilon_ll_prime += (
@@ -690,35 +1048,269 @@ class CAS(UserModel):
                              clicks=click_ll,
                              sat=sat_ll)
 
-    def train(self, data):
-        reg_weight = self.regularization_weight()
+    def dataset(self, data):
+        """ Precompute the features of data (a list of dicts) for this model. """
+        return CASDataset(data, self.rels, self.trec_style)
+
+    def log_likelihood_batch(self, params, data):
+        """ data can be a list of dicts or a CASDataset. """
+        dataset = data if isinstance(data, CASDataset) else self.dataset(data)
+        ll = self._dataset_log_likelihood(params, dataset)
+        return ll._replace(gaussian=np.full(len(dataset), np.nan))
+
+    def utility_batch(self, params, data):
+        """ data can be a list of dicts or a CASDataset. """
+        dataset = data if isinstance(data, CASDataset) else self.dataset(data)
+        return self._dataset_utility(params, dataset)
+
+    def _exam_feature_mask(self):
+        """ Mask of the exam features used by this model. """
+        mask = np.ones(self.num_features_epsilon)
+        if not self.use_class:
+            mask[2:(2 + NUM_ITEM_TYPES)] = 0
+        if not self.use_geometry:
+            mask[(2 + NUM_ITEM_TYPES):] = 0
+        return mask
+
+    def _check_dataset(self, dataset):
+        assert dataset.trec_style == self.trec_style, \
+                'The dataset was built with trec_style=%s' % dataset.trec_style
+
+    def _dataset_utility(self, params, dataset):
+        """ Vectorized version of utility() for a CASDataset. """
+        self._check_dataset(dataset)
+        x_epsilon = dataset.exam_features.dot(self.weight_epsilon(params) * self._exam_feature_mask())
+        epsilon = np.exp(log_sigma(x_epsilon))
+        alpha = np.exp(log_sigma(dataset.attr_features.dot(self.weight_alpha(params))))
+        if self.sat_term_weight == 0:
+            u_D = dataset.rel_D if self.use_D else 0
+            u_R = dataset.rel_R
+        else:
+            u_D = dataset.tau_f_D.dot(self.tau_D(params)) if self.use_D else 0
+            u_R = dataset.tau_f_R.dot(self.tau_R(params))
+        return np.where(dataset.mask, epsilon * (u_D + alpha * u_R), 0).sum(axis=1)
+
+    def _dataset_log_likelihood(self, params, dataset):
+        """ Vectorized version of log_likelihood() for a CASDataset.
+
+            Returns per-session arrays of log-likelihood values (full, clicks, sat)
+            and the gradient of the total log-likelihood (gaussian),
+            where every session is counted dataset.weight times.
+        """
+        self._check_dataset(dataset)
+        exam_mask = self._exam_feature_mask()
+        mask = dataset.mask
+        fixation = dataset.fixation & mask
+        click = dataset.click & mask
+        no_fixation = ~dataset.fixation & mask
+        no_click = ~dataset.click & mask
+        examined = fixation | click
+        hidden = no_fixation & no_click  # We don't know if there was an examination.
+
+        x_epsilon = dataset.exam_features.dot(self.weight_epsilon(params) * exam_mask)
+        x_alpha = dataset.attr_features.dot(self.weight_alpha(params))
+        log_epsilon = log_sigma(x_epsilon)
+        log_alpha = log_sigma(x_alpha)
+        epsilon = np.exp(log_epsilon)
+        alpha = np.exp(log_alpha)
+        log_1_alpha = log_sigma(-x_alpha)
+        log_1_epsilon_alpha = np.log1p(-epsilon * alpha)
+        u_D = dataset.tau_f_D.dot(self.tau_D(params)) * self.use_D
+        u_R = dataset.tau_f_R.dot(self.tau_R(params))
+
+        click_ll = np.where(click, log_epsilon + log_alpha,
+                            np.where(mask, log_1_epsilon_alpha, 0)).sum(axis=1)
+        ll = (np.where(examined, log_epsilon, 0) +
+              np.where(click, log_alpha, 0) +
+              np.where(fixation & no_click, log_1_alpha, 0) +
+              np.where(hidden, log_1_epsilon_alpha, 0)).sum(axis=1)
+        utility = (np.where(fixation, u_D, 0) +
+                   np.where(no_fixation, epsilon * u_D, 0) +
+                   np.where(click, u_R, 0)).sum(axis=1)
+
+        # Finally, the satisfaction term in the likelihood.
+        x_sat = self.tau_0(params) + utility
+        sat_ll = np.where(dataset.sat, log_sigma(x_sat), log_sigma(-x_sat))
+        ll += self.sat_term_weight * sat_ll
 
-        def f(theta):
-            ll = 0
-            for d in data:
-                session = d['session']
-                if DEBUG:
-                    assert len(session) > 5
-                    assert len(session) < 15
-                ll += self.log_likelihood(theta, session, d['serp'], d['sat'], f_only=True).full
-            N = len(data)
+        # Coefficients in front of the features in the gradient
+        # (sessions are weighted according to their multiplicity).
+        d_sat_term_d_U = self.sat_term_weight * (dataset.sat - np.exp(log_sigma(x_sat)))
+        hidden_ratio = epsilon * alpha / (epsilon * alpha - 1)
+        c_epsilon = (np.where(examined, 1 - epsilon, 0) +
+                     np.where(hidden, (1 - epsilon) * hidden_ratio, 0) +
+                     np.where(no_fixation,
+                              d_sat_term_d_U[:, np.newaxis] * u_D * epsilon * (1 - epsilon), 0))
+        c_alpha = (np.where(click, 1 - alpha, 0) +
+                   np.where(fixation & no_click, -alpha, 0) +
+                   np.where(hidden, (1 - alpha) * hidden_ratio, 0))
+        c_tau_D = np.where(no_fixation, d_sat_term_d_U[:, np.newaxis] * epsilon, 0)
+        c_tau_R = np.where(click, d_sat_term_d_U[:, np.newaxis], 0)
+        weight = dataset.weight[:, np.newaxis]
+        c_epsilon *= weight
+        c_alpha *= weight
+        c_tau_D *= weight
+        c_tau_R *= weight
+
+        gaussian = np.concatenate([
+            np.einsum('nl,nlf->f', c_epsilon, dataset.exam_features) * exam_mask,
+            np.einsum('nl,nlf->f', c_alpha, dataset.attr_features),
+            [dataset.weight.dot(d_sat_term_d_U)],
+            np.einsum('nl,nlf->f', c_tau_D, dataset.tau_f_D) * self.use_D,
+            np.einsum('nl,nlf->f', c_tau_R, dataset.tau_f_R),
+        ])
+        return LogLikelihood(full=ll,
+                             gaussian=gaussian,
+                             clicks=click_ll,
+                             sat=sat_ll)
+
+    def _total_log_likelihood(self, params, dataset):
+        """ Sum of the log-likelihood over the dataset and the gradient thereof. """
+        ll = self._dataset_log_likelihood(params, dataset)
+        return dataset.weight.dot(ll.full), ll.gaussian
+
+    def _starting_params(self, theta0):
+        """ Params to start the optimization from: initial_guess() unless theta0
+            is given as a params vector or a name of a file with pickled params.
+        """
+        if theta0 is None:
+            return self.initial_guess()
+        if isinstance(theta0, basestring):
+            with open(theta0) as f:
+                theta0 = pickle.load(f)
+        theta0 = np.array(theta0, dtype=float)
+        assert theta0.shape == (self.num_features,), theta0.shape
+        return theta0
+
+    def train(self, data, n_jobs=1, theta0=None, maxiter=100):
+        """ Return optimal model params. data is either a list of dicts or a CASDataset.
+
+            The optimization starts from theta0 (see _starting_params()), e.g., the
+            params of a previous fit on similar data, in which case it usually
+            needs much fewer than maxiter iterations.
+
+            With n_jobs > 1 the sessions are split into shards held by n_jobs worker
+            processes that compute partial log-likelihood sums on every iteration.
+            Worker processes cannot be started from a daemonic process
+            (e.g., a run_experiment() worker), so use n_jobs=1 there.
+        """
+        reg_weight = self.regularization_weight()
+        if not isinstance(data, CASDataset):
+            if DEBUG:
+                assert all(5 < len(d['session']) < 15 for d in data)
+            data = self.dataset(data)
+        # Identical sessions only need to be evaluated once.
+        data = data.deduplicate(self._exam_feature_mask())
+        N = data.weight.sum()
+        if n_jobs > 1:
+            total_log_likelihood = _ShardedLogLikelihood(self, data, n_jobs)
+        else:
+            total_log_likelihood = lambda theta: self._total_log_likelihood(theta, data)
+
+        # theta -> (value, gradient). The values are small, so we keep all of them
+        # in case the line search goes back to a point it has already evaluated.
+        memo = {}
+
+        def objective(theta):
+            """ Regularized negative mean log-likelihood and its gradient. """
+            key = theta.tostring()
+            if key in memo:
+                return memo[key]
+            ll_full, ll_prime = total_log_likelihood(theta)
             reg_term = 0.5 * self.reg_coeff / N * np.multiply(reg_weight, theta).dot(theta)
             if DEBUG:
                 self.debug_theta(theta)
-                print 'mean LL = %f, reg_term = %f, N = %d' % (ll/N, reg_term, N)
-            return -ll / N + reg_term
-
-        def fprime(theta):
-            ll_prime = np.zeros(self.num_features)
-            for d in data:
-                ll_prime += self.log_likelihood(theta, d['session'], d['serp'], d['sat']).gaussian
-            N = len(data)
-            return -ll_prime / N + self.reg_coeff / N * np.multiply(reg_weight, theta)
-
-        theta0 = self.initial_guess()
-        opt_res = scipy.optimize.minimize(f, theta0, method='L-BFGS-B', jac=fprime, options=dict(maxiter=100))
+                print 'mean LL = %f, reg_term = %f, N = %d' % (ll_full/N, reg_term, N)
+            value = -ll_full / N + reg_term
+            gradient = -ll_prime / N + self.reg_coeff / N * np.multiply(reg_weight, theta)
+            memo[key] = (value, gradient)
+            return value, gradient
+
+        theta0 = self._starting_params(theta0)
+        try:
+            opt_res = scipy.optimize.minimize(objective, theta0, method='L-BFGS-B', jac=True,
+                                              options=dict(maxiter=maxiter))
+        finally:
+            if n_jobs > 1:
+                total_log_likelihood.close()
         return opt_res.x
 
+    def update(self, params, dataset, new_data, **kwargs):
+        """ Refit the model after new sessions arrived.
+
+            Only the features of new_data are computed; they are appended to dataset
+            (a CASDataset of the sessions used for the previous fit) and the optimization
+            starts from the previous params. kwargs are passed to train().
+            Returns the new params and the extended dataset.
+        """
+        if not isinstance(new_data, CASDataset):
+            new_data = self.dataset(new_data)
+        dataset = CASDataset.concatenate([dataset, new_data])
+        return self.train(dataset, theta0=params, **kwargs), dataset
+
+    def train_stochastic(self, read_chunks, n_epochs=10, batch_size=100, learning_rate=0.01,
+                         held_out=None, num_sessions=None, random_state=None, theta0=None,
+                         verbose=False):
+        """ Return model params optimized with mini-batch Adam.
+
+            Unlike train(), only one chunk of the data is kept in memory at a time.
+                read_chunks -- function returning an iterable over the chunks of the data
+                    (lists of dicts or CASDataset's) for every epoch, e.g.,
+                    lambda: read_session_chunks('serps_anonymized.csv', 10000)
+                held_out -- optional data to report the log-likelihood on after every epoch
+                verbose -- print the progress to stderr after every epoch
+                num_sessions -- total number of sessions used to weigh the regularization
+                    term as in train(); if unknown, it is counted during the first epoch.
+                theta0 -- params to start from (see _starting_params()).
+            The sessions are shuffled within the chunks, and the params are projected
+            onto bounds() after every step.
+        """
+        reg_weight = self.regularization_weight()
+        lower_bounds = np.array([-np.inf if l is None else l for l, _ in self.bounds()])
+        upper_bounds = np.array([np.inf if u is None else u for _, u in self.bounds()])
+        if held_out is not None and not isinstance(held_out, CASDataset):
+            held_out = self.dataset(held_out)
+        random = np.random.RandomState(random_state)
+        beta_1, beta_2, adam_epsilon = 0.9, 0.999, 1e-8
+
+        theta = self._starting_params(theta0)
+        m = np.zeros(self.num_features)
+        v = np.zeros(self.num_features)
+        step = 0
+        for epoch in xrange(n_epochs):
+            N_seen = 0
+            ll_sum = 0
+            for chunk in read_chunks():
+                if not isinstance(chunk, CASDataset):
+                    chunk = self.dataset(chunk)
+                order = random.permutation(len(chunk))
+                for begin in xrange(0, len(chunk), batch_size):
+                    batch = chunk[order[begin:(begin + batch_size)]]
+                    ll_full, ll_prime = self._total_log_likelihood(theta, batch)
+                    batch_size_weighted = batch.weight.sum()
+                    N_seen += batch_size_weighted
+                    ll_sum += ll_full
+                    N = num_sessions if num_sessions is not None else N_seen
+                    gradient = -ll_prime / batch_size_weighted + self.reg_coeff / N * np.multiply(reg_weight, theta)
+                    step += 1
+                    m = beta_1 * m + (1 - beta_1) * gradient
+                    v = beta_2 * v + (1 - beta_2) * gradient ** 2
+                    m_hat = m / (1 - beta_1 ** step)
+                    v_hat = v / (1 - beta_2 ** step)
+                    theta = np.clip(theta - learning_rate * m_hat / (np.sqrt(v_hat) + adam_epsilon),
+                                    lower_bounds, upper_bounds)
+            if num_sessions is None:
+                num_sessions = N_seen
+            if verbose:
+                progress = 'Epoch %d: %d sessions, mean LL = %f' % (epoch + 1, N_seen, ll_sum / N_seen)
+                if held_out is not None:
+                    progress += ', held-out mean LL = %f' % np.average(
+                            self._dataset_log_likelihood(theta, held_out).full, weights=held_out.weight)
+                print >>sys.stderr, progress
+            if DEBUG:
+                self.debug_theta(theta)
+        return theta
+
     @classmethod
     def debug_theta(cls, theta):
         print '-' * 80
@@ -740,22 +1332,401 @@ class CAS(UserModel):
         sys.stdout.flush()
 
 
+class CASDataset(object):
+    """ Sessions with all the CAS features precomputed as arrays.
+
+        None of the features depend on the model params, so the dataset is built
+        once and reused across optimizer iterations, evaluation and the CAS variants
+        that only differ in use_D, use_class, use_geometry, reg_coeff or
+        sat_term_weight (these are applied by the model as feature masks).
+
+        Sessions are padded to the same length: arrays have the shape
+        (num_sessions, max_session_len, ...) and the padded positions
+        have mask == False, all-zero exam features and the relevance
+        features of an item without labels.
+    """
+
+    fields = ['exam_features', 'attr_features', 'tau_f_D', 'tau_f_R', 'rel_D', 'rel_R',
+              'fixation', 'click', 'mask', 'sat', 'weight']
+
+    def __init__(self, data, log_id_to_rel, trec_style=False):
+        self.trec_style = trec_style
+        rels = RelevanceStore.wrap(log_id_to_rel)
+        model = CAS(rels, trec_style=trec_style)
+        N = len(data)
+        max_len = max(len(d['session']) for d in data) if N else 0
+        self.exam_features = np.zeros((N, max_len, CAS.num_features_epsilon))
+        self.fixation = np.zeros((N, max_len), dtype=bool)
+        self.click = np.zeros((N, max_len), dtype=bool)
+        self.mask = np.zeros((N, max_len), dtype=bool)
+        self.sat = np.zeros(N, dtype=bool)
+        self.weight = np.array([d.get('weight', 1) for d in data], dtype=float)
+        items = np.zeros((N, max_len), dtype=np.int64)   # padding points to the empty item 0
+        for n, d in enumerate(data):
+            session = d['session']
+            items[n, :len(session)] = rels.indices([l.log_id for l in session])
+            exam_features = model._exam_features_serp(session, d['serp'])
+            for i, log_item in enumerate(session):
+                self.exam_features[n, i] = exam_features[i]
+                self.fixation[n, i] = log_item.fixation
+                self.click[n, i] = log_item.click
+                self.mask[n, i] = True
+            self.sat[n] = d['sat']
+        self._set_rel_features(rels, items)
+
+    def _set_rel_features(self, rels, items):
+        """ Set the relevance features given the (N x L) array of item ids. """
+        self.tau_f_D = rels.dist(items, 'D', self.trec_style)
+        self.tau_f_R = rels.dist(items, 'R', self.trec_style)
+        self.attr_features = np.concatenate([np.ones(items.shape + (1,)), self.tau_f_R], axis=2)
+        self.rel_D = rels.most_common(items, 'D')
+        self.rel_R = rels.most_common(items, 'R')
+
+    @classmethod
+    def from_columns(cls, columnar_logs, log_id_to_rel, trec_style=False):
+        """ Same as CASDataset(list(sessions_from_rows(columnar_logs.rows('serps'))), ...),
+            but computed from the columns of a ColumnarLogs without creating
+            the session dicts and LogItem objects.
+        """
+        rels = RelevanceStore.wrap(log_id_to_rel)
+        model = CAS(rels, trec_style=trec_style)
+        log_id_values, log_id_codes = columnar_logs.column_codes('serps', 'cas_log_id')
+        num_rows = len(log_id_codes)
+        if num_rows == 0:
+            return cls([], rels, trec_style)
+        row = np.arange(num_rows)
+
+        # Group the rows into sessions by the same key as sessions_from_rows().
+        _, serp_ids = np.unique(['_'.join(v.split('_')[:-1]) for v in log_id_values.tolist()],
+                                return_inverse=True)
+        sat_values, sat_codes = columnar_logs.column_codes('serps', 'sat_feedback')
+        keys = np.stack([serp_ids[log_id_codes],
+                         columnar_logs.column_codes('serps', 'cas_query_id')[1],
+                         sat_codes], axis=1)
+        starts = np.flatnonzero(np.concatenate([[True], (keys[1:] != keys[:-1]).any(axis=1)]))
+        lengths = np.diff(np.append(starts, num_rows))
+        session = np.repeat(np.arange(len(starts)), lengths)
+        position = row - starts[session]
+        sat = np.array([parse_sat(v) for v in sat_values.tolist()])[sat_codes[starts]]
+        keep = np.array([s is not None for s in sat], dtype=bool)
+
+        # The rank is reset in the second column (see CAS._exam_features_serp()), which starts
+        # at the first row of the session with a different "offset parent" than its first row.
+        emup_values, emup_codes = columnar_logs.column_codes('serps', 'emup')
+        emup_values = emup_values.tolist()
+        _, offset_parents = np.unique([e.split(';', 1)[0] for e in emup_values], return_inverse=True)
+        offset_parent = offset_parents[emup_codes]
+        other_column = offset_parent != offset_parent[starts][session]
+        second_column_start = np.minimum.reduceat(np.where(other_column, row, num_rows), starts)[session]
+        assert (offset_parent[other_column] ==
+                offset_parent[second_column_start[other_column]]).all(), 'More than two columns'
+        rank = row - np.where(row >= second_column_start, second_column_start, starts[session])
+        item_type = geometry = None
+        if not trec_style:
+            item_type_values, item_type_codes = columnar_logs.column_codes('serps', 'cas_item_type')
+            item_type = np.array([int(t[2:]) for t in item_type_values.tolist()])[item_type_codes]
+            geometry = np.array([parse_geometry(e) for e in emup_values], dtype=float)[emup_codes]
+        # The "second column" flag of CAS._exam_features_serp() is also set for the first row of
+        # every session, as new_column is the (by then non-empty) offset_parent_set there.
+        second_column = (row == second_column_start) | (position == 0)
+        exam_features = model._exam_feature_matrix(rank, second_column, item_type, geometry)
+
+        # Padded arrays of the sessions with a defined satisfaction label.
+        rows = keep[session]
+        n = (np.cumsum(keep) - 1)[session[rows]]
+        i = position[rows]
+        N = keep.sum()
+        max_len = lengths[keep].max() if N else 0
+        dataset = object.__new__(cls)
+        dataset.trec_style = trec_style
+        dataset.exam_features = np.zeros((N, max_len, CAS.num_features_epsilon))
+        dataset.exam_features[n, i] = exam_features[rows]
+        dataset.fixation = np.zeros((N, max_len), dtype=bool)
+        dataset.fixation[n, i] = columnar_logs.arrays['serps.log_item.fixation'][rows]
+        dataset.click = np.zeros((N, max_len), dtype=bool)
+        dataset.click[n, i] = columnar_logs.log_item_clicks('serps')[rows]
+        dataset.mask = np.zeros((N, max_len), dtype=bool)
+        dataset.mask[n, i] = True
+        dataset.sat = sat[keep].astype(bool)
+        dataset.weight = np.ones(N)
+        item_log_ids, item_codes = columnar_logs.column_codes('serps', 'log_item.log_id')
+        used_codes = np.unique(item_codes[rows])
+        item_ids = np.zeros(len(item_log_ids), dtype=np.int64)
+        item_ids[used_codes] = rels.indices(item_log_ids[used_codes].tolist())
+        items = np.zeros((N, max_len), dtype=np.int64)   # padding points to the empty item 0
+        items[n, i] = item_ids[item_codes[rows]]
+        dataset._set_rel_features(rels, items)
+        return dataset
+
+    def __len__(self):
+        return len(self.sat)
+
+    def __getitem__(self, index):
+        """ Select a subset of sessions (e.g., a cross-validation fold)
+            given an array of indices or a boolean mask.
+        """
+        subset = object.__new__(CASDataset)
+        subset.trec_style = self.trec_style
+        for name in self.fields:
+            setattr(subset, name, getattr(self, name)[index])
+        return subset
+
+    def deduplicate(self, exam_feature_mask=None):
+        """ Collapse identical sessions into one with the total weight of them.
+
+            Sessions are identical if they have the same features, clicks,
+            fixations and satisfaction label. If exam_feature_mask is given
+            (see CAS._exam_feature_mask()), only the exam features used by
+            the model are compared and the rest are set to zero.
+        """
+        exam_features = self.exam_features
+        if exam_feature_mask is not None:
+            exam_features = exam_features * exam_feature_mask
+        N = len(self)
+        if N == 0:
+            return self
+        signatures = np.hstack([exam_features.reshape(N, -1)] + [
+                getattr(self, name).reshape(N, -1).astype(float)
+                for name in self.fields if name not in ['exam_features', 'weight']])
+        _, index, inverse = np.unique(signatures, axis=0, return_index=True, return_inverse=True)
+        unique = self[index]
+        unique.exam_features = exam_features[index]
+        unique.weight = np.bincount(inverse, weights=self.weight)
+        return unique
+
+    @classmethod
+    def concatenate(cls, datasets):
+        """ Join the sessions of several datasets into one dataset. """
+        trec_style = datasets[0].trec_style
+        assert all(d.trec_style == trec_style for d in datasets)
+        max_len = max(d.mask.shape[1] for d in datasets)
+        result = object.__new__(cls)
+        result.trec_style = trec_style
+        for name in cls.fields:
+            arrays = []
+            for d in datasets:
+                array = getattr(d, name)
+                if array.ndim > 1:
+                    # Pad the sessions to the same length.
+                    padding = [(0, 0), (0, max_len - array.shape[1])] + [(0, 0)] * (array.ndim - 2)
+                    array = np.pad(array, padding, 'constant')
+                arrays.append(array)
+            setattr(result, name, np.concatenate(arrays))
+        return result
+
+
+
+
+def _sharded_log_likelihood_worker(model, dataset, index, conn):
+    """ Compute the log-likelihood sums of dataset[index] for every params vector
+        received from conn until None is received. The sums are sent back as
+        (True, sums); an exception is sent as (False, formatted traceback) and
+        ends the worker.
+    """
+    shard = dataset[index]
+    try:
+        while True:
+            params = conn.recv()
+            if params is None:
+                break
+            try:
+                conn.send((True, model._total_log_likelihood(params, shard)))
+            except Exception:
+                conn.send((False, traceback.format_exc()))
+                break
+    finally:
+        conn.close()
+
+
+class _ShardedLogLikelihood(object):
+    """ CAS._total_log_likelihood() computed by worker processes in parallel.
+
+        Each worker keeps its shard of the dataset between the calls (the dataset is
+        inherited by the forked workers), so only the params and the partial sums
+        are sent between the processes. A RuntimeError is raised if a worker fails
+        or dies.
+    """
+
+    # Seconds between the checks that the workers are alive while waiting for them.
+    poll_interval = 1
+
+    def __init__(self, model, dataset, n_jobs):
+        self.connections = []
+        self.workers = []
+        for index in np.array_split(np.arange(len(dataset)), n_jobs):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_sharded_log_likelihood_worker,
+                                             args=(model, dataset, index, child_conn))
+            worker.daemon = True
+            worker.start()
+            # Only the worker keeps its end open, so that recv() fails if the worker dies.
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.workers.append(worker)
+
+    def _receive(self, conn, worker):
+        while not conn.poll(self.poll_interval):
+            if not worker.is_alive():
+                break
+        try:
+            ok, result = conn.recv()
+        except (EOFError, IOError):
+            worker.join(self.poll_interval)
+            raise RuntimeError('Log-likelihood worker %d died (exit code %s)' % (
+                    worker.pid, worker.exitcode))
+        if not ok:
+            raise RuntimeError('Log-likelihood worker %d failed:\n%s' % (worker.pid, result))
+        return result
+
+    def __call__(self, params):
+        for conn in self.connections:
+            conn.send(params)
+        partial_sums = [self._receive(conn, worker)
+                        for conn, worker in zip(self.connections, self.workers)]
+        return (sum(ll for ll, _ in partial_sums),
+                sum(ll_prime for _, ll_prime in partial_sums))
+
+    def close(self):
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except IOError:
+                pass    # the worker is already gone
+            conn.close()
+        for worker in self.workers:
+            worker.join(self.poll_interval)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+
+# Read-only data shared with the workers of run_experiment(). It is set before
+# the process pool is started, so the forked workers inherit it (copy-on-write)
+# instead of receiving a pickled copy for every job.
+_EXPERIMENT = {}
+
+
+def _cas_dataset_key(model):
+    return id(model.rels), model.trec_style
+
+
+def evaluate_model(model, data, train_index, test_index, cas_datasets=None):
+    """ Train the model on data[train_index] and evaluate it on data[test_index].
+
+        cas_datasets is an optional dict with the CASDataset's of the full data
+        keyed by _cas_dataset_key() used instead of data for the CAS models.
+        Returns a dict metric_name -> value.
+    """
+    result = {}
+    cas_dataset = None
+    if isinstance(model, CAS) and cas_datasets is not None:
+        cas_dataset = cas_datasets.get(_cas_dataset_key(model))
+    if cas_dataset is not None:
+        train_data, test_data = cas_dataset[train_index], cas_dataset[test_index]
+        weight = test_data.weight
+    else:
+        train_data, test_data = data[train_index], data[test_index]
+        weight = None
+    params = model.train(train_data)
+    ll_values_test = model.log_likelihood_batch(params, test_data)
+    result['full'] = np.average(ll_values_test.full, weights=weight)
+    result['click'] = np.average(ll_values_test.clicks, weights=weight)
+    result['sat'] = np.average(ll_values_test.sat, weights=weight)
+    result['utility'] = list(model.utility_batch(params, test_data))
+    result['sat pearson'] = scipy.stats.pearsonr(
+            [int(d['sat']) for d in data[test_index]],
+            result['utility']
+    )[0]
+    return result
+
+
+def _run_experiment_job(job):
+    name, rep_index, fold_num, train_index, test_index = job
+    try:
+        result = evaluate_model(_EXPERIMENT['models'][name], _EXPERIMENT['data'],
+                                train_index, test_index, _EXPERIMENT['cas_datasets'])
+    except Exception:
+        # The traceback of the worker is lost when the exception is passed to the pool caller.
+        print >>sys.stderr, 'Failed to evaluate %s (rep=%d, fold=%d):' % (name, rep_index, fold_num)
+        traceback.print_exc()
+        raise
+    return [{'rep': rep_index, 'fold': fold_num, 'model': name, 'metric': k, 'value': v}
+            for k, v in result.iteritems()]
+
+
+def run_experiment(models, data, splitter, n_jobs=None, n_repetitions=1, cas_datasets=None):
+    """ Evaluate every model on every fold of every repetition in a process pool.
+
+        models -- dict model_name -> UserModel
+        data -- np.array of session dicts
+        splitter -- function rep_index -> iterable of (train_index, test_index),
+            e.g., lambda rep: sklearn.cross_validation.KFold(len(data), n_folds=5,
+                                                             shuffle=True, random_state=rep)
+        n_jobs -- number of worker processes (default: number of CPUs);
+            with n_jobs=1 everything runs in the current process.
+        cas_datasets -- optional dict with the already computed CASDataset's
+            of data keyed by _cas_dataset_key() (e.g., CASDataset.from_columns()).
+        Returns a pd.DataFrame with the columns rep, fold, model, metric, value.
+    """
+    data = np.asarray(data)
+    cas_datasets = dict(cas_datasets or {})
+    for model in models.itervalues():
+        if isinstance(model, CAS):
+            key = _cas_dataset_key(model)
+            if key not in cas_datasets:
+                cas_datasets[key] = model.dataset(data)
+    jobs = [(name, rep_index, fold_num, train_index, test_index)
+            for rep_index in xrange(n_repetitions)
+            for fold_num, (train_index, test_index) in enumerate(splitter(rep_index))
+            for name in models]
+    _EXPERIMENT.update(models=models, data=data, cas_datasets=cas_datasets)
+    try:
+        if n_jobs == 1:
+            results = [_run_experiment_job(job) for job in jobs]
+        else:
+            pool = multiprocessing.Pool(n_jobs)
+            try:
+                results = list(pool.imap_unordered(_run_experiment_job, jobs))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        _EXPERIMENT.clear()
+    return pd.DataFrame([r for job_results in results for r in job_results],
+                        columns=['rep', 'fold', 'model', 'metric', 'value'])
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
             description='Build a model that predicts clicks and satisfaction '
                     'given mousing')
-    parser.add_argument('--serps', help='task_with_SERPs.csv file',
-            required=True)
+    parser.add_argument('--serps', help='task_with_SERPs.csv file')
     parser.add_argument('--results_D',
-            help='CSV file with results for direct snippet relevance',
-            required=True)
+            help='CSV file with results for direct snippet relevance')
     parser.add_argument('--results_R',
-            help='CSV file with results for the full doc relevance',
-            required=True)
+            help='CSV file with results for the full doc relevance')
+    parser.add_argument('--columnar',
+            help='Directory written by columnar_logs.py; used instead of '
+                    '--serps, --results_D and --results_R')
     parser.add_argument('--spammers',
             help='File with ids of malicious workers (one per line)')
+    parser.add_argument('--n_jobs',
+            help='Number of worker processes (default: number of CPUs)',
+            type=int)
     args = parser.parse_args()
 
+    if args.columnar is not None:
+        columnar_logs = ColumnarLogs(args.columnar)
+        serps_rows = columnar_logs.rows('serps')
+        results_D_rows = columnar_logs.rows('results_D')
+        results_R_rows = columnar_logs.rows('results_R')
+    elif None in [args.serps, args.results_D, args.results_R]:
+        parser.error('Either --columnar or --serps, --results_D and --results_R are required')
+    else:
+        serps_rows = read_csv_rows(args.serps)
+        results_D_rows = read_csv_rows(args.results_D)
+        results_R_rows = read_csv_rows(args.results_R)
+
     spammers = set()
     with open(args.spammers) as f:
         for worker_id in f:
@@ -766,29 +1737,27 @@ if __name__ == '__main__':
     # log_id (query-doc pair id) to relevance mapping.
     log_id_to_rel = collections.defaultdict(RelContainer)
     log_id_to_query = {}
-    with open(args.results_D) as results_D:
-        for row in csv.DictReader(results_D):
-            # TODO: vary threshold to mark someone as a spammer and see
-            #       how the end result changes
-            if row['cas_worker_id'] not in spammers:
-                trust = float(row['cf_worker_trust']) if USE_CF_TRUST else 1
-                log_id = row['cas_log_id']
-                RelContainer.add_rel(log_id_to_rel[log_id].Ds, row['D'], trust)
-                log_id_to_query[log_id] = row['cas_query_id']
-
-    with open(args.results_R) as results_R:
-        for row in csv.DictReader(results_R):
-            if row['cas_worker_id'] not in spammers:
-                trust = float(row['cf_worker_trust']) if USE_CF_TRUST else 1
-                log_id = row['cas_log_id']
-                RelContainer.add_rel(log_id_to_rel[log_id].Rs, row['R'], trust)
-                query = row['cas_query_id']
-                old_query = log_id_to_query.setdefault(log_id, query)
-                if old_query != query:
-                    print >>sys.stderr, ('The same log_id '
-                            '(%s) maps to two different queries: [%s] and [%s]' % (
-                                    log_id, old_query, query))
-                    sys.exit(1)
+    for row in results_D_rows:
+        # TODO: vary threshold to mark someone as a spammer and see
+        #       how the end result changes
+        if row['cas_worker_id'] not in spammers:
+            trust = float(row['cf_worker_trust']) if USE_CF_TRUST else 1
+            log_id = row['cas_log_id']
+            RelContainer.add_rel(log_id_to_rel[log_id].Ds, row['D'], trust)
+            log_id_to_query[log_id] = row['cas_query_id']
+
+    for row in results_R_rows:
+        if row['cas_worker_id'] not in spammers:
+            trust = float(row['cf_worker_trust']) if USE_CF_TRUST else 1
+            log_id = row['cas_log_id']
+            RelContainer.add_rel(log_id_to_rel[log_id].Rs, row['R'], trust)
+            query = row['cas_query_id']
+            old_query = log_id_to_query.setdefault(log_id, query)
+            if old_query != query:
+                print >>sys.stderr, ('The same log_id '
+                        '(%s) maps to two different queries: [%s] and [%s]' % (
+                                log_id, old_query, query))
+                sys.exit(1)
 
     print '%d items with complete relevance' % sum(
             1 for r in log_id_to_rel.itervalues() if r)
@@ -796,73 +1765,37 @@ if __name__ == '__main__':
     print '%d queries with at least one completely judged document' % len(set(
             log_id_to_query[k] for k, r in log_id_to_rel.iteritems() if r))
 
-    data = []
-    with open(args.serps) as task_file:
-        sat_labels = []
-        num_skipped = 0
-        num_sat_true = 0
-        num_total = 0
-        reader = csv.DictReader(task_file)
-        for key, query_rows_iter in itertools.groupby(reader,
-                        key=lambda row: (row['cas_log_id'].split('_')[:-1], # SERP id
-                                         row['cas_query_id'],
-                                         row['sat_feedback'])):
-            sat = key[2]
-            if DEBUG and sat == 'undefined':
-                print >>sys.stderr, 'Undefined sat label for query [%s]' % key[1]
-            sat_labels.append(sat)
-            sat = parse_sat(sat)
-            if sat is None:
-                num_skipped += 1
-                continue
-            elif sat:
-                num_sat_true += 1
-            data_row = {'query': key[1], 'sat': sat, 'session': [], 'serp': []}
-            for row in query_rows_iter:
-                data_row['session'].append(jsonpickle.decode(row['actions']))
-                data_row['serp'].append(Snippet(emup=row['emup'],
-                                                cas_item_type=row['cas_item_type'],
-                                                is_complex=row['is_complex']))
-            data.append(data_row)
-            num_total += 1
-        #print collections.Counter(sat_labels)
-        print 'Skipped %d rows out of %d' % (num_skipped, num_total + num_skipped)
-        print '%.1f%% of SAT labels in the data' % (num_sat_true / num_total * 100)
+    sat_labels = []
+    data = list(sessions_from_rows(serps_rows, sat_labels))
+    #print collections.Counter(sat_labels)
+    print 'Skipped %d rows out of %d' % (len(sat_labels) - len(data), len(sat_labels))
+    print '%.1f%% of SAT labels in the data' % (
+            sum(1 for d in data if d['sat']) / len(data) * 100)
 
     N = len(data)
     data = np.array(data)
+    rels = RelevanceStore(log_id_to_rel)
 
     MODELS = {
-        'CAS': CAS(log_id_to_rel),
-        'PBM': PyClickModel('PBM', log_id_to_rel),
-        'CASnod': CAS(log_id_to_rel, use_D=False),
-        'CASnosat': CAS(log_id_to_rel, sat_term_weight=0),
-        'CASnoreg': CAS(log_id_to_rel, reg_coeff=0),
-        'CASnoclass': CAS(log_id_to_rel, use_class=False),
-        'CASnogeom': CAS(log_id_to_rel, use_geometry=False),
-        'CASrank': CAS(log_id_to_rel, use_class=False, use_geometry=False),
+        'CAS': CAS(rels),
+        'PBM': ClickModel('PBM', rels),
+        'CASnod': CAS(rels, use_D=False),
+        'CASnosat': CAS(rels, sat_term_weight=0),
+        'CASnoreg': CAS(rels, reg_coeff=0),
+        'CASnoclass': CAS(rels, use_class=False),
+        'CASnogeom': CAS(rels, use_geometry=False),
+        'CASrank': CAS(rels, use_class=False, use_geometry=False),
         'random': RandomSatModel(),
     }
 
-    for train_index, test_index in sklearn.cross_validation.ShuffleSplit(N, n_iter=1, random_state=42):
-        train_data = data[train_index]
-        test_data = data[test_index]
-        result = {}
-        for name, model in MODELS.iteritems():
-            print >>sys.stderr, 'Starting training', name
-            params = model.train(train_data)
-            ll_values_test = [
-                    model.log_likelihood(params,
-                                         d['session'], d['serp'], d['sat'],
-                                         f_only=True
-                    ) for d in test_data
-            ]
-            result[name] = {}
-            result[name]['full'] = np.average([l.full for l in ll_values_test])
-            result[name]['click'] = np.average([l.clicks for l in ll_values_test])
-            result[name]['sat'] = np.average([l.sat for l in ll_values_test])
-            result[name]['sat pearson'] = scipy.stats.pearsonr(
-                    [int(d['sat']) for d in test_data],
-                    [model.utility(params, d['session'], d['serp']) for d in test_data]
-            )[0]
-        print result
+    cas_datasets = {}
+    if args.columnar is not None:
+        cas_datasets[_cas_dataset_key(MODELS['CAS'])] = CASDataset.from_columns(columnar_logs, rels)
+
+    results = run_experiment(
+            MODELS, data,
+            lambda rep: sklearn.cross_validation.ShuffleSplit(N, n_iter=1, random_state=42),
+            n_jobs=args.n_jobs, cas_datasets=cas_datasets)
+    scores = results[results['metric'] != 'utility']
+    print scores.assign(value=scores['value'].astype(float)).pivot_table(
+            index='model', columns='metric', values='value')
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+#
+# Convert the anonymized dataset (serps / results_D / results_R CSV files)
+# to a directory of .npy files with one array per column that are memory-mapped
+# on load instead of parsing the CSV files and decoding the jsonpickle'd actions.
+
+import argparse
+import csv
+import itertools
+import jsonpickle
+import os
+
+import numpy as np
+
+from create_tasks import Action, LogItem
+
+
+# Names of the tables in the dataset directory.
+TABLES = ['serps', 'results_D', 'results_R']
+
+
+def _intern(values):
+    """ Encode a list of strings as (unique values, integer codes).
+
+        Byte strings (the CSV columns) are stored as such. If there are unicode
+        strings (e.g., in the decoded actions), all the values are stored as
+        unicode and the byte strings are assumed to be UTF-8.
+    """
+    if any(isinstance(v, unicode) for v in values):
+        values = [v if isinstance(v, unicode) else v.decode('utf-8') for v in values]
+        dtype = unicode
+    else:
+        dtype = str
+    unique_values, codes = np.unique(np.array(values, dtype=object), return_inverse=True)
+    return np.array(list(unique_values), dtype=dtype), codes.astype(np.int32)
+
+
+def _intern_optional(values):
+    """ Same as _intern(), but None values get the code -1. """
+    unique_values, codes = _intern(['' if v is None else v for v in values])
+    codes[np.array([v is None for v in values], dtype=bool)] = -1
+    return unique_values, codes
+
+
+def _table_arrays(table, rows):
+    """ Convert the CSV rows to a dict of arrays; the actions column
+        (if present) is decoded and stored as flat action arrays.
+    """
+    arrays = {}
+    columns = rows[0].keys() if rows else []
+    for column in columns:
+        if column == 'actions':
+            continue
+        values, codes = _intern([row[column] for row in rows])
+        arrays['%s.%s.values' % (table, column)] = values
+        arrays['%s.%s.codes' % (table, column)] = codes
+    if 'actions' not in columns:
+        return arrays
+    log_items = [jsonpickle.decode(row['actions']) for row in rows]
+    actions = [a for log_item in log_items for a in log_item.actions]
+    assert all(a.rank is None or isinstance(a.rank, int) for a in actions)
+    arrays['%s.log_item.log_id.values' % table], arrays['%s.log_item.log_id.codes' % table] = \
+            _intern([l.log_id for l in log_items])
+    arrays['%s.log_item.fixation' % table] = np.array([l.fixation for l in log_items], dtype=bool)
+    arrays['%s.log_item.long_click' % table] = np.array([l.long_click for l in log_items], dtype=bool)
+    arrays['%s.log_item.action_offsets' % table] = np.cumsum(
+            [0] + [len(l.actions) for l in log_items]).astype(np.int64)
+    arrays['%s.action.type.values' % table], arrays['%s.action.type.codes' % table] = \
+            _intern([a.type for a in actions])
+    arrays['%s.action.target.values' % table], arrays['%s.action.target.codes' % table] = \
+            _intern_optional([a.target for a in actions])
+    arrays['%s.action.ts' % table] = np.array([a.ts for a in actions], dtype=np.int64)
+    arrays['%s.action.rank' % table] = np.array(
+            [-1 if a.rank is None else a.rank for a in actions], dtype=np.int32)
+    return arrays
+
+
+def convert(out_dir, **csv_file_names):
+    """ Write the CSV files (keyword arguments named as in TABLES) to out_dir. """
+    arrays = {}
+    for table, file_name in csv_file_names.iteritems():
+        assert table in TABLES, table
+        with open(file_name) as f:
+            reader = csv.DictReader(f)
+            rows = list(reader)
+        arrays['%s.columns' % table] = np.array(reader.fieldnames, dtype=str)
+        arrays.update(_table_arrays(table, rows))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(out_dir, name + '.npy'), array)
+
+
+class ColumnarLogs(object):
+    """ The dataset written by convert(). The arrays are memory-mapped. """
+
+    def __init__(self, directory):
+        self.arrays = {}
+        for file_name in os.listdir(directory):
+            if file_name.endswith('.npy'):
+                self.arrays[file_name[:-len('.npy')]] = np.load(
+                        os.path.join(directory, file_name), mmap_mode='r')
+
+    def column_codes(self, table, column):
+        """ (unique values, integer codes of the rows) of the column. """
+        return self.arrays['%s.%s.values' % (table, column)], self.arrays['%s.%s.codes' % (table, column)]
+
+    def _column(self, table, column):
+        values, codes = self.column_codes(table, column)
+        return values[codes].tolist()
+
+    def log_item_clicks(self, table):
+        """ Boolean array: whether the actions of the row have a click (see LogItem.click). """
+        types, type_codes = self.column_codes(table, 'action.type')
+        offsets = self.arrays['%s.log_item.action_offsets' % table]
+        action_rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        is_click = np.in1d(type_codes, np.flatnonzero(types == 'Click'))
+        return np.bincount(action_rows[is_click], minlength=len(offsets) - 1) > 0
+
+    def _log_items(self, table):
+        types = self._column(table, 'action.type')
+        target_values = self.arrays['%s.action.target.values' % table]
+        target_codes = self.arrays['%s.action.target.codes' % table]
+        targets = np.where(target_codes >= 0, target_values[target_codes], None).tolist()
+        ts = self.arrays['%s.action.ts' % table].tolist()
+        ranks = self.arrays['%s.action.rank' % table].tolist()
+        offsets = self.arrays['%s.log_item.action_offsets' % table].tolist()
+        log_ids = self._column(table, 'log_item.log_id')
+        fixation = self.arrays['%s.log_item.fixation' % table].tolist()
+        long_click = self.arrays['%s.log_item.long_click' % table].tolist()
+        for i, log_id in enumerate(log_ids):
+            log_item = LogItem(log_id, [
+                    Action(type=types[j], ts=ts[j], target=targets[j],
+                           rank=(None if ranks[j] < 0 else ranks[j]))
+                    for j in xrange(offsets[i], offsets[i + 1])])
+            log_item.fixation = fixation[i]
+            log_item.long_click = long_click[i]
+            yield log_item
+
+    def rows(self, table):
+        """ Rows of the table as returned by csv.DictReader, except that
+            the actions are already decoded into LogItem objects.
+        """
+        columns = self.arrays['%s.columns' % table].tolist()
+        values = [self._log_items(table) if c == 'actions' else iter(self._column(table, c))
+                  for c in columns]
+        for row_values in itertools.izip(*values):
+            yield dict(zip(columns, row_values))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Convert the anonymized dataset to a binary file '
+                    'that can be used instead of it by click_model.py')
+    parser.add_argument('--serps', help='serps_anonymized.csv file', required=True)
+    parser.add_argument('--results_D', help='results_D_anonymized.csv file', required=True)
+    parser.add_argument('--results_R', help='results_R_anonymized.csv file', required=True)
+    parser.add_argument('--out', help='Output directory', default='dataset')
+    args = parser.parse_args()
+
+    convert(args.out, serps=args.serps, results_D=args.results_D, results_R=args.results_R)
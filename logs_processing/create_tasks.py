@@ -25,17 +25,23 @@ import glob
 import itertools
 import json
 import jsonpickle
+import jsonpickle.handlers
+import multiprocessing
 import os
 import os.path
+import StringIO
 import sys
 
 import bs4
+import numpy as np
 
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname('__file__'), os.path.pardir)))
 
 from logs_management.shared.logs import parse_href
 
+import html_snippets
+
 TMP_DIR = '<YOUR_DIRECTORY_PATH_GOES_HERE>'
 DEBUG = True
 ONLY_WITH_FEEDBACK = False
@@ -48,6 +54,19 @@ ONLY_HOVERED = False
 # the previous runs.
 LOG_ID_PREFIX = 'v2_'
 
+# Number of worker processes parsing the search log lines (None for the number
+# of CPUs). The output is the same as with a single process.
+N_JOBS = 1
+
+# Snippets longer than this (in bytes) are compacted by removing their inline
+# images, the largest first; the ones that are still too long are skipped.
+MAX_SNIPPET_SIZE = 60000
+
+# If set, the removed inline images are saved to this directory and
+# referenced as INLINE_IMAGES_URL + file name instead of being lost.
+INLINE_IMAGES_DIR = None
+INLINE_IMAGES_URL = 'images/'
+
 DEBUG_HTML_HEADER = """
 <!DOCTYPE html>
 <html>
@@ -73,16 +92,19 @@ DEBUG_HTML_FOOTER = """
 </html>
 """
 
-def format_snippet_debug(query, descendant, snippet, rank):
+def format_snippet_debug(query, descendant, snippet, rank, out=sys.stderr):
     if rank is None:
         rank = -1
-    print >>sys.stderr, '<li>'
-    print >>sys.stderr, 'Non-link click for [%s]' % query
-    print >>sys.stderr, '<ul style="list-style-type:circle">'
-    print >>sys.stderr, '<li>Clicked: <div class="snippet">%s</div></li>' % descendant
-    print >>sys.stderr, '<li>Full: <ol class="snippet" start="%d">%s</div></ol>' % (rank, snippet)
-    print >>sys.stderr, '</ul>'
-    print >>sys.stderr, '</li>'
+    print >>out, '<li>'
+    # Everything is written as UTF-8 bytes: the output may be a StringIO buffer,
+    # which cannot mix unicode and non-ASCII byte strings.
+    print >>out, 'Non-link click for [%s]' % query.encode('utf-8')
+    print >>out, '<ul style="list-style-type:circle">'
+    print >>out, '<li>Clicked: <div class="snippet">%s</div></li>' % descendant.encode('utf-8')
+    print >>out, '<li>Full: <ol class="snippet" start="%d">%s</div></ol>' % (
+            rank, snippet.encode('utf-8'))
+    print >>out, '</ul>'
+    print >>out, '</li>'
 
 
 def cleanup_link(node):
@@ -91,19 +113,17 @@ def cleanup_link(node):
     node.attrs.pop('onmousedown', None)
 
 
-def remove_inline_image(snippet):
-    for descendant in snippet.descendants:
-        if type(descendant) != bs4.element.Tag:
-            continue
-        if descendant.name == 'img' and descendant.get('src', '').startswith('data:image/'):
-            del descendant['src']
-            return True
-    return False
+Action = collections.namedtuple('Action', ['type', 'ts', 'target', 'rank'])
 
+class LogItem(object):
+    """ Actions on a SERP item and the flags derived from them.
 
-Action = collections.namedtuple('Action', ['type', 'ts', 'target', 'rank'])
+        The click flag is computed when the actions are assigned, so the actions
+        list should be replaced rather than modified in place.
+    """
+
+    __slots__ = ['log_id', '_actions', 'click', 'long_click', 'fixation']
 
-class LogItem:
     def __init__(self, log_id, actions=None):
         self.log_id = log_id
         self.actions = actions if actions is not None else []
@@ -111,8 +131,24 @@ class LogItem:
         self.fixation = self.click  # click implies fixation for sure
 
     @property
-    def click(self):
-        return any(a.type == 'Click' for a in self.actions)
+    def actions(self):
+        return self._actions
+
+    @actions.setter
+    def actions(self, actions):
+        self._actions = actions
+        self.click = any(a.type == 'Click' for a in actions)
+
+    def __getstate__(self):
+        # Same state as the one of the old LogItem objects without __slots__.
+        return {'log_id': self.log_id, 'actions': self.actions,
+                'long_click': self.long_click, 'fixation': self.fixation}
+
+    def __setstate__(self, state):
+        self.log_id = state['log_id']
+        self.actions = state['actions']
+        self.long_click = state['long_click']
+        self.fixation = state['fixation']
 
     def __str__(self):
         if self.long_click:
@@ -150,63 +186,91 @@ class LogItem:
         self.actions = [a for a in self.actions if a.ts <= ts]
 
 
+class LogItemHandler(jsonpickle.handlers.BaseHandler):
+    """ jsonpickle's LogItem encoding: the state (see LogItem.__getstate__()) is
+        stored next to py/object, as it was for the old LogItem objects without
+        __slots__, so that the exported logs stay the same.
+    """
+
+    def flatten(self, log_item, data):
+        for k, v in log_item.__getstate__().iteritems():
+            data[k] = self.context.flatten(v, reset=False)
+        return data
+
+    def restore(self, data):
+        # Also accept the state under py/state, which jsonpickle writes by default.
+        state = data.get('py/state', data)
+        log_item = LogItem.__new__(LogItem)
+        log_item.__setstate__(dict((k, self.context.restore(state[k], reset=False))
+                                   for k in ['log_id', 'actions', 'long_click', 'fixation']))
+        return log_item
+
+LogItemHandler.handles(LogItem)
+
+
 class QueryLogProcessor:
-    """ A class to update some parameters of LogItem's using the context of other actions. """
+    """ A class to update some parameters of LogItem's using the context of other actions.
+
+        The actions are kept as a timeline of parallel lists (emu_ids, actions)
+        that is processed with NumPy array operations.
+    """
 
     SESSION_CUT_OFF = 30 * 60 * 1000  # 30 mins
     LONG_CLICK_THRESHOLD = 30 * 1000  # 30 seconds
     FIXATION_THRESHOLD = 200  # 200 ms
 
     def __init__(self):
+        self.emu_ids = []
         self.actions = []
         self.emu_id_to_log_item = {}
 
+    def add_action(self, emu_id, action):
+        self.emu_ids.append(emu_id)
+        self.actions.append(action)
+
     def process(self):
-        self.actions.sort(key=lambda x: x['action'].ts)
-        enter_times = {}  # log_id -> ts of entering the log item (snippet)
-        first_log_item = self.emu_id_to_log_item.get(self.actions[0]['emu_id'])
-        if first_log_item is not None:
-            enter_times[first_log_item.log_id] = self.actions[0]['action'].ts
-        end_timestamp = None
-        for i in xrange(1, len(self.actions)):
-            cur = self.actions[i]
-            prev = self.actions[i - 1]
-            # Read corresponding log items (only defined for snippets, otherwise None).
-            cur_log_item = self.emu_id_to_log_item.get(cur['emu_id'])
-            prev_log_item = self.emu_id_to_log_item.get(prev['emu_id'])
-            if cur_log_item != prev_log_item:
-                # Transition to a different SERP area.
-                if cur_log_item is not None:
-                    # This is an incoming transition into a snippet.
-                    # Record the time of (re-)entering it.
-                    enter_times[cur_log_item.log_id] = cur['action'].ts
-                if prev_log_item is not None:
-                    # This is an outgoing transition from a snippet.
-                    if cur['action'].ts - enter_times[prev_log_item.log_id] \
-                            >= self.FIXATION_THRESHOLD:
-                        # Within-snippet dwell time is big enough.
-                        prev_log_item.fixation = True
-                    # TODO: proper way of counting long clicks:
-                    #  - record the last click item
-                    #  - look for PageHide event
-                    #  - measure the time between it and the next event
-                    if prev_log_item.click and \
-                            cur['action'].ts - prev['action'].ts >= self.LONG_CLICK_THRESHOLD:
-                        prev_log_item.long_click = True
-            time_to_prev = cur['action'].ts - prev['action'].ts
-            if time_to_prev >= self.SESSION_CUT_OFF:
-                #print >>sys.stderr, 'Found a really big break between %s and %s: +%d min' % (
-                        #prev['action'], cur['action'], time_to_prev / 60000)
-                end_timestamp = prev['action'].ts
-                break
-        if end_timestamp is not None:
-            for a in self.actions:
-                log_item = self.emu_id_to_log_item.get(a['emu_id'])
-                if log_item is not None:
-                    log_item.clear_after(end_timestamp)
+        # Number the log items (only defined for snippets, otherwise -1).
+        log_items = []
+        log_item_nums = {}  # id of the log item -> its number
+        emu_id_to_num = {}
+        for emu_id, log_item in self.emu_id_to_log_item.iteritems():
+            if id(log_item) not in log_item_nums:
+                log_item_nums[id(log_item)] = len(log_items)
+                log_items.append(log_item)
+            emu_id_to_num[emu_id] = log_item_nums[id(log_item)]
+        ts = np.array([a.ts for a in self.actions], dtype=np.int64)
+        items = np.array([emu_id_to_num.get(e, -1) for e in self.emu_ids], dtype=np.int32)
+        order = np.argsort(ts, kind='mergesort')  # stable, as list.sort()
+        ts = ts[order]
+        items = items[order]
+        # The actions are processed up to (and including) the first one after
+        # a really big break.
+        breaks = np.flatnonzero(np.diff(ts) >= self.SESSION_CUT_OFF)
+        last = breaks[0] + 1 if len(breaks) > 0 else len(ts) - 1
+        # Transitions to a different SERP area and the times of entering the areas.
+        transitions = np.flatnonzero(items[1:last + 1] != items[:last]) + 1
+        enter_ts = ts[np.concatenate([[0], transitions]).astype(np.int64)[:-1]]
+        # Outgoing transitions from snippets.
+        outgoing = items[transitions - 1] >= 0
+        # Within-snippet dwell time is big enough.
+        fixated = outgoing & (ts[transitions] - enter_ts >= self.FIXATION_THRESHOLD)
+        for num in np.unique(items[transitions[fixated] - 1]):
+            log_items[num].fixation = True
+        # TODO: proper way of counting long clicks:
+        #  - record the last click item
+        #  - look for PageHide event
+        #  - measure the time between it and the next event
+        long_dwell = outgoing & (ts[transitions] - ts[transitions - 1] >= self.LONG_CLICK_THRESHOLD)
+        for num in np.unique(items[transitions[long_dwell] - 1]):
+            if log_items[num].click:
+                log_items[num].long_click = True
+        if len(breaks) > 0:
+            end_timestamp = ts[last - 1]
+            for num in np.unique(items[items >= 0]):
+                log_items[num].clear_after(end_timestamp)
         else:
-            last_log_item = self.emu_id_to_log_item.get(self.actions[-1]['emu_id'])
-            if last_log_item is not None:
+            if items[-1] >= 0:
+                last_log_item = log_items[items[-1]]
                 # The last item always assumed to be fixated for long.
                 last_log_item.fixation = True
                 if last_log_item.click:
@@ -215,11 +279,153 @@ class QueryLogProcessor:
 
         #if DEBUG and any(len(l.actions) > 0 and not l.fixation \
                 #for l in self.emu_id_to_log_item.itervalues()):
-            #for i, a in enumerate(self.actions):
-                #delta = a['action'].ts - self.actions[i - 1]['action'].ts if i > 0 else 0
-                #emu_id = a['emu_id']
+            #for i, (emu_id, a) in enumerate(zip(self.emu_ids, self.actions)):
+                #delta = a.ts - self.actions[i - 1].ts if i > 0 else 0
                 #print >>sys.stderr, self.emu_id_to_log_item.get(emu_id), emu_id, \
-                        #a['action'], '+%d ms' % delta
+                        #a, '+%d ms' % delta
+
+
+QueryResult = collections.namedtuple('QueryResult', ['rows',
+                                                     'interesting_selectors',
+                                                     'styles',
+                                                     'stderr',
+                                                     'html_files_dumped']
+)
+
+
+def process_search_log(query_num, line, test_queries, previously_judged_queries, dump_html=False):
+    """ Create the task rows (ready for csv.DictWriter) for one line of search_log.txt.
+
+        query_num is the number of the line; it is a part of the log_ids.
+        If dump_html is true, the SERP and the first snippet are written to TMP_DIR.
+        The messages are returned in the stderr buffer instead of being printed,
+        so that the lines can be processed in any order.
+    """
+    result = QueryResult(rows=[], interesting_selectors=set(), styles=set(),
+                         stderr=StringIO.StringIO(), html_files_dumped=False)
+    try:
+        search_log = json.loads(line)
+    except ValueError:
+        print >>result.stderr, 'Error reading line %d. Skipping...' % query_num
+        return result
+    sat_feedback = None
+    for a in search_log['actions']:
+        if a['event_type'] == 'SatFeedback':
+            sat_feedback = a['fields']['val']
+            if sat_feedback == 'OTH':
+                sat_feedback += ' (%s)' % a['fields'].get('reason')
+            break
+    else:
+        if ONLY_WITH_FEEDBACK:
+            return result
+        else:
+            sat_feedback = 'absent'
+    query = search_log['q']
+    if query in test_queries:
+        return result
+    if dump_html:
+        for f in glob.glob(TMP_DIR + '*.html'):
+            os.unlink(f)
+        with open(TMP_DIR + 'serp.html', 'w') as f:
+            print >>f, search_log['serp_html'].encode('utf-8')
+    if ONLY_ASCII_QUERIES and not all(ord(c) < 128 for c in query):
+        return result
+    if query in previously_judged_queries and query not in test_queries:
+        return result
+    log_processor = QueryLogProcessor()
+    emu_id_to_actions = collections.defaultdict(lambda: [])
+    for a in search_log['actions']:
+        emu_id = a['fields'].get('emu_id')
+        target = None
+        if a['event_type'] == 'MMov':
+            # This is a mouse-move event, we can safely ignore it
+            continue
+        elif a['event_type'] == 'Click':
+            target = parse_href(a['fields'].get('href'))
+        action = Action(type=a['event_type'], ts=a['ts'],
+                        target=target, rank=a['fields'].get('rank'))
+        emu_id_to_actions[emu_id].append(action)
+        log_processor.add_action(emu_id, action)
+
+    image_store = None
+    if INLINE_IMAGES_DIR is not None:
+        image_store = html_snippets.InlineImageStore(INLINE_IMAGES_DIR, INLINE_IMAGES_URL)
+    serp = html_snippets.SerpExtractor(search_log['serp_html'])
+    for style in serp.styles:
+        result.styles.add(unicode(style).encode('utf-8'))
+    result.interesting_selectors.update(serp.selectors)
+    query_rows = []
+    for snippet, emu_ids in zip(serp.snippets(), serp.snippet_emu_ids(emu_id_to_actions)):
+        log_id = LOG_ID_PREFIX + '%d_%s' % (query_num, snippet['emu_id'])
+        snippet_emu_ids = []
+        snippet_actions = []
+        link = None
+        rank = None
+        for descendant in itertools.chain([snippet], snippet.descendants):
+            if type(descendant) != bs4.element.Tag:
+                continue
+            if descendant.name == 'script':
+                descendant.clear()
+                continue
+            cleanup_link(descendant)
+        for emu_id in emu_ids:
+            snippet_emu_ids.append(emu_id)
+            actions = emu_id_to_actions[emu_id]
+            if link is None:
+                for a in actions:
+                    if a.target is not None:
+                        link = a.target
+                        rank = a.rank
+                        break
+            if any(a.type == 'Click' for a in actions) and link is None:
+                snippet_actions += [a for a in actions if not a.type == 'Click']
+                if DEBUG:
+                    descendant = snippet.find(emu_id=emu_id) if snippet['emu_id'] != emu_id else snippet
+                    format_snippet_debug(query, descendant, snippet, rank, result.stderr)
+
+            else:
+                snippet_actions += actions
+        if ONLY_HOVERED and len(snippet_actions) == 0:
+            continue
+        snippet_encoded = html_snippets.compact_snippet(snippet, MAX_SNIPPET_SIZE, image_store)
+        if len(snippet_encoded) > MAX_SNIPPET_SIZE:
+            print >>result.stderr, 'The snippet is too long: ', len(snippet_encoded)
+            # print >>sys.stderr, snippet_encoded
+        else:
+            log_item = LogItem(log_id, snippet_actions)
+            for emu_id in snippet_emu_ids:
+                log_processor.emu_id_to_log_item[emu_id] = log_item
+            query_rows.append({
+                'query': query.encode('utf-8'),
+                'snippet': snippet_encoded,
+                'link': link,
+                'log_id': log_id,
+                'emu_ids': ' '.join(snippet_emu_ids),
+                'actions': log_item,
+                'sat_feedback': sat_feedback,
+            })
+            if dump_html and not result.html_files_dumped:
+                with open(TMP_DIR + log_id + '.html', 'w') as f:
+                    print >>f, snippet.prettify().encode('utf-8')
+                result = result._replace(html_files_dumped=True)
+    # All the data for the query is read, do the processing now.
+    log_processor.process()
+    for row in query_rows:
+        result.rows.append(dict((k, (v if type(v) in [str, unicode] else jsonpickle.encode(v))) \
+                for k, v in row.iteritems()))
+    return result
+
+
+# Arguments of _process_search_log_job() set before the process pool is started,
+# so the forked workers inherit them instead of receiving a pickled copy.
+_PREVIOUS_RESULTS = {}
+
+
+def _process_search_log_job(job):
+    query_num, line = job
+    result = process_search_log(query_num, line, _PREVIOUS_RESULTS['test_queries'],
+                                _PREVIOUS_RESULTS['previously_judged_queries'])
+    return result._replace(stderr=result.stderr.getvalue())
 
 
 if __name__ == '__main__':
@@ -233,8 +439,6 @@ if __name__ == '__main__':
             fieldnames=['log_id', 'emu_ids', 'actions', 'sat_feedback', 'query', 'link', 'snippet'])
     print >>sys.stderr, '<ul style="list-style-type:decimal">'
     writer.writeheader()
-    interesting_selectors = set()
-    styles = set()
     previously_judged_queries = set()
     test_queries = set()
     if len(sys.argv) == 2:
@@ -244,123 +448,40 @@ if __name__ == '__main__':
                 previously_judged_queries.add(query)
                 if row['_golden'] == 'true':
                     test_queries.add(query)
-    html_files_dumped = False
-    for query_num, line in enumerate(sys.stdin):
-        try:
-            search_log = json.loads(line)
-        except ValueError:
-            print >>sys.stderr, 'Error reading line %d. Skipping...' % query_num
-            continue
-        sat_feedback = None
-        for a in search_log['actions']:
-            if a['event_type'] == 'SatFeedback':
-                sat_feedback = a['fields']['val']
-                if sat_feedback == 'OTH':
-                    sat_feedback += ' (%s)' % a['fields'].get('reason')
+    lines = enumerate(sys.stdin)
+    results = []
+    if DEBUG:
+        # Process the lines in this process until the HTML files are dumped.
+        for query_num, line in lines:
+            result = process_search_log(query_num, line, test_queries, previously_judged_queries,
+                                        dump_html=True)
+            results.append(result._replace(stderr=result.stderr.getvalue()))
+            if result.html_files_dumped:
                 break
-        else:
-            if ONLY_WITH_FEEDBACK:
-                continue
-            else:
-                sat_feedback = 'absent'
-        query = search_log['q']
-        if query in test_queries:
-            continue
-        if DEBUG and not html_files_dumped:
-            for f in glob.glob(TMP_DIR + '*.html'):
-                os.unlink(f)
-            with open(TMP_DIR + 'serp.html', 'w') as f:
-                print >>f, search_log['serp_html'].encode('utf-8')
-        if ONLY_ASCII_QUERIES and not all(ord(c) < 128 for c in query):
-            continue
-        if query in previously_judged_queries and query not in test_queries:
-            continue
-        log_processor = QueryLogProcessor()
-        emu_id_to_actions = collections.defaultdict(lambda: [])
-        for a in search_log['actions']:
-            emu_id = a['fields'].get('emu_id')
-            target = None
-            if a['event_type'] == 'MMov':
-                # This is a mouse-move event, we can safely ignore it
-                continue
-            elif a['event_type'] == 'Click':
-                target = parse_href(a['fields'].get('href'))
-            action = Action(type=a['event_type'], ts=a['ts'],
-                            target=target, rank=a['fields'].get('rank'))
-            emu_id_to_actions[emu_id].append(action)
-            log_processor.actions.append({'emu_id': emu_id, 'action': action})
-
-        parsed_html = bs4.BeautifulSoup(search_log['serp_html'], 'html.parser')
-        for style in parsed_html.find_all('style'):
-            styles.add(unicode(style.string).encode('utf-8'))
-        query_rows = []
-        for snippet in parsed_html.find_all(
-                lambda b: b.name == 'li' and 'g' in b.get('class', [])):
-            log_id = LOG_ID_PREFIX + '%d_%s' % (query_num, snippet['emu_id'])
-            snippet_emu_ids = []
-            snippet_actions = []
-            link = None
-            rank = None
-            for descendant in itertools.chain([snippet], snippet.descendants):
-                if type(descendant) != bs4.element.Tag:
-                    continue
-                if descendant.name == 'script':
-                    descendant.clear()
-                    continue
-                classes = set('.' + c for c in descendant.get('class', []))
-                interesting_selectors.update(classes)
-                id = descendant.get('id')
-                if id is not None:
-                    interesting_selectors.add('#' + id)
-                cleanup_link(descendant)
-                emu_id = descendant['emu_id']
-                if (emu_id is not None) and (emu_id in emu_id_to_actions):
-                    snippet_emu_ids.append(emu_id)
-                    actions = emu_id_to_actions[emu_id]
-                    if link is None:
-                        for a in actions:
-                            if a.target is not None:
-                                link = a.target
-                                rank = a.rank
-                                break
-                    if any(a.type == 'Click' for a in actions) and link is None:
-                        snippet_actions += [a for a in actions if not a.type == 'Click']
-                        if DEBUG:
-                            format_snippet_debug(query, descendant, snippet, rank)
-
-                    else:
-                        snippet_actions += actions
-            if ONLY_HOVERED and len(snippet_actions) == 0:
-                continue
-            snippet_encoded = snippet.encode('utf-8')
-            while len(snippet_encoded) > 60000:
-                if not remove_inline_image(snippet):
-                    print >>sys.stderr, 'The snippet is too long: ', len(snippet_encoded)
-                    # print >>sys.stderr, snippet_encoded
-                    break
-                snippet_encoded = snippet.encode('utf-8')
-            else:
-                log_item = LogItem(log_id, snippet_actions)
-                for emu_id in snippet_emu_ids:
-                    log_processor.emu_id_to_log_item[emu_id] = log_item
-                query_rows.append({
-                    'query': query.encode('utf-8'),
-                    'snippet': snippet_encoded,
-                    'link': link,
-                    'log_id': log_id,
-                    'emu_ids': ' '.join(snippet_emu_ids),
-                    'actions': log_item,
-                    'sat_feedback': sat_feedback,
-                })
-                if DEBUG and not html_files_dumped:
-                    with open(TMP_DIR + log_id + '.html', 'w') as f:
-                        print >>f, snippet.prettify().encode('utf-8')
-                    html_files_dumped = True
-        # All the data for the query is read, do the processing now.
-        log_processor.process()
-        for row in query_rows:
-            writer.writerow(dict((k, (v if type(v) in [str, unicode] else jsonpickle.encode(v))) \
-                    for k, v in row.iteritems()))
+    _PREVIOUS_RESULTS.update(test_queries=test_queries,
+                             previously_judged_queries=previously_judged_queries)
+    pool = None
+    if N_JOBS == 1:
+        results = itertools.chain(results, itertools.imap(_process_search_log_job, lines))
+    else:
+        pool = multiprocessing.Pool(N_JOBS)
+        # imap() returns the results in the order of the lines.
+        results = itertools.chain(results, pool.imap(_process_search_log_job, lines, chunksize=16))
+    interesting_selectors = set()
+    styles = set()
+    try:
+        for result in results:
+            sys.stderr.write(result.stderr)
+            for row in result.rows:
+                writer.writerow(row)
+            interesting_selectors.update(result.interesting_selectors)
+            styles.update(result.styles)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
     print >>sys.stderr, '</ul>'
 
     with open(TMP_DIR + 'classes.txt', 'w') as f:
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+#
+# Extract the snippets (li.g elements) and stylesheets from SERP HTML with a
+# single streaming pass of the HTMLParser (the parser used by BeautifulSoup
+# with 'html.parser') instead of building the tree for the whole SERP.
+# Only the snippets are then parsed with BeautifulSoup, which gives the same
+# trees as the corresponding subtrees of the whole SERP.
+#
+# Snippets that are too big for the task file are compacted by removing
+# their inline (data:) images, optionally keeping them in a side-car store.
+
+import base64
+import binascii
+import bisect
+import hashlib
+from HTMLParser import HTMLParser
+import mimetypes
+import os
+import os.path
+import urllib
+
+import bs4
+
+
+# Elements that are closed right after the start tag (same as in BeautifulSoup).
+VOID_ELEMENTS = frozenset(bs4.builder.HTMLTreeBuilder.empty_element_tags)
+
+
+def is_snippet(tag, attrs):
+    return tag == 'li' and 'g' in (attrs.get('class') or '').split()
+
+
+class SerpExtractor(HTMLParser):
+    """ The source of the snippets and the contents of the <style> elements of a SERP.
+
+        Open elements are tracked the same way BeautifulSoup builds the tree:
+        an end tag closes the last open element with the same name and all the
+        elements opened after it; an end tag without such an element is ignored.
+
+        The elements are numbered in the document (pre-)order, so the elements
+        of a snippet form a range of numbers and the emu_ids of the snippet
+        can be looked up without walking its tree (see snippet_emu_ids()).
+        The elements of the snippets that matter to create_tasks.py exclude
+        the <script> ones.
+    """
+
+    def __init__(self, html):
+        HTMLParser.__init__(self)
+        self.html = html
+        self.line_offsets = [0]
+        pos = html.find('\n')
+        while pos >= 0:
+            self.line_offsets.append(pos + 1)
+            pos = html.find('\n', pos + 1)
+        self.open_tags = []         # (tag, index in snippet_spans or None)
+        self.snippet_spans = []     # [start, end) offsets in html
+        self.snippet_ranges = []    # [start, end) numbers of the elements
+        self.n_open_snippets = 0
+        self.n_elements = 0
+        self.emu_id_positions = {}  # emu_id -> numbers of the elements with it
+        self.selectors = set()      # CSS classes and ids used in the snippets
+        self.styles = []            # text of the <style> elements, None for empty ones
+        self.style_data = None
+        self.feed(html)
+        self.close()
+        # Elements that are not closed end with the document.
+        self._pop(0, len(html))
+
+    def _offset(self):
+        line, column = self.getpos()
+        return self.line_offsets[line - 1] + column
+
+    def _pop(self, depth, end):
+        """ Close the open elements from depth on at the offset end. """
+        for tag, snippet_index in self.open_tags[depth:]:
+            if snippet_index is not None:
+                self.snippet_spans[snippet_index][1] = end
+                self.snippet_ranges[snippet_index][1] = self.n_elements
+                self.n_open_snippets -= 1
+            if tag == 'style':
+                self.styles.append(u''.join(self.style_data) if self.style_data else None)
+                self.style_data = None
+        del self.open_tags[depth:]
+
+    def handle_starttag(self, tag, attrs):
+        # Attributes without a value are empty strings in BeautifulSoup.
+        attrs = dict((k, '' if v is None else v) for k, v in attrs)
+        snippet_index = None
+        if is_snippet(tag, attrs):
+            snippet_index = len(self.snippet_spans)
+            start = self._offset()
+            self.snippet_spans.append([start, start + len(self.get_starttag_text())])
+            self.snippet_ranges.append([self.n_elements, self.n_elements + 1])
+            self.n_open_snippets += 1
+        if tag != 'script':
+            emu_id = attrs.get('emu_id')
+            if emu_id is not None:
+                self.emu_id_positions.setdefault(emu_id, []).append(self.n_elements)
+            if self.n_open_snippets > 0:
+                self.selectors.update('.' + c for c in attrs.get('class', '').split())
+                if 'id' in attrs:
+                    self.selectors.add('#' + attrs['id'])
+        self.n_elements += 1
+        if tag == 'style':
+            self.style_data = []
+        self.open_tags.append((tag, snippet_index))
+        if tag in VOID_ELEMENTS:
+            self._pop(len(self.open_tags) - 1, self._offset() + len(self.get_starttag_text()))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self._pop(len(self.open_tags) - 1, self._offset() + len(self.get_starttag_text()))
+
+    def handle_endtag(self, tag):
+        for depth in xrange(len(self.open_tags) - 1, -1, -1):
+            if self.open_tags[depth][0] == tag:
+                start = self._offset()
+                # Elements opened after this one end where its end tag starts.
+                self._pop(depth + 1, start)
+                self._pop(depth, self.html.index('>', start) + 1)
+                return
+
+    def handle_data(self, data):
+        if self.style_data is not None:
+            self.style_data.append(data)
+
+    def snippet_sources(self):
+        """ HTML of the snippets in the document order. """
+        return [self.html[start:end] for start, end in self.snippet_spans]
+
+    def snippets(self):
+        """ The snippets as BeautifulSoup tags. """
+        return [bs4.BeautifulSoup(source, 'html.parser').li for source in self.snippet_sources()]
+
+    def snippet_emu_ids(self, emu_ids):
+        """ For each snippet, the emu_ids from the given collection that its elements
+            have, in the order of the elements.
+        """
+        emu_id_at = dict((p, emu_id) for emu_id in emu_ids
+                         for p in self.emu_id_positions.get(emu_id, []))
+        positions = sorted(emu_id_at)
+        result = []
+        for start, end in self.snippet_ranges:
+            result.append([emu_id_at[p] for p in positions[bisect.bisect_left(positions, start):
+                                                            bisect.bisect_left(positions, end)]])
+        return result
+
+
+class _FirstTagAttrs(HTMLParser):
+    def __init__(self, tag):
+        HTMLParser.__init__(self)
+        self.tag = tag
+        self.attrs = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == self.tag and self.attrs is None:
+            self.attrs = dict(attrs)
+
+
+def first_tag_attrs(html, tag='li'):
+    """ Attributes of the first element with the given tag name (None if there is none),
+        with the multi-valued 'class' attribute split into a list as in BeautifulSoup.
+    """
+    parser = _FirstTagAttrs(tag)
+    pos = 0
+    # Feed the HTML in parts to stop soon after the tag is found.
+    while parser.attrs is None and pos < len(html):
+        parser.feed(html[pos:pos + 1024])
+        pos += 1024
+    if parser.attrs is None:
+        parser.close()
+    attrs = parser.attrs
+    if attrs is not None and 'class' in attrs:
+        attrs['class'] = (attrs['class'] or '').split()
+    return attrs
+
+
+class InlineImageStore(object):
+    """ Directory with the images taken out of the snippets.
+
+        The images are stored under the SHA-1 of their data: URI, so the same
+        image is stored once and several processes can share the directory.
+    """
+
+    def __init__(self, directory, url_prefix):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def put(self, data_uri):
+        """ Store the image and return the URL to replace data_uri with
+            (None if data_uri cannot be decoded).
+        """
+        header, sep, data = data_uri.partition(',')
+        if not sep:
+            return None
+        mime_type = header[len('data:'):].split(';', 1)[0]
+        try:
+            if header.endswith(';base64'):
+                data = base64.b64decode(data)
+            else:
+                data = urllib.unquote(data.encode('utf-8'))
+        except (TypeError, binascii.Error, UnicodeError):
+            return None
+        name = hashlib.sha1(data_uri.encode('utf-8')).hexdigest() + \
+                (mimetypes.guess_extension(mime_type) or '')
+        file_name = os.path.join(self.directory, name)
+        if not os.path.exists(file_name):
+            tmp_file_name = '%s.%d.tmp' % (file_name, os.getpid())
+            with open(tmp_file_name, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_file_name, file_name)
+        return self.url_prefix + name
+
+
+def compact_snippet(snippet, max_size, image_store=None):
+    """ Encode the snippet (UTF-8), removing its largest inline images until
+        it is at most max_size bytes long or there are no inline images left.
+
+        With image_store the images are replaced by their URLs in the store
+        instead of being removed.
+    """
+    snippet_encoded = snippet.encode('utf-8')
+    if len(snippet_encoded) <= max_size:
+        return snippet_encoded
+    images = snippet.find_all('img', src=lambda src: src is not None and src.startswith('data:image/'))
+    # The largest (encoded) first; the document order for the images of the same size.
+    images = sorted(((len(img.encode('utf-8')), -i, img) for i, img in enumerate(images)), reverse=True)
+    size = len(snippet_encoded)
+    for img_size, _, img in images:
+        if size <= max_size:
+            break
+        url = image_store.put(img['src']) if image_store is not None else None
+        if url is None:
+            del img['src']
+        else:
+            img['src'] = url
+        # The encoded tag includes the escaping of its attributes, so the
+        # difference is exactly the change of the encoded snippet.
+        size -= img_size - len(img.encode('utf-8'))
+    return snippet.encode('utf-8')
@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+#
+# Tests for click_model.py. The models are compared with straightforward
+# (or the original) implementations on small fixed datasets.
+
+from __future__ import division
+
+import collections
+import os
+import pickle
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.optimize
+import scipy.stats
+import sklearn.cross_validation
+
+import click_model
+from create_tasks import Action, LogItem
+
+try:
+    from pyclick.click_models.PBM import PBM as pyclick_PBM
+    from pyclick.click_models.UBM import UBM as pyclick_UBM
+    from pyclick.search_session.SearchResult import SearchResult as pyclick_SearchResult
+    from pyclick.search_session.SearchSession import SearchSession as pyclick_SearchSession
+except ImportError:
+    pyclick_PBM = None
+
+
+def make_data(n=40, seed=0):
+    """ Fixed random relevance labels (log_id -> RelContainer) and sessions. """
+    rnd = random.Random(seed)
+    rels = collections.defaultdict(click_model.RelContainer)
+    data = []
+    for q in xrange(n):
+        L = rnd.randint(7, 12)
+        session, serp = [], []
+        for r in xrange(L):
+            log_id = 'v2_%d_%d' % (q, r)
+            actions = []
+            if rnd.random() < 0.3:
+                actions.append(Action('Click', rnd.randint(0, 10000), 'x', r))
+            if rnd.random() < 0.3:
+                actions.append(Action('MOver', rnd.randint(0, 10000), None, None))
+            log_item = LogItem(log_id, actions)
+            if rnd.random() < 0.2:
+                log_item.fixation = True
+            session.append(log_item)
+            column = '101' if (r < L - 2 or rnd.random() < 0.5) else '202'
+            serp.append(click_model.Snippet(
+                    emup='%s;16;%d;%d;%d' % (column, rnd.randint(0, 1800), rnd.randint(338, 539),
+                                             rnd.randint(33, 896)),
+                    cas_item_type='c_%d' % rnd.randint(0, 9), is_complex=False))
+            for k in xrange(rnd.randint(0, 3)):
+                rels[log_id].Ds.append((rnd.randint(0, 2), rnd.random()))
+            for k in xrange(rnd.randint(0, 3)):
+                rels[log_id].Rs.append((rnd.randint(0, 3), rnd.random()))
+        data.append({'query': 'q%d' % q, 'sat': rnd.random() < 0.6, 'session': session, 'serp': serp})
+    return rels, np.array(data)
+
+
+def click_log(n_sessions=60, seed=0):
+    """ Fixed sessions as (N x L) arrays of document ids, clicks and the padding mask. """
+    random_state = np.random.RandomState(seed)
+    L = 6
+    docs = random_state.randint(4, size=(n_sessions, L))
+    clicks = random_state.uniform(size=(n_sessions, L)) < 0.15 + 0.15 * docs
+    mask = np.arange(L) < random_state.randint(3, L + 1, size=(n_sessions, 1))
+    return np.where(mask, docs, 0), clicks & mask, mask
+
+
+def reference_em(model_name, docs, clicks, mask, iterations):
+    """ PBM / UBM EM with one update per session and rank, as in pyclick. """
+    L = docs.shape[1]
+    attr = np.full(docs.max() + 1, 0.5)
+    exam = np.full((L, L + 1), 0.5)
+    for _ in xrange(iterations):
+        attr_num, attr_den = np.ones_like(attr), np.full_like(attr, 2)
+        exam_num, exam_den = np.ones_like(exam), np.full_like(exam, 2)
+        for n in xrange(len(docs)):
+            prev = 0
+            for rank in xrange(L):
+                if not mask[n, rank]:
+                    break
+                d = docs[n, rank]
+                e = (rank, 0 if model_name == 'PBM' else prev)
+                a, g = attr[d], exam[e]
+                if clicks[n, rank]:
+                    attr_num[d] += 1
+                    exam_num[e] += 1
+                    prev = rank + 1
+                else:
+                    attr_num[d] += a * (1 - g) / (1 - a * g)
+                    exam_num[e] += g * (1 - a) / (1 - a * g)
+                attr_den[d] += 1
+                exam_den[e] += 1
+        attr = attr_num / attr_den
+        exam = exam_num / exam_den
+    if model_name == 'PBM':
+        exam = exam[:, :1]
+    return attr, exam
+
+
+# CAS variants with different features and terms of the log-likelihood.
+CAS_VARIANTS = [{}, {'use_D': False}, {'sat_term_weight': 0}, {'use_class': False},
+                {'use_geometry': False}, {'trec_style': True}]
+
+
+def random_params(seed=0):
+    random_state = np.random.RandomState(seed)
+    return click_model.CAS.initial_guess() + random_state.normal(scale=0.5, size=click_model.CAS.num_features)
+
+
+def reference_cas_train(model, data, maxiter):
+    """ The original CAS.train() with separate value and gradient functions
+        computed session by session.
+    """
+    reg_weight = model.regularization_weight()
+    N = len(data)
+
+    def f(theta):
+        ll = sum(model.log_likelihood(theta, d['session'], d['serp'], d['sat'], f_only=True).full
+                 for d in data)
+        return -ll / N + 0.5 * model.reg_coeff / N * np.multiply(reg_weight, theta).dot(theta)
+
+    def fprime(theta):
+        ll_prime = sum(model.log_likelihood(theta, d['session'], d['serp'], d['sat']).gaussian
+                       for d in data)
+        return -ll_prime / N + model.reg_coeff / N * np.multiply(reg_weight, theta)
+
+    return scipy.optimize.minimize(f, model.initial_guess(), method='L-BFGS-B', jac=fprime,
+                                   options=dict(maxiter=maxiter)).x
+
+
+class CASTest(unittest.TestCase):
+    """ The vectorized CAS computations against the per-session ones. """
+
+    def test_log_likelihood(self):
+        rels, data = make_data()
+        params = random_params()
+        for kwargs in CAS_VARIANTS:
+            model = click_model.CAS(rels, **kwargs)
+            ll = model.log_likelihood(params, model.dataset(data))
+            gradient = np.zeros(model.num_features)
+            for n, d in enumerate(data):
+                expected = model.log_likelihood(params, d['session'], d['serp'], d['sat'])
+                for field in ['full', 'clicks', 'sat']:
+                    self.assertAlmostEqual(getattr(expected, field), getattr(ll, field)[n], msg=(kwargs, field))
+                gradient += expected.gaussian
+            np.testing.assert_allclose(gradient, ll.gaussian, rtol=1e-10, atol=1e-10, err_msg=str(kwargs))
+
+    def test_gradient(self):
+        rels, data = make_data()
+        params = random_params()
+        for kwargs in CAS_VARIANTS:
+            model = click_model.CAS(rels, **kwargs)
+            dataset = model.dataset(data)
+            _, gradient = model._total_log_likelihood(params, dataset)
+            # As in log_likelihood(), the tau_D gradient only accounts for the
+            # items without fixations, so it is not compared here.
+            begin = model.num_features_epsilon + model.num_features_alpha + 1
+            tau_D = np.arange(begin, begin + model.num_tau_D)
+            h = 1e-6
+            for k in np.setdiff1d(np.arange(model.num_features), tau_D):
+                delta = np.zeros(model.num_features)
+                delta[k] = h
+                numeric = (model._total_log_likelihood(params + delta, dataset)[0] -
+                           model._total_log_likelihood(params - delta, dataset)[0]) / (2 * h)
+                self.assertAlmostEqual(numeric, gradient[k], places=4, msg=(kwargs, k))
+
+    def test_utility(self):
+        rels, data = make_data()
+        params = random_params()
+        for kwargs in CAS_VARIANTS:
+            model = click_model.CAS(rels, **kwargs)
+            np.testing.assert_allclose([model.utility(params, d['session'], d['serp']) for d in data],
+                                       model.utility(params, model.dataset(data)), err_msg=str(kwargs))
+
+    def test_train(self):
+        rels, data = make_data()
+        for kwargs in CAS_VARIANTS:
+            model = click_model.CAS(rels, **kwargs)
+            np.testing.assert_allclose(reference_cas_train(model, data, maxiter=10),
+                                       model.train(data, maxiter=10), rtol=1e-5, atol=1e-6,
+                                       err_msg=str(kwargs))
+
+    def test_train_stochastic(self):
+        rels, data = make_data()
+        model = click_model.CAS(rels)
+        # Full-batch Adam steps with the per-session gradients.
+        reg_weight = model.regularization_weight()
+        bounds = np.array([[-np.inf if l is None else l, np.inf if u is None else u]
+                           for l, u in model.bounds()])
+        theta = model.initial_guess()
+        m = np.zeros_like(theta)
+        v = np.zeros_like(theta)
+        for step in xrange(1, 4):
+            ll_prime = sum(model.log_likelihood(theta, d['session'], d['serp'], d['sat']).gaussian
+                           for d in data)
+            gradient = -ll_prime / len(data) + model.reg_coeff / len(data) * reg_weight * theta
+            m = 0.9 * m + 0.1 * gradient
+            v = 0.999 * v + 0.001 * gradient ** 2
+            theta = np.clip(theta - 0.05 * (m / (1 - 0.9 ** step)) / (np.sqrt(v / (1 - 0.999 ** step)) + 1e-8),
+                            bounds[:, 0], bounds[:, 1])
+        np.testing.assert_allclose(theta, model.train_stochastic(lambda: [data], n_epochs=3,
+                                                                 batch_size=len(data), learning_rate=0.05))
+        # The chunks can be lists of sessions or CASDataset's.
+        chunks = [data[:15], data[15:]]
+        self.assertTrue(np.array_equal(
+                model.train_stochastic(lambda: chunks, n_epochs=2, batch_size=4, random_state=0),
+                model.train_stochastic(lambda: [model.dataset(c) for c in chunks], n_epochs=2,
+                                       batch_size=4, random_state=0)))
+
+    def test_train_stochastic_verbose(self):
+        rels, data = make_data()
+        model = click_model.CAS(rels)
+        saved_stderr = sys.stderr
+        try:
+            sys.stderr = StringIO.StringIO()
+            model.train_stochastic(lambda: [data], n_epochs=2, held_out=data[:10])
+            self.assertEqual('', sys.stderr.getvalue())
+            sys.stderr = StringIO.StringIO()
+            model.train_stochastic(lambda: [data], n_epochs=2, held_out=data[:10], verbose=True)
+            progress = sys.stderr.getvalue().splitlines()
+        finally:
+            sys.stderr = saved_stderr
+        self.assertEqual(2, len(progress))
+        self.assertTrue(progress[1].startswith('Epoch 2: 40 sessions, mean LL = '), progress[1])
+        self.assertIn('held-out mean LL', progress[1])
+
+    def test_malformed_snippets(self):
+        rels, data = make_data(n=1)
+        session, serp = data[0]['session'], data[0]['serp']
+        for emup in ['101;16;800;400', '101;16;800;400;30;7', '101;16;800;400;x']:
+            bad_serp = serp[:2] + [serp[2]._replace(emup=emup)] + serp[3:]
+            self.assertRaises(ValueError, click_model.CASDataset, [{'session': session, 'serp': bad_serp,
+                                                                   'sat': True}], rels)
+            self.assertRaises(ValueError, click_model.CAS(rels)._exam_features_serp, session, bad_serp)
+            # The geometry is not parsed if it is not used.
+            click_model.CAS(rels, use_geometry=False)._exam_features_serp(session, bad_serp)
+        bad_serp = serp[:2] + [serp[2]._replace(cas_item_type='c_x')] + serp[3:]
+        self.assertRaises(ValueError, click_model.CAS(rels)._exam_features_serp, session, bad_serp)
+        click_model.CAS(rels, use_class=False)._exam_features_serp(session, bad_serp)
+
+    def test_update(self):
+        rels, data = make_data()
+        model = click_model.CAS(rels)
+        params = model.train(data[:25], maxiter=5)
+        new_params, dataset = model.update(params, model.dataset(data[:25]), data[25:], maxiter=5)
+        self.assertEqual(len(data), len(dataset))
+        np.testing.assert_array_equal(model.train(data, theta0=params, maxiter=5), new_params)
+        # The starting params can be read from a file.
+        directory = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(directory, 'CAS.params')
+            with open(fname, 'w') as f:
+                pickle.dump(params, f)
+            np.testing.assert_array_equal(new_params, model.train(data, theta0=fname, maxiter=5))
+        finally:
+            shutil.rmtree(directory)
+
+
+class CASDatasetTest(unittest.TestCase):
+
+    def test_features(self):
+        rels, data = make_data()
+        for trec_style in [False, True]:
+            dataset = click_model.CASDataset(data, rels, trec_style)
+            model = click_model.CAS(rels, trec_style=trec_style)
+            self.assertEqual(len(data), len(dataset))
+            for n, d in enumerate(data):
+                session = d['session']
+                L = len(session)
+                np.testing.assert_array_equal(model._exam_features_serp(session, d['serp']),
+                                              dataset.exam_features[n, :L])
+                for i, log_item in enumerate(session):
+                    rel = rels[log_item.log_id]
+                    np.testing.assert_allclose(click_model.rel_dist(rel.Ds, 'D', trec_style),
+                                               dataset.tau_f_D[n, i])
+                    np.testing.assert_allclose(click_model.rel_dist(rel.Rs, 'R', trec_style),
+                                               dataset.tau_f_R[n, i])
+                    np.testing.assert_allclose(model._attr_features(rel.Rs, trec_style),
+                                               dataset.attr_features[n, i])
+                    self.assertEqual(click_model.rel_most_common(rel.Ds), dataset.rel_D[n, i])
+                    self.assertEqual(click_model.rel_most_common(rel.Rs), dataset.rel_R[n, i])
+                self.assertEqual([l.fixation for l in session], dataset.fixation[n, :L].tolist())
+                self.assertEqual([l.click for l in session], dataset.click[n, :L].tolist())
+                self.assertEqual(d['sat'], dataset.sat[n])
+                self.assertEqual([True] * L + [False] * (dataset.mask.shape[1] - L), dataset.mask[n].tolist())
+                for name in ['exam_features', 'fixation', 'click']:
+                    self.assertFalse(getattr(dataset, name)[n, L:].any(), name)
+
+    def test_getitem(self):
+        rels, data = make_data()
+        dataset = click_model.CASDataset(data, rels)
+        index = np.array([5, 0, 17, 3])
+        subset = dataset[index]
+        expected = click_model.CASDataset(data[index], rels)
+        for name in click_model.CASDataset.fields:
+            array = getattr(subset, name)
+            if array.ndim > 1:
+                array = array[:, :expected.mask.shape[1]]
+            np.testing.assert_array_equal(getattr(expected, name), array, name)
+
+    def test_concatenate(self):
+        rels, data = make_data()
+        # The sessions of the parts have different maximum lengths.
+        order = np.r_[1:3, 0, 3:len(data)]
+        parts = [data[1:3], data[:1], data[3:]]
+        dataset = click_model.CASDataset.concatenate([click_model.CASDataset(p, rels) for p in parts])
+        expected = click_model.CASDataset(data[order], rels)
+        np.testing.assert_array_equal(expected.mask, dataset.mask)
+        for name in click_model.CASDataset.fields:
+            expected_array, array = getattr(expected, name), getattr(dataset, name)
+            if array.ndim > 1:
+                # The padded relevance features are zeros in the padded parts and
+                # the features of the unlabeled item 0 in expected, so they are skipped.
+                expected_array, array = expected_array[expected.mask], array[dataset.mask]
+            np.testing.assert_array_equal(expected_array, array, name)
+
+
+class DeduplicateTest(unittest.TestCase):
+
+    def test_cas_dataset(self):
+        rels, data = make_data()
+        data = np.concatenate([data, data[:10], data[5:8]])
+        params = random_params()
+        dataset = click_model.CASDataset(data, rels)
+        for kwargs, num_unique in [({}, 40), ({'use_class': False, 'use_geometry': False}, None)]:
+            model = click_model.CAS(rels, **kwargs)
+            unique = dataset.deduplicate(model._exam_feature_mask())
+            if num_unique is not None:
+                self.assertEqual(num_unique, len(unique))
+            self.assertEqual(len(data), unique.weight.sum())
+            ll, gradient = model._total_log_likelihood(params, dataset)
+            unique_ll, unique_gradient = model._total_log_likelihood(params, unique)
+            self.assertAlmostEqual(ll, unique_ll)
+            np.testing.assert_allclose(gradient, unique_gradient)
+
+
+class BatchTest(unittest.TestCase):
+    """ The batch methods of the models against the per-session ones. """
+
+    def test_batch(self):
+        rels, data = make_data()
+        rels = click_model.RelevanceStore(rels)
+        models = [click_model.RandomSatModel(), click_model.ClickModel('PBM', rels),
+                  click_model.ClickModel('UBM', rels), click_model.DCG(rels), click_model.uUBM(rels),
+                  click_model.CAS(rels), click_model.CAS(rels, sat_term_weight=0)]
+        for model in models:
+            params = model.train(data)
+            ll = model.log_likelihood_batch(params, data)
+            for field in ['full', 'clicks', 'sat']:
+                np.testing.assert_allclose(
+                        [getattr(model.log_likelihood(params, d['session'], d['serp'], d['sat'], f_only=True),
+                                 field) for d in data],
+                        getattr(ll, field), err_msg='%s %s' % (model.__class__.__name__, field))
+            np.testing.assert_allclose([model.utility(params, d['session'], d['serp']) for d in data],
+                                       model.utility_batch(params, data), err_msg=model.__class__.__name__)
+
+
+class EMClickModelTest(unittest.TestCase):
+
+    def test_reference_em(self):
+        docs, clicks, mask = click_log()
+        for model_name in ['PBM', 'UBM']:
+            model = click_model.EMClickModel(model_name)
+            model.iterations = 10
+            model.train(docs, clicks, mask)
+            attr, exam = reference_em(model_name, docs, clicks, mask, 10)
+            np.testing.assert_allclose(model.attr, attr)
+            # UBM examination for the (rank, previous click rank) pairs that occur.
+            seen = np.zeros_like(exam, dtype=bool)
+            prev = model.prev_click_ranks(clicks)
+            seen[np.arange(docs.shape[1])[np.newaxis].repeat(len(docs), 0)[mask],
+                 0 if model_name == 'PBM' else prev[mask]] = True
+            np.testing.assert_allclose(model.exam[seen], exam[seen])
+
+    def test_export_params(self):
+        docs, clicks, mask = click_log()
+        model = click_model.EMClickModel('UBM').train(docs, clicks, mask)
+        params = pickle.loads(pickle.dumps(model.export_params()))
+        loaded = click_model.EMClickModel.from_params(params)
+        np.testing.assert_array_equal(model.get_full_click_probs(docs, mask),
+                                      loaded.get_full_click_probs(docs, mask))
+
+    @unittest.skipIf(pyclick_PBM is None, 'pyclick is not installed')
+    def test_pyclick(self):
+        docs, clicks, mask = click_log()
+        sessions = []
+        for n in xrange(len(docs)):
+            session = pyclick_SearchSession('dummy_query')
+            for rank in np.flatnonzero(mask[n]):
+                session.web_results.append(pyclick_SearchResult(int(docs[n, rank]), int(clicks[n, rank])))
+            sessions.append(session)
+        for model_name, pyclick_class in [('PBM', pyclick_PBM), ('UBM', pyclick_UBM)]:
+            model = click_model.EMClickModel(model_name).train(docs, clicks, mask)
+            pyclick_model = pyclick_class()
+            pyclick_model.train(sessions)
+            attr = pyclick_model.params[pyclick_model.param_names.attr]
+            for doc in xrange(len(model.attr)):
+                self.assertAlmostEqual(attr.get('dummy_query', doc).value(), model.attr[doc])
+            if model_name == 'PBM':
+                exam = pyclick_model.params[pyclick_model.param_names.exam]
+                for rank in xrange(docs.shape[1]):
+                    self.assertAlmostEqual(exam.get(rank).value(), model.exam[rank, 0])
+            # The examination probabilities of UBM through the click probabilities.
+            conditional = model.get_conditional_click_probs(docs, clicks, mask)
+            full = model.get_full_click_probs(docs, mask)
+            for n, session in enumerate(sessions):
+                np.testing.assert_allclose(pyclick_model.get_conditional_click_probs(session),
+                                           conditional[n][mask[n]])
+                np.testing.assert_allclose(pyclick_model.get_full_click_probs(session),
+                                           full[n][mask[n]])
+
+
+class ClickModelTest(unittest.TestCase):
+
+    def test_trec_eval_params_file(self):
+        import trec_eval
+        rels = trec_eval.MARK_TO_INT_REL_DICT
+        data = [{'session': [LogItem(str(m)) for m in marks]}
+                for marks in [[3, 0, 1], [2, 2, 0, 1], [0, 3]]]
+        model = click_model.ClickModel('PBM', rels)
+        trained = model.train(data)
+        directory = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(directory, 'PBM.params')
+            with open(fname, 'w') as f:
+                pickle.dump(trained.export_params(), f)
+            metric = trec_eval.ClickModelFromFile('PBM', fname)
+            value = metric({'i': np.array([0, 3, 1, 0], dtype=np.int8)}, np.array([1, 2, 3]))
+        finally:
+            shutil.rmtree(directory)
+        session = [LogItem(str(m)) for m in [3, 1, 0]]
+        self.assertAlmostEqual(model.utility(trained, session, None), value)
+
+
+class RelevanceStoreTest(unittest.TestCase):
+
+    def check_store(self, store, rels, log_ids):
+        ids = store.indices(log_ids)
+        for log_id, i in zip(log_ids, ids):
+            rel = rels[log_id]
+            for rel_aspect, ratings in [('D', rel.Ds), ('R', rel.Rs)]:
+                np.testing.assert_allclose(store.dist(i, rel_aspect),
+                                           click_model.rel_dist(ratings, rel_aspect))
+                np.testing.assert_allclose(store.dist(i, rel_aspect, trec_style=True),
+                                           click_model.rel_dist(ratings, rel_aspect, trec_style=True))
+                self.assertEqual(click_model.rel_most_common(ratings), store.most_common(i, rel_aspect))
+
+    def test_labels(self):
+        rels, data = make_data()
+        log_ids = [l.log_id for d in data for l in d['session']] + ['unknown']
+        self.check_store(click_model.RelevanceStore(rels), rels, log_ids)
+        # Items added in small batches on first use.
+        store = click_model.RelevanceStore(collections.defaultdict(click_model.RelContainer))
+        store.log_id_to_rel = rels
+        for k in xrange(0, len(log_ids), 7):
+            store.indices(log_ids[k:k + 7])
+        self.check_store(store, rels, log_ids)
+        self.assertEqual(len(store.log_ids), len(store.hist_R))
+
+    def test_save_load(self):
+        rels, data = make_data()
+        store = click_model.RelevanceStore(rels)
+        directory = tempfile.mkdtemp()
+        try:
+            store.save(directory)
+            loaded = click_model.RelevanceStore.load(directory)
+            sessions = [d['session'] for d in data]
+            for a, b in zip(store.session_arrays(sessions), loaded.session_arrays(sessions)):
+                np.testing.assert_array_equal(a, b)
+            del loaded
+        finally:
+            shutil.rmtree(directory)
+
+
+class _SumModel(object):
+    """ Stands in for CAS in the _ShardedLogLikelihood tests. """
+
+    def _total_log_likelihood(self, params, shard):
+        if params == 'fail':
+            raise ValueError('failed')
+        if params == 'die':
+            os._exit(3)
+        return shard.sum() * params, shard.size
+
+
+class ShardedLogLikelihoodTest(unittest.TestCase):
+
+    def test_sums(self):
+        sharded = click_model._ShardedLogLikelihood(_SumModel(), np.arange(10), 3)
+        try:
+            self.assertEqual((45 * 2, 10), sharded(2))
+            self.assertEqual((45 * 3, 10), sharded(3))
+        finally:
+            sharded.close()
+
+    def test_worker_exception(self):
+        sharded = click_model._ShardedLogLikelihood(_SumModel(), np.arange(10), 3)
+        try:
+            with self.assertRaisesRegexp(RuntimeError, 'ValueError: failed'):
+                sharded('fail')
+        finally:
+            sharded.close()
+        self.assertFalse(any(w.is_alive() for w in sharded.workers))
+
+    def test_dead_worker(self):
+        sharded = click_model._ShardedLogLikelihood(_SumModel(), np.arange(10), 2)
+        try:
+            with self.assertRaisesRegexp(RuntimeError, 'exit code 3'):
+                sharded('die')
+        finally:
+            sharded.close()
+
+    def test_cas_train(self):
+        rels, data = make_data()
+        model = click_model.CAS(rels)
+        np.testing.assert_allclose(model.train(data, n_jobs=1, maxiter=5),
+                                   model.train(data, n_jobs=2, maxiter=5))
+
+
+def reference_evaluate(model, data, train_index, test_index):
+    """ Evaluation of a model on one fold as in the original main(). """
+    train_data = data[train_index]
+    test_data = data[test_index]
+    params = model.train(train_data)
+    ll_values_test = [model.log_likelihood(params, d['session'], d['serp'], d['sat'], f_only=True)
+                      for d in test_data]
+    utility = [model.utility(params, d['session'], d['serp']) for d in test_data]
+    return {
+        'full': np.average([l.full for l in ll_values_test]),
+        'click': np.average([l.clicks for l in ll_values_test]),
+        'sat': np.average([l.sat for l in ll_values_test]),
+        'utility': utility,
+        'sat pearson': scipy.stats.pearsonr([int(d['sat']) for d in test_data], utility)[0],
+    }
+
+
+class _FailingModel(click_model.RandomSatModel):
+    def train(self, data):
+        raise ValueError('bad fold')
+
+
+class RunExperimentTest(unittest.TestCase):
+
+    def test_run_experiment(self):
+        rels, data = make_data()
+        rels = click_model.RelevanceStore(rels)
+        models = {
+            'CAS': click_model.CAS(rels),
+            'CASnosat': click_model.CAS(rels, sat_term_weight=0),
+            'PBM': click_model.ClickModel('PBM', rels),
+            'random': click_model.RandomSatModel(),
+        }
+        splitter = lambda rep: sklearn.cross_validation.KFold(len(data), n_folds=2, shuffle=True,
+                                                               random_state=rep)
+        expected = {}
+        for rep in xrange(2):
+            for fold, (train_index, test_index) in enumerate(splitter(rep)):
+                for name, model in models.iteritems():
+                    for metric, value in reference_evaluate(model, data, train_index, test_index).iteritems():
+                        expected[rep, fold, name, metric] = value
+        for n_jobs in [1, 2]:
+            results = click_model.run_experiment(models, data, splitter, n_jobs=n_jobs, n_repetitions=2)
+            self.assertEqual(len(expected), len(results))
+            for _, row in results.iterrows():
+                key = (row['rep'], row['fold'], row['model'], row['metric'])
+                np.testing.assert_allclose(expected[key], row['value'], rtol=1e-6, err_msg=str(key))
+
+    def test_failed_job(self):
+        _, data = make_data()
+        models = {'random': click_model.RandomSatModel(), 'failing': _FailingModel()}
+        splitter = lambda rep: sklearn.cross_validation.KFold(len(data), n_folds=2)
+        saved_stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            for n_jobs in [1, 2]:
+                with self.assertRaises(ValueError):
+                    click_model.run_experiment(models, data, splitter, n_jobs=n_jobs)
+            self.assertIn('Failed to evaluate failing (rep=0, fold=', sys.stderr.getvalue())
+        finally:
+            sys.stderr = saved_stderr
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+#
+#
+# Tests for columnar_logs.py.
+
+import collections
+import csv
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import jsonpickle
+import numpy as np
+
+import click_model
+from columnar_logs import ColumnarLogs, convert
+from create_tasks import Action, LogItem
+
+
+SERPS_COLUMNS = ['cas_log_id', 'cas_query_id', 'sat_feedback', 'emup', 'cas_item_type',
+                 'is_complex', 'actions']
+
+
+def serps_rows(n=30, seed=0):
+    """ Fixed rows of a serps_anonymized.csv file with non-ASCII queries and links. """
+    rnd = random.Random(seed)
+    rows = []
+    for q in xrange(n):
+        L = rnd.randint(1, 10)
+        query = u'\u0437\u0430\u043f\u0440\u043e\u0441 %d' % rnd.randint(0, n // 2)
+        sat = rnd.choice(['SAT', 'DSAT', 'undefined'])
+        for r in xrange(L):
+            log_id = 'v2_%d_e%d' % (q, r)
+            actions = []
+            for k in xrange(rnd.randint(0, 3)):
+                action_type = rnd.choice(['Click', 'MOver', 'Scroll'])
+                target = rnd.choice([None, 'http://example.com/%d' % k, u'http://\u043f\u0440.com/'])
+                actions.append(Action(action_type, rnd.randint(0, 10000), target,
+                                      rnd.choice([None, r])))
+            log_item = LogItem(log_id, actions)
+            log_item.fixation = log_item.click or rnd.random() < 0.3
+            log_item.long_click = log_item.click and rnd.random() < 0.5
+            column = '101' if (r < L - 2 or rnd.random() < 0.5) else '202'
+            rows.append({
+                    'cas_log_id': log_id,
+                    'cas_query_id': query.encode('utf-8'),
+                    'sat_feedback': sat,
+                    'emup': '%s;16;%d;%d;%d' % (column, rnd.randint(0, 1800), rnd.randint(338, 539),
+                                                rnd.randint(33, 896)),
+                    'cas_item_type': 'c_%d' % rnd.randint(0, 9),
+                    'is_complex': rnd.choice(['0', '1']),
+                    'actions': jsonpickle.encode(log_item),
+            })
+    return rows
+
+
+def relevance_labels(rows, seed=0):
+    rnd = random.Random(seed)
+    rels = collections.defaultdict(click_model.RelContainer)
+    for row in rows:
+        for k in xrange(rnd.randint(0, 3)):
+            rels[row['cas_log_id']].Ds.append((rnd.randint(0, 2), rnd.random()))
+        for k in xrange(rnd.randint(0, 3)):
+            rels[row['cas_log_id']].Rs.append((rnd.randint(0, 3), rnd.random()))
+    return rels
+
+
+class ColumnarLogsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rows = serps_rows()
+        self.logs = self.convert(self.rows, 'dataset')
+
+    def convert(self, rows, name):
+        csv_file_name = os.path.join(self.directory, name + '.csv')
+        with open(csv_file_name, 'w') as f:
+            writer = csv.DictWriter(f, SERPS_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        convert(os.path.join(self.directory, name), serps=csv_file_name)
+        return ColumnarLogs(os.path.join(self.directory, name))
+
+    def tearDown(self):
+        del self.logs
+        shutil.rmtree(self.directory)
+
+    def test_memory_mapped(self):
+        self.assertTrue(all(isinstance(a, np.memmap) for a in self.logs.arrays.itervalues()))
+
+    def test_rows(self):
+        rows = list(self.logs.rows('serps'))
+        self.assertEqual(len(self.rows), len(rows))
+        for expected, row in zip(self.rows, rows):
+            log_item = jsonpickle.decode(expected['actions'])
+            self.assertEqual(dict(expected, actions=None), dict(row, actions=None))
+            self.assertEqual(log_item.log_id, row['actions'].log_id)
+            self.assertEqual(log_item.actions, row['actions'].actions)
+            self.assertEqual((log_item.click, log_item.fixation, log_item.long_click),
+                             (row['actions'].click, row['actions'].fixation, row['actions'].long_click))
+
+    def test_cas_dataset(self):
+        rels = relevance_labels(self.rows)
+        for trec_style in [False, True]:
+            expected = click_model.CASDataset(list(click_model.sessions_from_rows(self.rows)),
+                                              click_model.RelevanceStore(rels), trec_style)
+            dataset = click_model.CASDataset.from_columns(self.logs, click_model.RelevanceStore(rels),
+                                                          trec_style)
+            self.assertEqual(trec_style, dataset.trec_style)
+            for name in click_model.CASDataset.fields:
+                np.testing.assert_array_equal(getattr(expected, name), getattr(dataset, name), name)
+
+    def test_malformed_emup(self):
+        rels = click_model.RelevanceStore(relevance_labels(self.rows))
+        # With three extra fields everywhere the numbers still make whole
+        # (offset_top, width, height) triples.
+        for name, malformed in [('missing', lambda emup: emup.rsplit(';', 1)[0]),
+                                ('extra', lambda emup: emup + ';1;2;3')]:
+            rows = [dict(row, emup=malformed(row['emup'])) for row in self.rows]
+            logs = self.convert(rows, name)
+            try:
+                self.assertRaises(ValueError, click_model.CASDataset,
+                                  list(click_model.sessions_from_rows(rows)), rels)
+                self.assertRaises(ValueError, click_model.CASDataset.from_columns, logs, rels)
+            finally:
+                del logs
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+#
+# Tests for create_tasks.py.
+
+import json
+import random
+import unittest
+
+import jsonpickle
+
+import create_tasks
+
+
+def search_log_line(query, actions):
+    serp_html = (u'<style>.s{}</style><ol>' +
+                 u''.join(u'<li class="g" emu_id="e%d"><div class="rc" emu_id="e%d_t">'
+                          u'<a emu_id="e%d_a">\u0442\u0435\u043a\u0441\u0442 %d</a></div></li>'
+                          % (i, i, i, i) for i in xrange(3)) +
+                 u'</ol>')
+    return json.dumps({
+            'q': query,
+            'serp_html': serp_html,
+            'actions': [{'event_type': event_type, 'ts': ts, 'fields': {'emu_id': emu_id, 'rank': rank}}
+                        for event_type, ts, emu_id, rank in actions],
+    })
+
+
+def reference_process(emu_id_to_log_item, actions):
+    """ The original QueryLogProcessor.process() for the [{'emu_id', 'action'}] timeline. """
+    actions = sorted(actions, key=lambda x: x['action'].ts)
+    enter_times = {}
+    first_log_item = emu_id_to_log_item.get(actions[0]['emu_id'])
+    if first_log_item is not None:
+        enter_times[first_log_item.log_id] = actions[0]['action'].ts
+    end_timestamp = None
+    for i in xrange(1, len(actions)):
+        cur = actions[i]
+        prev = actions[i - 1]
+        cur_log_item = emu_id_to_log_item.get(cur['emu_id'])
+        prev_log_item = emu_id_to_log_item.get(prev['emu_id'])
+        if cur_log_item != prev_log_item:
+            if cur_log_item is not None:
+                enter_times[cur_log_item.log_id] = cur['action'].ts
+            if prev_log_item is not None:
+                if cur['action'].ts - enter_times[prev_log_item.log_id] \
+                        >= create_tasks.QueryLogProcessor.FIXATION_THRESHOLD:
+                    prev_log_item.fixation = True
+                if prev_log_item.click and \
+                        cur['action'].ts - prev['action'].ts >= create_tasks.QueryLogProcessor.LONG_CLICK_THRESHOLD:
+                    prev_log_item.long_click = True
+        if cur['action'].ts - prev['action'].ts >= create_tasks.QueryLogProcessor.SESSION_CUT_OFF:
+            end_timestamp = prev['action'].ts
+            break
+    if end_timestamp is not None:
+        for a in actions:
+            log_item = emu_id_to_log_item.get(a['emu_id'])
+            if log_item is not None:
+                log_item.clear_after(end_timestamp)
+    else:
+        last_log_item = emu_id_to_log_item.get(actions[-1]['emu_id'])
+        if last_log_item is not None:
+            last_log_item.fixation = True
+            if last_log_item.click:
+                last_log_item.long_click = True
+
+
+def random_timeline(seed):
+    """ Log items of three snippets (the first one has two emu_ids) and the actions
+        on them and outside of the snippets, with ties and long breaks.
+    """
+    rnd = random.Random(seed)
+    timeline = []
+    ts = 0
+    for _ in xrange(rnd.randint(1, 30)):
+        ts += rnd.choice([0, 50, 150, 250, 1000, 40 * 1000, 31 * 60 * 1000]) if rnd.random() < 0.9 else 0
+        emu_id = rnd.choice(['e0', 'e0_a', 'e1', 'e2', 'x', None])
+        action_type = rnd.choice(['Hover', 'Hover', 'Click', 'Scroll'])
+        timeline.append((emu_id, create_tasks.Action(action_type, ts, None, None)))
+    rnd.shuffle(timeline)
+    emu_id_to_log_item = {}
+    for log_id, emu_ids in [('v2_0_e0', ['e0', 'e0_a']), ('v2_0_e1', ['e1']), ('v2_0_e2', ['e2'])]:
+        log_item = create_tasks.LogItem(log_id, [a for e, a in timeline if e in emu_ids])
+        for emu_id in emu_ids:
+            emu_id_to_log_item[emu_id] = log_item
+    return emu_id_to_log_item, timeline
+
+
+class ProcessSearchLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_flags = (create_tasks.DEBUG, create_tasks.ONLY_ASCII_QUERIES)
+        create_tasks.DEBUG = True
+        create_tasks.ONLY_ASCII_QUERIES = False
+
+    def tearDown(self):
+        create_tasks.DEBUG, create_tasks.ONLY_ASCII_QUERIES = self.saved_flags
+
+    def test_debug_non_ascii(self):
+        query = u'\u0437\u0430\u043f\u0440\u043e\u0441'
+        # A click without a link is reported in the debug output.
+        line = search_log_line(query, [('Hover', 0, 'e0', 0),
+                                       ('Click', 500, 'e0_t', 0),
+                                       ('Hover', 1000, 'e1_a', 1)])
+        result = create_tasks.process_search_log(0, line, set(), set())
+        stderr = result.stderr.getvalue()
+        self.assertIsInstance(stderr, str)
+        self.assertIn('Non-link click for [%s]' % query.encode('utf-8'), stderr)
+        self.assertIn(u'\u0442\u0435\u043a\u0441\u0442 0'.encode('utf-8'), stderr)
+        self.assertEqual(['v2_0_e0', 'v2_0_e1', 'v2_0_e2'], [row['log_id'] for row in result.rows])
+        self.assertEqual(query.encode('utf-8'), result.rows[0]['query'])
+        self.assertEqual('e0 e0_t', result.rows[0]['emu_ids'])
+        self.assertEqual('e1_a', result.rows[1]['emu_ids'])
+
+    def test_pool_job(self):
+        create_tasks._PREVIOUS_RESULTS.update(test_queries=set(), previously_judged_queries=set())
+        line = search_log_line(u'caf\xe9', [('Click', 0, 'e2_t', 2), ('Hover', 100, 'e1', 1)])
+        result = create_tasks._process_search_log_job((5, line))
+        self.assertIsInstance(result.stderr, str)
+        self.assertIn('Non-link click for [caf\xc3\xa9]', result.stderr)
+        self.assertEqual(3, len(result.rows))
+
+
+class QueryLogProcessorTest(unittest.TestCase):
+
+    def test_reference(self):
+        for seed in xrange(300):
+            expected, timeline = random_timeline(seed)
+            reference_process(expected, [{'emu_id': e, 'action': a} for e, a in timeline])
+            log_processor = create_tasks.QueryLogProcessor()
+            log_processor.emu_id_to_log_item, _ = random_timeline(seed)
+            for emu_id, action in timeline:
+                log_processor.add_action(emu_id, action)
+            log_processor.process()
+            for emu_id, log_item in expected.iteritems():
+                processed = log_processor.emu_id_to_log_item[emu_id]
+                self.assertEqual((log_item.actions, log_item.click, log_item.fixation, log_item.long_click),
+                                 (processed.actions, processed.click, processed.fixation, processed.long_click))
+
+
+class LogItemTest(unittest.TestCase):
+
+    # The encoding of a LogItem before it had __slots__.
+    ENCODED = ('{"actions": [{"py/newargs": {"py/tuple": ["Click", 5, "http://x", 1]}, '
+               '"py/object": "create_tasks.Action", "py/state": null}], "fixation": true, '
+               '"log_id": "v2_1_e1", "long_click": false, "py/object": "create_tasks.LogItem"}')
+
+    def test_jsonpickle(self):
+        log_item = create_tasks.LogItem('v2_1_e1', [create_tasks.Action('Click', 5, 'http://x', 1)])
+        self.assertEqual(self.ENCODED, jsonpickle.encode(log_item))
+        decoded = jsonpickle.decode(self.ENCODED)
+        self.assertIsInstance(decoded, create_tasks.LogItem)
+        self.assertEqual(('v2_1_e1', log_item.actions, True, True, False),
+                         (decoded.log_id, decoded.actions, decoded.click, decoded.fixation, decoded.long_click))
+
+    def test_jsonpickle_state(self):
+        # The encoding of jsonpickle for objects with __getstate__().
+        decoded = jsonpickle.decode(
+                '{"py/object": "create_tasks.LogItem", "py/state": {"actions": [], '
+                '"fixation": true, "log_id": "v2_1_e1", "long_click": false}}')
+        self.assertEqual(('v2_1_e1', [], False, True, False),
+                         (decoded.log_id, decoded.actions, decoded.click, decoded.fixation, decoded.long_click))
+
+if __name__ == '__main__':
+    unittest.main()
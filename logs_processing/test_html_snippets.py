@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+#
+#
+# Tests for html_snippets.py.
+
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+
+import bs4
+
+import html_snippets
+
+
+def inline_image(n, c='a'):
+    return 'data:image/svg+xml,' + c * n
+
+
+# Nested and unclosed elements, void elements, stray end tags and scripts.
+SERP_HTML = (u'<html emu_id="e0"><head emu_id="e1"><style emu_id="e2">.g { color: red }\n'
+             u'.rc { margin: 0 }</style><style emu_id="e3"></style></head>\n'
+             u'<body emu_id="e4"><div id="res" class="main wide" emu_id="e5">\n'
+             u'<ol emu_id="e6"><li class="g" emu_id="e7"><div class="rc" emu_id="e8">'
+             u'<a href="http://x" emu_id="e9">\u0442\u0435\u043a\u0441\u0442</a><br emu_id="e10">'
+             u'<p class="st" emu_id="e11">one<p emu_id="e12">two</div></li>\n'
+             u'<li class="g card" emu_id="e13" data-hveid><script emu_id="e14">var x = "<b>";</script>'
+             u'<img src="data:image/png;base64,AAAA" emu_id="e15"/><span id="s1" emu_id="e16">'
+             u'<ul emu_id="e17"><li class="g" emu_id="e18"><em emu_id="e19">x</em></li></ul></b>'
+             u'<div emu_id="e20">unclosed</li>\n'
+             u'<li class="other" emu_id="e21"><span class="st" emu_id="e22">no snippet</span></li>\n'
+             u'<li class="g" emu_id="e23"><table emu_id="e24"><tr emu_id="e25"><td class="t" emu_id="e26">'
+             u'cell</table></ol></div></body></html>\n'
+             u'<li class="g" emu_id="e27"><b emu_id="e28">unclosed until the end')
+
+
+class SerpExtractorTest(unittest.TestCase):
+
+    def test_snippets(self):
+        parsed_html = bs4.BeautifulSoup(SERP_HTML, 'html.parser')
+        expected = parsed_html.find_all(lambda b: b.name == 'li' and 'g' in b.get('class', []))
+        serp = html_snippets.SerpExtractor(SERP_HTML)
+        self.assertEqual(5, len(expected))
+        self.assertEqual([s.encode('utf-8') for s in expected],
+                         [s.encode('utf-8') for s in serp.snippets()])
+        self.assertEqual(sorted(unicode(style.string).encode('utf-8')
+                                for style in parsed_html.find_all('style')),
+                         sorted(unicode(style).encode('utf-8') for style in serp.styles))
+        selectors = set()
+        for snippet in expected:
+            for descendant in itertools.chain([snippet], snippet.descendants):
+                if type(descendant) != bs4.element.Tag or descendant.name == 'script':
+                    continue
+                selectors.update('.' + c for c in descendant.get('class', []))
+                if descendant.get('id') is not None:
+                    selectors.add('#' + descendant['id'])
+        self.assertEqual(selectors, serp.selectors)
+
+    def test_first_tag_attrs(self):
+        for html in [SERP_HTML, u'<li emu_id="e1">x</li>', u'<div class="a  b">' + u'x' * 3000 + u'<li class>']:
+            attrs = html_snippets.first_tag_attrs(html)
+            self.assertEqual(bs4.BeautifulSoup(html, 'html.parser').li.attrs, attrs)
+        self.assertIsNone(html_snippets.first_tag_attrs(u'<div>no items</div>'))
+
+    def test_snippet_emu_ids(self):
+        parsed_html = bs4.BeautifulSoup(SERP_HTML, 'html.parser')
+        serp = html_snippets.SerpExtractor(SERP_HTML)
+        # Including emu_ids of scripts, of elements outside the snippets and unknown ones.
+        for emu_ids in [set('e%d' % i for i in xrange(30)), set(['e7', 'e9', 'e14', 'e19', 'e21', 'e26', 'x']),
+                        set(['e4']), set()]:
+            expected = []
+            for snippet in parsed_html.find_all(lambda b: b.name == 'li' and 'g' in b.get('class', [])):
+                expected.append([d['emu_id'] for d in itertools.chain([snippet], snippet.descendants)
+                                 if type(d) == bs4.element.Tag and d.name != 'script' and d['emu_id'] in emu_ids])
+            self.assertEqual(expected, serp.snippet_emu_ids(emu_ids))
+
+
+def reference_compact_snippet(snippet, max_size):
+    """ compact_snippet() without an image store, encoding the snippet after every removed image. """
+    images = snippet.find_all('img', src=lambda src: src is not None and src.startswith('data:image/'))
+    images = sorted(((len(img.encode('utf-8')), -i, img) for i, img in enumerate(images)), reverse=True)
+    snippet_encoded = snippet.encode('utf-8')
+    for _, _, img in images:
+        if len(snippet_encoded) <= max_size:
+            break
+        del img['src']
+        snippet_encoded = snippet.encode('utf-8')
+    return snippet_encoded
+
+
+class CompactSnippetTest(unittest.TestCase):
+
+    def snippet(self, srcs):
+        html = '<li class="g">%s</li>' % ''.join('<img alt="%d" src="%s"/>' % (i, src)
+                                                 for i, src in enumerate(srcs))
+        return bs4.BeautifulSoup(html, 'html.parser').li
+
+    def remaining(self, snippet_encoded):
+        snippet = bs4.BeautifulSoup(snippet_encoded, 'html.parser')
+        return [int(img['alt']) for img in snippet.find_all('img') if img.get('src')]
+
+    def test_small(self):
+        snippet = self.snippet([inline_image(100)])
+        self.assertEqual(snippet.encode('utf-8'), html_snippets.compact_snippet(snippet, 1000))
+
+    def test_largest_first(self):
+        srcs = [inline_image(300), inline_image(500), inline_image(100), inline_image(500)]
+        size = len(self.snippet(srcs).encode('utf-8'))
+        for max_size, remaining in [(size - 1, [0, 2, 3]), (size - 600, [0, 2]),
+                                    (size - 1200, [2]), (size - 1400, [])]:
+            snippet_encoded = html_snippets.compact_snippet(self.snippet(srcs), max_size)
+            self.assertEqual(remaining, self.remaining(snippet_encoded))
+            if remaining:
+                self.assertLessEqual(len(snippet_encoded), max_size)
+
+    def test_escaped(self):
+        # Every & takes 5 bytes in the encoded snippet.
+        srcs = [inline_image(300, '&'), inline_image(400), inline_image(200, '&')]
+        size = len(self.snippet(srcs).encode('utf-8'))
+        for max_size, remaining in [(size - 1, [1, 2]), (size - 1600, [1]), (size - 2600, [])]:
+            snippet_encoded = html_snippets.compact_snippet(self.snippet(srcs), max_size)
+            self.assertEqual(remaining, self.remaining(snippet_encoded))
+
+    def test_encoded_twice(self):
+        srcs = [inline_image(100 + 10 * i, '&' if i % 3 == 0 else 'a') for i in xrange(50)]
+        snippet = self.snippet(srcs)
+        size = len(snippet.encode('utf-8'))
+        encode = snippet.encode
+        calls = []
+        def counting_encode(*args, **kwargs):
+            calls.append(args)
+            return encode(*args, **kwargs)
+        snippet.encode = counting_encode
+        snippet_encoded = html_snippets.compact_snippet(snippet, size // 2)
+        # Once to measure the snippet and once after removing the images.
+        self.assertEqual(2, len(calls))
+        self.assertLessEqual(len(snippet_encoded), size // 2)
+        self.assertEqual(reference_compact_snippet(self.snippet(srcs), size // 2), snippet_encoded)
+
+    def test_image_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = html_snippets.InlineImageStore(directory, 'http://example.com/')
+            srcs = [inline_image(300), inline_image(2000, 'b')]
+            snippet_encoded = html_snippets.compact_snippet(self.snippet(srcs), 1000, store)
+            snippet = bs4.BeautifulSoup(snippet_encoded, 'html.parser')
+            self.assertEqual(srcs[0], snippet.find(alt='0')['src'])
+            url = snippet.find(alt='1')['src']
+            self.assertTrue(url.startswith('http://example.com/'))
+            with open(os.path.join(directory, url[len('http://example.com/'):])) as f:
+                self.assertEqual('b' * 2000, f.read())
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+#
+# Tests for trec_eval.py.
+
+from collections import defaultdict
+import gzip
+import itertools
+import math
+import os
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import trec_eval
+
+
+# Qrels of one query with two intents as returned by QrelsIndex: marks indexed by
+# the document numbers (0 for the documents without a mark).
+RELS = {'i1': trec_eval.np.array([0, 3, 0, 1, 2], dtype=trec_eval.np.int8),
+        'i2': trec_eval.np.array([0, 0, 2, 0, 1], dtype=trec_eval.np.int8)}
+RANKING = trec_eval.np.array([1, 2, 0, 3, 4])
+
+
+class GetMetricTest(unittest.TestCase):
+
+    def test_uubm_without_click_model(self):
+        # A fresh interpreter where importing pyclick fails.
+        script = '\n'.join([
+                "import sys",
+                "sys.modules['pyclick'] = None",
+                "import numpy as np",
+                "import trec_eval",
+                "rels = {'i': np.array(%r, dtype=np.int8)}" % RELS['i1'].tolist(),
+                "print repr(trec_eval.get_metric('uUBM')(rels, np.array(%r)))" % RANKING.tolist(),
+                "print sorted(m for m in ['click_model', 'pandas', 'scipy', 'sklearn'] if m in sys.modules)",
+        ])
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        value, modules = output.splitlines()
+        self.assertEqual('[]', modules)
+        self.assertAlmostEqual(trec_eval.get_metric('uUBM')({'i': RELS['i1']}, RANKING), float(value))
+
+
+def reference_ASL(x, y, counts):
+    """ The original pure Python ASL with the bootstrap samples given by counts. """
+    n = len(x)
+
+    def t(a):
+        aBar = sum(a) / float(n)
+        aSigma = math.sqrt(sum(1.0 / (n - 1) * (a1 - aBar) ** 2 for a1 in a))
+        if aBar == 0:
+            return 0.0
+        return aBar / aSigma * math.sqrt(n) if aSigma else float('inf')
+
+    z = [p[0] - p[1] for p in zip(x, y)]
+    tZ = abs(t(z))
+    zBar = sum(z) / float(n)
+    w = [z1 - zBar for z1 in z]
+    count = 0
+    for b in xrange(counts.shape[1]):
+        wStar = [w[k] for k in xrange(n) for c in xrange(int(counts[k, b]))]
+        if abs(t(wStar)) >= tZ:
+            count += 1
+    return float(count) / counts.shape[1]
+
+
+class ASLTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = trec_eval.np.random.RandomState(0)
+        # Systems 0-3 are close, 4 is much better, 5 has the same values as 0
+        # and 6 has large values with a small variance.
+        ranks = random_state.uniform(size=(5, 20))
+        ranks[4] += 0.3
+        self.ranks = trec_eval.np.vstack([ranks, ranks[0], 1e8 + ranks[1]])
+        self.counts = trec_eval.bootstrap_counts(20, nsamples=200, random_state=0)
+
+    def test_reference(self):
+        i, j = trec_eval.np.triu_indices(len(self.ranks), 1)
+        asl = trec_eval.pair_ASL(self.ranks, i, j, self.counts)
+        for k in xrange(len(i)):
+            self.assertEqual(reference_ASL(self.ranks[i[k]], self.ranks[j[k]], self.counts), asl[k],
+                             (i[k], j[k]))
+
+    def test_iter_pair_ASL(self):
+        metric_ranks = {'m1': self.ranks, 'm2': self.ranks[::-1] * 2}
+        results = {}
+        for n_jobs in [1, 2]:
+            result = {}
+            for m, i, j, asl in trec_eval.iter_pair_ASL(metric_ranks, self.counts, n_jobs, pairs_per_job=4):
+                result.update(((m, i1, j1), asl1) for i1, j1, asl1 in zip(i, j, asl))
+            results[n_jobs] = result
+        self.assertEqual(results[1], results[2])
+        # All the pairs except (0, 5) in m1 and (1, 6) in m2 are different.
+        self.assertEqual(2 * 21 - 2, len(results[1]))
+        self.assertNotIn(('m1', 0, 5), results[1])
+        self.assertNotIn(('m2', 1, 6), results[1])
+        i, j = trec_eval.np.triu_indices(len(self.ranks), 1)
+        asl = trec_eval.pair_ASL(self.ranks, i, j, self.counts)
+        for i1, j1, asl1 in zip(i, j, asl):
+            self.assertEqual(asl1, results[1].get(('m1', i1, j1), asl1))
+
+
+def write_trec_data(directory, seed=0):
+    """ A fixed qrels file and gzipped runs; returns the qrels file name and the run file names. """
+    rnd = random.Random(seed)
+    docs = ['clueweb-%d' % d for d in xrange(30)]
+    qrels_fname = os.path.join(directory, 'qrels.txt')
+    with open(qrels_fname, 'w') as f:
+        for query_id in ['1', '2', '10']:
+            for intent_id in xrange(1, rnd.randint(2, 4)):
+                for doc in rnd.sample(docs, 12):
+                    print >>f, query_id, intent_id, doc, rnd.choice([-2, 0, 1, 2, 3])
+    run_fnames = []
+    for system in xrange(3):
+        fname = os.path.join(directory, 'input.system%d.gz' % system)
+        with gzip.open(fname, 'w') as f:
+            # Query 3 is not in the qrels.
+            for query_id in ['1', '2', '3', '10']:
+                for rank, doc in enumerate(rnd.sample(docs, rnd.randint(5, 15))):
+                    print >>f, query_id, 'Q0', doc, rank + 1, 10 - rank, 'system%d' % system
+                print >>f
+        run_fnames.append(fname)
+    return qrels_fname, run_fnames
+
+
+def reference_qrels(fname):
+    """ rels[query_id][intent_id][document_id] as read by the original main(). """
+    rels = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: 0.0)))
+    with open(fname) as f:
+        for line in f:
+            query_id, topic_id, document_id, mark = line.rstrip().split()
+            rels[query_id][topic_id][document_id] = mark
+    return rels
+
+
+def reference_run(fname):
+    """ [(query_id, document ids)] as read by the original main(). """
+    with gzip.open(fname) as f:
+        return [(query_id, [l.split()[2] for l in lines]) for (query_id, lines)
+                in itertools.groupby((l for l in f if l.rstrip()), key=lambda line: line.split()[0])]
+
+
+class TrecDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.qrels_fname, self.run_fnames = write_trec_data(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_qrels(self, index):
+        rels = reference_qrels(self.qrels_fname)
+        for query_id in ['1', '2', '3', '10']:
+            doc_numbers = index.doc_numbers(query_id)
+            intents = index[query_id]
+            self.assertEqual(sorted(rels[query_id].keys()), sorted(intents.keys()))
+            for intent_id, marks in intents.iteritems():
+                for doc in ['clueweb-%d' % d for d in xrange(30)]:
+                    self.assertEqual(trec_eval.markToIntRel(rels[query_id][intent_id][doc]),
+                                     marks[doc_numbers.get(doc, 0)])
+
+    def test_qrels_index(self):
+        self.check_qrels(trec_eval.QrelsIndex.from_qrels(self.qrels_fname))
+        # Written to and then read from the binary copy.
+        self.check_qrels(trec_eval.QrelsIndex.load(self.qrels_fname))
+        self.assertTrue(os.path.exists(self.qrels_fname + '.npz'))
+        self.check_qrels(trec_eval.QrelsIndex.load(self.qrels_fname))
+
+    def test_read_runs(self):
+        index = trec_eval.QrelsIndex.from_qrels(self.qrels_fname)
+        rels = reference_qrels(self.qrels_fname)
+        dcg = trec_eval.get_metric('DCG')
+        for n_jobs in [1, 2]:
+            runs = trec_eval.read_runs(self.run_fnames, index, n_jobs)
+            self.assertEqual(len(self.run_fnames), len(runs))
+            for fname, (query_ids, rankings, lengths) in zip(self.run_fnames, runs):
+                expected = reference_run(fname)
+                self.assertEqual([q for q, _ in expected], query_ids)
+                for k, (query_id, doc_list) in enumerate(expected):
+                    doc_numbers = index.doc_numbers(query_id)
+                    top = doc_list[:trec_eval.RANK_DEPTH]
+                    self.assertEqual([doc_numbers.get(d, 0) for d in top], rankings[k, :lengths[k]].tolist())
+                    self.assertAlmostEqual(dcg(rels[query_id], doc_list),
+                                           dcg(index[query_id], rankings[k, :lengths[k]]))
+
+
+class CountingMetricCache(trec_eval.MetricCache):
+    """ MetricCache that counts the computed metric values. """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingMetricCache, self).__init__(*args, **kwargs)
+        self.num_computed = 0
+
+    def lookup(self, metric_name, mark_vectors, compute):
+        def counting_compute(missing):
+            self.num_computed += len(missing)
+            return compute(missing)
+        return super(CountingMetricCache, self).lookup(metric_name, mark_vectors, counting_compute)
+
+
+class CASMetricTest(unittest.TestCase):
+
+    def setUp(self):
+        import click_model
+        self.saved_cache = trec_eval.METRIC_CACHE
+        trec_eval.METRIC_CACHE = CountingMetricCache(100)
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'CAST.params')
+        random_state = trec_eval.np.random.RandomState(0)
+        self.params = click_model.CAS.initial_guess() + random_state.normal(
+                size=len(click_model.CAS.initial_guess()))
+        with open(self.fname, 'w') as f:
+            pickle.dump(self.params, f)
+
+    def tearDown(self):
+        trec_eval.METRIC_CACHE = self.saved_cache
+        shutil.rmtree(self.directory)
+
+    def test_cached_values(self):
+        import click_model
+        import create_tasks
+        for use_sat in [True, False]:
+            metric = trec_eval.CASModelFromFile(self.fname, use_sat)
+            cas = click_model.CAS(trec_eval.MARK_TO_INT_REL_DICT, use_D=False, trec_style=True,
+                                  sat_term_weight=1 if use_sat else 0)
+            serp = [click_model.Snippet(emup='372;16;842;496;147', cas_item_type=None, is_complex=False)
+                    for doc in RANKING]
+            expected = sum(cas.utility(self.params, [create_tasks.LogItem(m) for m in rels[RANKING]], serp)
+                           for rels in RELS.itervalues()) / len(RELS)
+            num_computed = trec_eval.METRIC_CACHE.num_computed
+            value = metric(RELS, RANKING)
+            self.assertEqual(num_computed + 2, trec_eval.METRIC_CACHE.num_computed)
+            self.assertAlmostEqual(expected, value)
+            # The second call only reads the cache.
+            self.assertEqual(value, metric(RELS, RANKING))
+            self.assertEqual(num_computed + 2, trec_eval.METRIC_CACHE.num_computed)
+
+
+if __name__ == '__main__':
+    unittest.main()
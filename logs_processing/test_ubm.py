@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+#
+# Tests for ubm.py.
+
+import itertools
+import math
+import unittest
+
+import numpy as np
+
+from ubm import UBM_GAMMAS, UBM_RELS, ubm_full_click_probs, uubm_click_probs
+
+
+def prod(l):
+    return math.exp(sum(math.log(x) for x in l))
+
+
+def reference_uubm_click_probs(alpha):
+    """ The click probabilities as computed by the original uUBM metric. """
+    p = [1.0]
+    for rank in xrange(len(alpha)):
+        p.append(alpha[rank] * sum(
+                p[j] * UBM_GAMMAS[rank][j] *
+                    prod((1 - alpha[k] * UBM_GAMMAS[k][j]) for k in xrange(j, rank)) for j in xrange(rank + 1)))
+    return p[1:]
+
+
+def enumerated_click_probs(p_click):
+    """ Marginal click probabilities by enumerating all the click patterns
+        of one ranking given the (L x (L + 1)) click probabilities.
+    """
+    L = len(p_click)
+    result = np.zeros(L)
+    for clicks in itertools.product([False, True], repeat=L):
+        p = 1.0
+        prev = 0
+        for rank, click in enumerate(clicks):
+            p *= p_click[rank][prev] if click else 1 - p_click[rank][prev]
+            if click:
+                prev = rank + 1
+        result += p * np.array(clicks)
+    return result
+
+
+class UBMTest(unittest.TestCase):
+
+    def test_uubm_click_probs(self):
+        marks = [[3, 0, 1, 2, 0, 0, 3, 1, 0, 2], [0] * 10, [3] * 10, [1, 2, 0], [2]]
+        for m in marks:
+            alpha = [UBM_RELS[x] for x in m]
+            np.testing.assert_allclose(uubm_click_probs(np.array([alpha]))[0],
+                                       reference_uubm_click_probs(alpha))
+
+    def test_ubm_full_click_probs(self):
+        random_state = np.random.RandomState(0)
+        p_click = random_state.uniform(size=(3, 6, 7))
+        full = ubm_full_click_probs(p_click)
+        for k in xrange(len(p_click)):
+            np.testing.assert_allclose(full[k], enumerated_click_probs(p_click[k]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,31 +16,35 @@
 #
 ################################################################################
 #
-# Code to compute discriminative power (if USE_PYPE == True) or correlations
-# between different evaluation metrics (if USE_PYPE == False) using TREC data.
+# Code to compute discriminative power (if COMPUTE_DISC_POWER == True) or correlations
+# between different evaluation metrics (if COMPUTE_DISC_POWER == False) using TREC data.
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+import argparse
 import glob
 import gzip
+import hashlib
 import itertools
+import os
 import math
+import multiprocessing
 import pickle
-import random
-import threading
 import sys
-from Queue import Queue
 
+import numpy as np
 
-try:
-  import __pypy__
-  USE_PYPY = True
-except ImportError:
-  USE_PYPY = False
+from ubm import UBM_RELS, uubm_click_probs
 
-USE_PYPY = True
+
+COMPUTE_DISC_POWER = True
 
 DETAILED_LOG = False
 
+# Number of worker processes for reading the runs and computing discriminative power
+# (None for the number of CPUs) and the number of system pairs in one job.
+N_JOBS = None
+PAIRS_PER_JOB = 2000
+
 MAX_MARK = 3
 
 RANK_DEPTH = 10
@@ -49,56 +53,15 @@ assert RANK_DEPTH <= 10
 #METRICS = ['CAST', 'CASTnoreg', 'CASTnosat', 'CASTnosatnoreg', 'UBM', 'PBM', 'DCG', 'uUBM']
 METRICS = ['CAST', 'CASTnoreg', 'CASTnosat', 'CASTnosatnoreg']
 
+# Max number of memoized metric values (see MetricCache) and the file
+# to keep them between the runs (None to keep them in memory only).
+METRIC_CACHE_SIZE = 10 ** 6
+METRIC_CACHE_FILE = None
 
-################################################################################
-# Params used in uUBM metric in
-# Chuklin, A., Serdyukov, P., & de Rijke, M. (2013).
-# Click model-based information retrieval metrics. In SIGIR (pp. 493--502)
-# http://doi.org/10.1145/2484028.2484071
-UBM_GAMMAS = """
-0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  1.0000
-0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.6980  0.0029
-0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.6483  0.0023  0.0106
-0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.5461  0.0032  0.0082  0.0263
-0.0000  0.0000  0.0000  0.0000  0.0000  0.5747  0.0042  0.0101  0.0215  0.0305
-0.0000  0.0000  0.0000  0.0000  0.4816  0.0067  0.0179  0.0280  0.0303  0.0599
-0.0000  0.0000  0.0000  0.5670  0.0099  0.0248  0.0476  0.0434  0.0620  0.0917
-0.0000  0.0000  0.5410  0.0187  0.0426  0.0716  0.0713  0.0826  0.0813  0.1518
-0.0000  0.8951  0.0331  0.0794  0.1242  0.1210  0.1449  0.1268  0.1559  0.1901
-0.9921  0.1199  0.2395  0.3230  0.3004  0.3107  0.3018  0.3212  0.3221  0.4149
-"""
-
-gammas = [[0.0 for j in xrange(10)] for k in xrange(10)]
-
-m = 0
-for line in UBM_GAMMAS.split('\n'):
-    line = line.strip()
-    if not line:
-        continue
-    n = 0
-    for item in line.split():
-        if not item:
-            continue
-        if n + m >= 9:
-            gammas[n][n + m - 9] = float(item)
-        n += 1
-    m += 1
-
-UBM_GAMMAS = gammas
-del gammas
-
-
-UBM_RELS = """
-IRRELEVANT      0.491912
-RELEVANT        0.570803
-USEFUL  0.695883
-VITAL   0.931482
-"""
-
-UBM_RELS = [float(x.split()[-1]) for x in UBM_RELS.split('\n') if x]
+
+# Params of the uUBM metric (see ubm.py).
 assert len(UBM_RELS) == MAX_MARK + 1
 
-################################################################################
 
 def markToIntRel(mark):
     mark = int(mark)
@@ -125,19 +88,6 @@ def avg(l):
     return float(s) / n if n else 0.0
 
 
-def prod(l):
-    return math.exp(sum(math.log(x) for x in l))
-
-
-def frac(x, y):
-    if x == 0:
-        return 0.0
-    if y == 0:
-        return float('inf')
-    else:
-        return float(x) / y
-
-
 def systemName(fileName):
     return fileName.split('/')[-1].split('.', 1)[-1]
 
@@ -153,53 +103,134 @@ def intent_aware(func):
 # end decorator
 
 
+def mark_vector(rels, doc_list):
+    """ Relevance marks of the top RANK_DEPTH documents for one intent. """
+    if isinstance(rels, np.ndarray):
+        # Marks from QrelsIndex indexed by document numbers.
+        return tuple(rels[doc_list[:RANK_DEPTH]].tolist())
+    return tuple(markToIntRel(rels[doc]) for doc in doc_list[:RANK_DEPTH])
+
+
+class MetricCache(object):
+    """ Metric values memoized by the metric name and the mark vector
+        (see mark_vector()) they were computed for.
+
+        When there are more than max_size values the least recently used
+        ones are evicted. If file_name is given, the values are read from
+        it (if it exists) and written to it by save().
+    """
+
+    def __init__(self, max_size, file_name=None):
+        self.max_size = max_size
+        self.file_name = file_name
+        self.values = OrderedDict()
+        if file_name is not None and os.path.exists(file_name):
+            with open(file_name, 'rb') as f:
+                self.values = pickle.load(f)
+            self._evict()
+
+    def _evict(self):
+        while len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+
+    def lookup(self, metric_name, mark_vectors, compute):
+        """ Values of the metric for the mark vectors; compute(mark_vectors)
+            is called for the ones that are not in the cache and should return
+            the list of their values.
+        """
+        keys = [(metric_name, m) for m in mark_vectors]
+        missing = list(OrderedDict.fromkeys(k for k in keys if k not in self.values))
+        if missing:
+            for key, value in zip(missing, compute([m for _, m in missing])):
+                self.values[key] = value
+        result = []
+        for key in keys:
+            value = self.values.pop(key)    # move to the end as the most recently used one
+            self.values[key] = value
+            result.append(value)
+        self._evict()
+        return result
+
+    def save(self):
+        if self.file_name is not None:
+            with open(self.file_name, 'wb') as f:
+                pickle.dump(self.values, f, pickle.HIGHEST_PROTOCOL)
+
+METRIC_CACHE = MetricCache(METRIC_CACHE_SIZE, METRIC_CACHE_FILE)
+
+
+# decorator
+def cached_intent_aware(metric_name):
+    """ Same as intent_aware for a function that computes the metric values
+        for a list of mark vectors (one per intent). The values are memoized
+        in METRIC_CACHE under metric_name.
+    """
+    def decorator(func):
+        def func1(rels, doc_list):
+            intents = rels.keys()
+            N = len(intents)
+            if not N:
+                return 0
+            return sum(METRIC_CACHE.lookup(
+                    metric_name, [mark_vector(rels[i], doc_list) for i in intents], func)) / N
+        return func1
+    return decorator
+# end decorator
+
+
+def params_file_metric_name(fname):
+    """ Name of a metric with parameters read from fname for METRIC_CACHE. """
+    with open(fname, 'rb') as f:
+        return '%s:%s' % (fname, hashlib.md5(f.read()).hexdigest())
+
+
 def __DCG(rels, doc_list):
     return sum(float(markToRelDcg(rels[doc])) / math.log(k + 2, 2) for (k, doc) in enumerate(doc_list[:RANK_DEPTH]))
 
 DCG = intent_aware(__DCG)
 
-@intent_aware
-def uUBM(rels, doc_list):
-    p = [1.0]
-    s = 0.0
-    alpha = [markToRelUbm(rels[doc]) for doc in doc_list[:RANK_DEPTH]]
-    for rank, doc in enumerate(doc_list[:RANK_DEPTH]):
-        p.append(alpha[rank] * sum(p[j] * UBM_GAMMAS[rank][j] * prod((1 - alpha[k] * UBM_GAMMAS[k][j]) for k in xrange(j, rank)) for j in xrange(rank + 1)))
-        s += p[-1] * markToRelDcg(rels[doc])
-    return s
+@cached_intent_aware('uUBM')
+def uUBM(mark_vectors):
+    # All the mark vectors have the same length, so they are evaluated in one batch.
+    L = len(mark_vectors[0])
+    alpha = np.array([[markToRelUbm(m) for m in marks] for marks in mark_vectors]).reshape(len(mark_vectors), L)
+    gains = np.array([[markToRelDcg(m) for m in marks] for marks in mark_vectors]).reshape(len(mark_vectors), L)
+    return list((gains * uubm_click_probs(alpha)).sum(axis=1))
 
 
 ############################### CAS paper ############################################
-from pyclick.click_models.PBM import PBM as pyclick_PBM
-from pyclick.click_models.UBM import UBM as pyclick_UBM
-
-import click_model
-import create_tasks
-
-assert click_model.RelContainer.grades_R == MAX_MARK + 1
+# These metrics import click_model (and with it pandas, scipy and sklearn) and
+# read their parameter files only when they are first used (see get_metric()).
 
 class MarkToIntRelDict(dict):
     def __missing__(self, key):
+        import click_model
         rel = click_model.RelContainer()
         rel.Rs.append((markToIntRel(key), 1))
         return rel
 MARK_TO_INT_REL_DICT = MarkToIntRelDict()
 
 
-FAKE_SERP = [{'emup': '372;16;842;496;147', 'class': [u'g']} for i in xrange(RANK_DEPTH)]
+def fake_serp():
+    """ RANK_DEPTH snippets in one column. Only their emup is used by the trec_style CAS. """
+    import click_model
+    return [click_model.Snippet(emup='372;16;842;496;147', cas_item_type=None, is_complex=False)
+            for i in xrange(RANK_DEPTH)]
+
+
 def CASModelFromFile(fname, use_sat=True):
+    import click_model
+    import create_tasks
+    assert click_model.RelContainer.grades_R == MAX_MARK + 1
     with open(fname) as f:
         _CAS_params = pickle.load(f)
     _CAS = click_model.CAS(MARK_TO_INT_REL_DICT, use_D=False, trec_style=True, sat_term_weight=1 if use_sat else 0)
-    def metric(rels, doc_list):
-        session = [create_tasks.LogItem(rels[doc]) for doc in doc_list[:RANK_DEPTH]]
-        return _CAS.utility(_CAS_params, session, FAKE_SERP)
-    return intent_aware(metric)
-
-CAST = CASModelFromFile('CAST.params')
-CASTnoreg = CASModelFromFile('CASTnoreg.params')
-CASTnosat = CASModelFromFile('CASTnosat.params')
-CASTnosatnoreg = CASModelFromFile('CASTnosatnoreg.params')
+    serp = fake_serp()
+    @cached_intent_aware('%s:%s' % (params_file_metric_name(fname), use_sat))
+    def metric(mark_vectors):
+        return [_CAS.utility(_CAS_params, [create_tasks.LogItem(m) for m in marks], serp)
+                for marks in mark_vectors]
+    return metric
 
 
 def pyclick_params_to_model(model_class, params):
@@ -207,128 +238,355 @@ def pyclick_params_to_model(model_class, params):
     model.params = {model.param_names.attr: params['attr'], model.param_names.exam: params['exam']}
     return model
 
-with open('UBM.params') as f:
-    _UBM_pyclick_model = pyclick_params_to_model(pyclick_UBM, pickle.load(f))
-_UBM = click_model.PyClickModel('UBM', MARK_TO_INT_REL_DICT)
-@intent_aware
-def UBM(rels, doc_list):
-    session = [create_tasks.LogItem(rels[doc]) for doc in doc_list[:RANK_DEPTH]]
-    return _UBM.utility(_UBM_pyclick_model, session, FAKE_SERP)
-
-with open('PBM.params') as f:
-    _PBM_pyclick_model = pyclick_params_to_model(pyclick_PBM, pickle.load(f))
-_PBM = click_model.PyClickModel('PBM', MARK_TO_INT_REL_DICT)
-@intent_aware
-def PBM(rels, doc_list):
-    session = [create_tasks.LogItem(rels[doc]) for doc in doc_list[:RANK_DEPTH]]
-    return _PBM.utility(_PBM_pyclick_model, session, FAKE_SERP)
+
+def ClickModelFromFile(model_name, fname):
+    """ PBM or UBM with the parameters exported by EMClickModel.export_params()
+        or, in the old format, by pyclick.
+    """
+    import click_model
+    import create_tasks
+    assert click_model.RelContainer.grades_R == MAX_MARK + 1
+    with open(fname) as f:
+        params = pickle.load(f)
+    if 'model_name' in params:
+        assert params['model_name'] == model_name, (params['model_name'], model_name)
+        _click_model = click_model.EMClickModel.from_params(params)
+    else:
+        from pyclick.click_models.PBM import PBM as pyclick_PBM
+        from pyclick.click_models.UBM import UBM as pyclick_UBM
+        _click_model = pyclick_params_to_model(
+                {'PBM': pyclick_PBM, 'UBM': pyclick_UBM}[model_name], params)
+    _model = click_model.ClickModel(model_name, MARK_TO_INT_REL_DICT)
+    @cached_intent_aware(params_file_metric_name(fname))
+    def metric(mark_vectors):
+        return [_model.utility(_click_model, [create_tasks.LogItem(m) for m in marks], None)
+                for marks in mark_vectors]
+    return metric
 
 ############################### CAS paper end ############################################
 
+# Functions that create the metrics by name (see get_metric()). DCG and uUBM
+# only need NumPy; the other metrics import click_model.
+METRIC_FACTORIES = {
+    'CAST': lambda: CASModelFromFile('CAST.params'),
+    'CASTnoreg': lambda: CASModelFromFile('CASTnoreg.params'),
+    'CASTnosat': lambda: CASModelFromFile('CASTnosat.params'),
+    'CASTnosatnoreg': lambda: CASModelFromFile('CASTnosatnoreg.params'),
+    'UBM': lambda: ClickModelFromFile('UBM', 'UBM.params'),
+    'PBM': lambda: ClickModelFromFile('PBM', 'PBM.params'),
+    'DCG': lambda: DCG,
+    'uUBM': lambda: uUBM,
+}
+
+_METRIC_FUNCTIONS = {}
+
+
+def get_metric(metric_name):
+    """ The metric function (rels, doc_list) -> value, created on first use. """
+    if metric_name not in _METRIC_FUNCTIONS:
+        _METRIC_FUNCTIONS[metric_name] = METRIC_FACTORIES[metric_name]()
+    return _METRIC_FUNCTIONS[metric_name]
+
+def bootstrap_counts(n, nsamples=1000, random_state=None):
+    """ Draw nsamples bootstrap samples of n queries and return the (n x nsamples)
+        matrix of the number of times each query is drawn in each sample.
+        The same matrix can be used for all the pairs of systems and metrics.
+    """
+    random_state = np.random.RandomState(random_state)
+    indices = random_state.randint(n, size=(nsamples, n))
+    counts = np.zeros((n, nsamples))
+    np.add.at(counts, (indices, np.arange(nsamples)[:, np.newaxis]), 1)
+    return counts
+
+
+def _t(mean, sq_dev, n):
+    """ t-statistics given the means of the samples and the sums of squared deviations
+        from them (same as t() in the pure Python ASL: 0 for zero mean, inf for zero variance).
+    """
+    aSigma = np.sqrt(sq_dev / (n - 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = mean / aSigma * math.sqrt(n)
+    return np.where(mean == 0, 0.0, np.where(aSigma == 0, np.inf, t))
+
+
+# Max size of the (pairs x nQueries x nSamples) blocks in pair_ASL().
+ASL_BLOCK_SIZE = 10 ** 7
+
+
+def pair_ASL(ranks, i, j, counts):
+    """ Compute achieved significance level (ASL) for the pairs of systems (i[k], j[k]).
+            ranks -- (nSystems x nQueries) matrix of metric values
+            counts -- bootstrap samples (see bootstrap_counts())
+        [1] Sakai, T. 2006. Evaluating evaluation metrics based on the bootstrap. SIGIR 2006
+    """
+    n = ranks.shape[1]
+    z = ranks[i] - ranks[j]
+    zBar = z.mean(axis=1)
+    w = z - zBar[:, np.newaxis]
+    tZ = np.abs(_t(zBar, (w ** 2).sum(axis=1), n))
+    # The bootstrap samples of w are the values of w weighted by the counts.
+    wBar = w.dot(counts) / n
+    wSqDev = np.empty_like(wBar)
+    block_size = max(1, ASL_BLOCK_SIZE // counts.size)
+    for start in xrange(0, len(w), block_size):
+        block = slice(start, start + block_size)
+        wSqDev[block] = (counts * (w[block, :, np.newaxis] - wBar[block, np.newaxis, :]) ** 2).sum(axis=1)
+    tStar = np.abs(_t(wBar, wSqDev, n))
+    return (tStar >= tZ[:, np.newaxis]).mean(axis=1)
+
+
 def ASL(x, y, nsamples=1000):
     """ Compute achieved significance level (ASL).
             x -- vector of metric values for sytem X
             y -- vector of metric values for sytem Y
-        [1] Sakai, T. 2006. Evaluating evaluation metrics based on the bootstrap. SIGIR 2006
     """
     n = len(x)
     assert n == len(y)
+    return pair_ASL(np.array([x, y], dtype=float), [0], [1], bootstrap_counts(n, nsamples))[0]
 
-    def t(a):
-        aBar = avg(a)
-        aSigma = math.sqrt(sum(1.0 / (n - 1) * (a1 - aBar) ** 2 for a1 in a))
-        return frac(aBar, aSigma) * math.sqrt(n)
 
-    z = [p[0] - p[1] for p in zip(x, y)]
-    tZ = abs(t(z))
-    zBar = avg(z)
-    w = [z1 - zBar for z1 in z]
-    count = 0
-    for b in xrange(nsamples):
-        wStar = [random.choice(w) for i in xrange(n)]
-        if abs(t(wStar)) >= tZ:
-            count += 1
-    return float(count) / nsamples
+def _different_pairs(ranks, i, j):
+    """ The pairs of systems (i[k], j[k]) with different metric values. """
+    differ = ~(ranks[i] == ranks[j]).all(axis=1)
+    return i[differ], j[differ]
 
 
-if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print >>sys.stderr, 'Usage: {0:s} qrels_file directory_with_trec_results'.format(sys.argv[0])
-        sys.exit(1)
+# Arguments of _pair_ASL_job() set before the process pool is started,
+# so the forked workers inherit them instead of receiving a pickled copy.
+_PAIR_ASL = {}
+
+
+def _pair_ASL_job(job):
+    metric, i, j = job
+    ranks = _PAIR_ASL['metric_ranks'][metric]
+    i, j = _different_pairs(ranks, i, j)
+    return metric, i, j, pair_ASL(ranks, i, j, _PAIR_ASL['counts'])
+
+
+def iter_pair_ASL(metric_ranks, counts, n_jobs=None, pairs_per_job=PAIRS_PER_JOB):
+    """ Compute ASL for all the pairs of systems with different metric values.
 
-    random.seed()
+        metric_ranks -- dict metric_name -> (nSystems x nQueries) matrix of metric values
+        counts -- bootstrap samples (see bootstrap_counts())
+        n_jobs -- number of worker processes (default: number of CPUs);
+            with n_jobs=1 everything runs in the current process.
+        The (metric, pair) space is split into jobs of pairs_per_job pairs; yields
+        (metric_name, i, j, asl) arrays for every job in the order they are done.
+    """
+    metric_ranks = dict((m, np.asarray(r, dtype=float)) for m, r in metric_ranks.iteritems())
+    jobs = []
+    for m, ranks in metric_ranks.iteritems():
+        i, j = np.triu_indices(len(ranks), 1)
+        for start in xrange(0, len(i), pairs_per_job):
+            jobs.append((m, i[start:start + pairs_per_job], j[start:start + pairs_per_job]))
+    _PAIR_ASL.update(metric_ranks=metric_ranks, counts=counts)
+    try:
+        if n_jobs == 1:
+            for job in jobs:
+                yield _pair_ASL_job(job)
+        else:
+            pool = multiprocessing.Pool(n_jobs)
+            try:
+                for result in pool.imap_unordered(_pair_ASL_job, jobs):
+                    yield result
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        _PAIR_ASL.clear()
+
+
+class QrelsIndex(object):
+    """ Marks (see markToIntRel()) from a qrels file with integer-numbered
+        queries, intents and documents.
+
+        The judged documents of query q are doc_ids[doc_offsets[q]:doc_offsets[q + 1]];
+        a document is referred to by its position in this list plus one (see doc_numbers()),
+        0 is used for the documents without a mark. The intents of query q are the blocks
+        block_offsets[q]..block_offsets[q + 1] - 1; the marks of block b are
+        marks[mark_offsets[b]:mark_offsets[b + 1]] indexed by the document numbers.
+    """
 
-    # rels[query_id][intent_id][document_id]
-    rels = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: 0.0)))
-    with open(sys.argv[1]) as f:
-        for line in f:
-            query_id, topic_id, document_id, mark = line.rstrip().split()
-            rels[query_id][topic_id][document_id] = mark
+    arrays = ['query_ids', 'doc_ids', 'doc_offsets', 'intent_ids', 'block_offsets',
+              'mark_offsets', 'marks']
+
+    def __init__(self, arrays):
+        for name in self.arrays:
+            setattr(self, name, arrays[name])
+        self.query_numbers = dict((query_id, q) for q, query_id in enumerate(self.query_ids.tolist()))
+        self._doc_numbers = {}
+
+    @classmethod
+    def from_qrels(cls, fname):
+        marks = OrderedDict()      # query_id -> intent_id -> document_id -> mark
+        doc_ids = OrderedDict()    # query_id -> document_id -> number
+        with open(fname) as f:
+            for line in f:
+                query_id, topic_id, document_id, mark = line.rstrip().split()
+                docs = doc_ids.setdefault(query_id, OrderedDict())
+                docs.setdefault(document_id, len(docs) + 1)
+                marks.setdefault(query_id, OrderedDict()).setdefault(topic_id, {})[docs[document_id]] = \
+                        markToIntRel(mark)
+        intent_ids = []
+        block_offsets = [0]
+        mark_offsets = [0]
+        mark_blocks = []
+        for query_id, intents in marks.iteritems():
+            for topic_id, doc_marks in intents.iteritems():
+                block = np.zeros(len(doc_ids[query_id]) + 1, dtype=np.int8)
+                block[doc_marks.keys()] = doc_marks.values()
+                intent_ids.append(topic_id)
+                mark_blocks.append(block)
+                mark_offsets.append(mark_offsets[-1] + len(block))
+            block_offsets.append(len(intent_ids))
+        return cls({
+            'query_ids': np.array(marks.keys(), dtype=str),
+            'doc_ids': np.array([d for docs in doc_ids.itervalues() for d in docs], dtype=str),
+            'doc_offsets': np.cumsum([0] + [len(docs) for docs in doc_ids.itervalues()]),
+            'intent_ids': np.array(intent_ids, dtype=str),
+            'block_offsets': np.array(block_offsets),
+            'mark_offsets': np.array(mark_offsets),
+            'marks': np.concatenate(mark_blocks) if mark_blocks else np.zeros(0, dtype=np.int8),
+        })
+
+    @classmethod
+    def load(cls, fname):
+        """ Read the qrels file or its binary copy fname + '.npz' if it is up to date;
+            the copy is (re)written otherwise.
+        """
+        cache_fname = fname + '.npz'
+        if os.path.exists(cache_fname) and os.path.getmtime(cache_fname) >= os.path.getmtime(fname):
+            with np.load(cache_fname) as npz:
+                return cls(dict((name, npz[name]) for name in cls.arrays))
+        index = cls.from_qrels(fname)
+        np.savez(cache_fname, **dict((name, getattr(index, name)) for name in cls.arrays))
+        return index
+
+    def __getitem__(self, query_id):
+        """ dict intent_id -> marks indexed by the document numbers (empty for unknown queries). """
+        q = self.query_numbers.get(query_id)
+        if q is None:
+            return {}
+        return dict((self.intent_ids[b], self.marks[self.mark_offsets[b]:self.mark_offsets[b + 1]])
+                    for b in xrange(self.block_offsets[q], self.block_offsets[q + 1]))
+
+    def doc_numbers(self, query_id):
+        """ dict document_id -> document number for the judged documents of the query. """
+        if query_id not in self._doc_numbers:
+            q = self.query_numbers.get(query_id)
+            doc_ids = [] if q is None else self.doc_ids[self.doc_offsets[q]:self.doc_offsets[q + 1]].tolist()
+            self._doc_numbers[query_id] = dict((d, k + 1) for k, d in enumerate(doc_ids))
+        return self._doc_numbers[query_id]
+
+
+# Arguments of read_run() set before the process pool is started (see _PAIR_ASL).
+_RUN_READER = {}
+
+
+def read_run(fname):
+    """ Read a gzipped TREC run with the document numbers from _RUN_READER['qrels'].
+
+        Returns (query_ids, rankings, lengths): rankings[k, :lengths[k]] are the numbers
+        of the top RANK_DEPTH documents for query_ids[k] (see QrelsIndex).
+    """
+    qrels = _RUN_READER['qrels']
+    query_ids = []
+    rankings = []
+    with gzip.open(fname) as f:
+        for query_id, lines in itertools.groupby(
+                (l.split() for l in f if l.rstrip()), key=lambda fields: fields[0]):
+            docs = qrels.doc_numbers(query_id)
+            query_ids.append(query_id)
+            rankings.append([docs.get(fields[2], 0) for fields in itertools.islice(lines, RANK_DEPTH)])
+    lengths = np.array([len(r) for r in rankings], dtype=np.int32)
+    ranking_array = np.zeros((len(rankings), RANK_DEPTH), dtype=np.int32)
+    for k, r in enumerate(rankings):
+        ranking_array[k, :len(r)] = r
+    return query_ids, ranking_array, lengths
+
+
+def read_runs(fnames, qrels, n_jobs=None):
+    """ read_run() for every file on a process pool of n_jobs workers
+        (default: number of CPUs; with n_jobs=1 everything runs in the current process).
+    """
+    _RUN_READER.update(qrels=qrels)
+    try:
+        if n_jobs == 1:
+            return [read_run(fname) for fname in fnames]
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            runs = pool.map(read_run, fnames)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return runs
+    finally:
+        _RUN_READER.clear()
 
-    inputFiles = glob.glob('{0:s}/input.*.gz'.format(sys.argv[2]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Compute discriminative power of or correlations between '
+                    'the metrics using TREC data')
+    parser.add_argument('qrels_file')
+    parser.add_argument('directory_with_trec_results')
+    parser.add_argument('--metrics',
+            help='Comma-separated metric names out of %s (default: %s)' % (
+                    ', '.join(sorted(METRIC_FACTORIES)), ','.join(METRICS)),
+            default=','.join(METRICS))
+    args = parser.parse_args()
+
+    METRICS = args.metrics.split(',')
+    for m in METRICS:
+        if m not in METRIC_FACTORIES:
+            parser.error('unknown metric: %s' % m)
+
+    # rels[query_id][intent_id][document number]
+    rels = QrelsIndex.load(args.qrels_file)
+
+    inputFiles = glob.glob('{0:s}/input.*.gz'.format(args.directory_with_trec_results))
+    runs = read_runs(inputFiles, rels, N_JOBS)
     metricRanks = defaultdict(lambda: [])   # metric_name -> avg system scores (for all systems)
     metricRanksDetailed = defaultdict(lambda: [])   # metric_name -> system_num -> query_id -> score
-    for filename in inputFiles:
-        with gzip.open(filename) as f:
-            #           query_id  doc_ids
-            #               |       |
-            #               |       |
-            #               v       v
-            rankings = [(query_id, [l.split()[2] for l in lines]) for (query_id, lines) \
-                    in itertools.groupby((l for l in f if l.rstrip()), key=lambda line: line.split()[0])]
-            for m in METRICS:
-                metricFunction = globals()[m]
-                ranks = [metricFunction(rels[l[0]], l[1]) for l in rankings]
-                metricRanks[m].append(avg(ranks))
-                # print [x[0] for x in rankings] #       <----   we assume that query order is the same for all systems
-                metricRanksDetailed[m].append(ranks)
+    for m in METRICS:
+        metricFunction = get_metric(m)
+        for query_ids, rankings, lengths in runs:
+            ranks = [metricFunction(rels[query_id], rankings[k, :lengths[k]])
+                     for k, query_id in enumerate(query_ids)]
+            metricRanks[m].append(avg(ranks))
+            # print query_ids #       <----   we assume that query order is the same for all systems
+            metricRanksDetailed[m].append(ranks)
+    METRIC_CACHE.save()
 
     #print >>sys.stderr, '\t'.join(str(avg(c[i] for c in EBU_CLICK_PROBS)) for i in xrange(RANK_DEPTH))
     print >>sys.stderr, 'Finish reading the data'
 
-    if USE_PYPY:
-        # This branch would be too slow w/o PyPy
-        nSystems = len(inputFiles)
-        taskQueue = Queue()
-        resultQueue = Queue()
-
-        def calcDiscPower():
-            m1 = taskQueue.get()
-            detailedRanks = metricRanksDetailed[m1]
-            differ = 0
-            count = 0
-            if DETAILED_LOG:
-                logFile = open('logs/' + m1 + '.log', 'w')
-            for i in xrange(nSystems):
-                for j in xrange(i + 1, nSystems):
-                    s1 = detailedRanks[i]
-                    s2 = detailedRanks[j]
-                    if s1 == s2:
-                        continue
-                    asl = ASL(s1, s2)
-                    if asl < 0.05:
-                        differ += 1
-                    elif DETAILED_LOG:
-                        print >>logFile, 'COLLISION:', m1, 'ASL:', asl, \
-                            '{0:s} ({1:f})'.format(systemName(inputFiles[i]), metricRanks[m1][i]), \
-                            '{0:s} ({1:f})'.format(systemName(inputFiles[j]), metricRanks[m1][j])
-                    count += 1
+    if COMPUTE_DISC_POWER:
+        # The same bootstrap samples are used for all the metrics and pairs of systems.
+        counts = bootstrap_counts(len(metricRanksDetailed[METRICS[0]][0]))
+        differ = defaultdict(lambda: 0)
+        significant = defaultdict(lambda: 0)
+        if DETAILED_LOG:
+            logFiles = dict((m, open('logs/' + m + '.log', 'w')) for m in METRICS)
+        for m1, i, j, asl in iter_pair_ASL(
+                dict((m, metricRanksDetailed[m]) for m in METRICS), counts, N_JOBS):
+            differ[m1] += len(asl)
+            significant[m1] += (asl < 0.05).sum()
             if DETAILED_LOG:
+                for i1, j1, asl1 in zip(i, j, asl):
+                    if asl1 >= 0.05:
+                        print >>logFiles[m1], 'COLLISION:', m1, 'ASL:', asl1, \
+                            '{0:s} ({1:f})'.format(systemName(inputFiles[i1]), metricRanks[m1][i1]), \
+                            '{0:s} ({1:f})'.format(systemName(inputFiles[j1]), metricRanks[m1][j1])
+        if DETAILED_LOG:
+            for logFile in logFiles.itervalues():
                 logFile.close()
-            resultQueue.put('discriminative_power({0:s}) = {1:f}'.format(m1, float(differ) / count))
-
-        workers = []
-        for m in METRICS:
-            taskQueue.put(m)
-            t = threading.Thread(target=calcDiscPower)
-            workers.append(t)
-            t.start()
-
-        for w in workers:
-            w.join()
-            print >>sys.stderr, resultQueue.get()
+        for m1 in METRICS:
+            print >>sys.stderr, 'discriminative_power({0:s}) = {1:f}'.format(
+                    m1, float(significant[m1]) / differ[m1])
     else:
-        # We can't import these w/ PyPy
         import scipy
         import scipy.stats
         print '\\begin{{tabular}}{{{0:s}}}'.format(''.join('c' for m in xrange(len(METRICS))))
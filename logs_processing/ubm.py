@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+#
+# UBM click probabilities and the parameters of the uUBM metric. This module
+# only depends on NumPy, so that trec_eval.py can compute uUBM without
+# importing click_model.py.
+
+import numpy as np
+
+
+def ubm_full_click_probs(p_click):
+    """ Click probabilities not conditioned on the clicks given the (N x L x (L + 1))
+        array of click probabilities for each rank and previous click rank
+        (0 for no click above, rank of the last click plus one otherwise).
+    """
+    N, L = p_click.shape[:2]
+    # Probability that the last click above the current rank is at a given rank.
+    p_prev = np.zeros((N, L + 1))
+    p_prev[:, 0] = 1
+    full_click_probs = np.zeros((N, L))
+    for rank in xrange(L):
+        full_click_probs[:, rank] = (p_prev * p_click[:, rank]).sum(axis=1)
+        p_prev *= 1 - p_click[:, rank]
+        p_prev[:, rank + 1] = full_click_probs[:, rank]
+    return full_click_probs
+
+
+# Params used in uUBM metric in
+# Chuklin, A., Serdyukov, P., & de Rijke, M. (2013).
+# Click model-based information retrieval metrics. In SIGIR (pp. 493--502).
+# http://doi.org/10.1145/2484028.2484071
+UBM_GAMMAS = """
+0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  1.0000
+0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.6980  0.0029
+0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.6483  0.0023  0.0106
+0.0000  0.0000  0.0000  0.0000  0.0000  0.0000  0.5461  0.0032  0.0082  0.0263
+0.0000  0.0000  0.0000  0.0000  0.0000  0.5747  0.0042  0.0101  0.0215  0.0305
+0.0000  0.0000  0.0000  0.0000  0.4816  0.0067  0.0179  0.0280  0.0303  0.0599
+0.0000  0.0000  0.0000  0.5670  0.0099  0.0248  0.0476  0.0434  0.0620  0.0917
+0.0000  0.0000  0.5410  0.0187  0.0426  0.0716  0.0713  0.0826  0.0813  0.1518
+0.0000  0.8951  0.0331  0.0794  0.1242  0.1210  0.1449  0.1268  0.1559  0.1901
+0.9921  0.1199  0.2395  0.3230  0.3004  0.3107  0.3018  0.3212  0.3221  0.4149
+"""
+
+gammas = [[0.0 for j in xrange(10)] for k in xrange(10)]
+
+m = 0
+for line in UBM_GAMMAS.split('\n'):
+    line = line.strip()
+    if not line:
+        continue
+    n = 0
+    for item in line.split():
+        if not item:
+            continue
+        if n + m >= 9:
+            gammas[n][n + m - 9] = float(item)
+        n += 1
+    m += 1
+
+
+UBM_GAMMAS = gammas
+del gammas
+
+
+UBM_RELS = """
+IRRELEVANT      0.491912
+RELEVANT        0.570803
+USEFUL  0.695883
+VITAL   0.931482
+"""
+
+
+UBM_RELS = [float(x.split()[-1]) for x in UBM_RELS.split('\n') if x]
+
+
+def uubm_exam_click_probs(alpha):
+    """ Click probabilities of uUBM for every rank and previous click rank
+        (see ubm_full_click_probs()) given the (N x L) array of attractiveness
+        probabilities of the results, L <= 10.
+    """
+    L = alpha.shape[1]
+    gammas = np.pad(np.array(UBM_GAMMAS), [(0, 0), (0, 1)], 'constant')
+    return alpha[..., np.newaxis] * gammas[np.newaxis, :L, :L + 1]
+
+
+def uubm_click_probs(alpha):
+    """ Click probabilities of uUBM not conditioned on the clicks, in O(L^2)
+        per ranking (see uubm_exam_click_probs() for the argument).
+    """
+    return ubm_full_click_probs(uubm_exam_click_probs(alpha))